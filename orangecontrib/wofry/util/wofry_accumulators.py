@@ -0,0 +1,173 @@
+import os, tempfile
+import numpy, h5py
+
+class WavefrontAccumulator2D(object):
+    """
+    Running sums of the 2D wavefronts received by a viewer, with a memory footprint fixed at creation: intensity and
+    phase sums, the cross spectral density slices W(x1,0,x2,0) and W(0,y1,0,y2) (optionally downsampled) and the
+    integrated intensities of the last iterations.
+
+    If a spill file is given, the integrated intensities of all the iterations are appended to it in blocks, together
+    with a snapshot of the running sums. An existing file is never overwritten: a new file with a unique name is
+    created next to it (see get_spill_file_name()).
+    """
+    def __init__(self, x, y,
+                 single_precision=False,
+                 csd_downsampling=1,
+                 history_size=1000,
+                 spill_file_name=None):
+        super().__init__()
+
+        real_type    = numpy.float32 if single_precision else numpy.float64
+        complex_type = numpy.complex64 if single_precision else numpy.complex128
+
+        self.__x = x
+        self.__y = y
+
+        self.__csd_downsampling = max(1, int(csd_downsampling))
+
+        self.__intensity = numpy.zeros((x.size, y.size), dtype=real_type)
+        self.__phase     = numpy.zeros((x.size, y.size), dtype=real_type)
+
+        self.__W_x1_0_x2_0 = numpy.zeros((self.get_csd_coordinate_x().size, ) * 2, dtype=complex_type)
+        self.__W_0_y1_0_y2 = numpy.zeros((self.get_csd_coordinate_y().size, ) * 2, dtype=complex_type)
+
+        self.__counter = 0
+
+        # integrated intensities: ring buffer of the last iterations, plus running sums for the statistics
+        self.__history = numpy.zeros(max(1, int(history_size)), dtype=numpy.float64)
+        self.__first_iteration_intensity = 0.0
+        self.__iteration_intensities_sum = 0.0
+        self.__iteration_intensities_sum_squares = 0.0
+
+        self.__spill_file_name = None if spill_file_name is None else self.__get_new_file_name(spill_file_name)
+        self.__spilled = 0
+
+        if not self.__spill_file_name is None:
+            # the (empty) file has just been reserved by this accumulator
+            with h5py.File(self.__spill_file_name, "w") as f:
+                f.create_dataset("iteration_intensities", shape=(0,), maxshape=(None,), dtype=numpy.float64,
+                                 chunks=(self.__history.size,))
+
+    @classmethod
+    def __get_new_file_name(cls, file_name):
+        # creates the file atomically, to never take over an existing one
+        try:
+            with open(file_name, "x"): pass
+        except FileExistsError:
+            # e.g. wavefront_accumulation.h5 -> wavefront_accumulation_k3j9x2ab.h5
+            root, extension = os.path.splitext(os.path.basename(file_name))
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(file_name)),
+                                             prefix=root + "_", suffix=extension, delete=False) as f:
+                file_name = f.name
+
+        return file_name
+
+    def get_spill_file_name(self):
+        return self.__spill_file_name
+
+    def get_coordinate_x(self):
+        return self.__x
+
+    def get_coordinate_y(self):
+        return self.__y
+
+    def get_csd_coordinate_x(self):
+        return self.__x[::self.__csd_downsampling]
+
+    def get_csd_coordinate_y(self):
+        return self.__y[::self.__csd_downsampling]
+
+    def get_counter(self):
+        return self.__counter
+
+    def get_intensity(self):
+        return self.__intensity
+
+    def get_phase(self):
+        return self.__phase
+
+    def get_averaged_phase(self):
+        return self.__phase / self.__counter
+
+    def get_W_x1_0_x2_0(self):
+        return self.__W_x1_0_x2_0
+
+    def get_W_0_y1_0_y2(self):
+        return self.__W_0_y1_0_y2
+
+    def add_wavefront(self, wavefront):
+        complex_amplitude = wavefront.get_complex_amplitude()
+
+        if complex_amplitude.shape != self.__intensity.shape:
+            raise ValueError("Wavefront shape %s differs from the accumulated one %s: clear the accumulation first" %
+                             (str(complex_amplitude.shape), str(self.__intensity.shape)))
+
+        intensity = numpy.abs(complex_amplitude)**2
+
+        numpy.add(self.__intensity, intensity, out=self.__intensity, casting="unsafe")
+        numpy.add(self.__phase, numpy.angle(complex_amplitude), out=self.__phase, casting="unsafe")
+
+        mode_x = complex_amplitude[::self.__csd_downsampling, int(0.5 * complex_amplitude.shape[1])]
+        mode_y = complex_amplitude[int(0.5 * complex_amplitude.shape[0]), ::self.__csd_downsampling]
+
+        numpy.add(self.__W_x1_0_x2_0, numpy.outer(numpy.conj(mode_x), mode_x), out=self.__W_x1_0_x2_0, casting="unsafe")
+        numpy.add(self.__W_0_y1_0_y2, numpy.outer(numpy.conj(mode_y), mode_y), out=self.__W_0_y1_0_y2, casting="unsafe")
+
+        delta = wavefront.delta()
+        iteration_intensity = intensity.sum() * delta[0] * delta[1]
+
+        if self.__counter == 0: self.__first_iteration_intensity = iteration_intensity
+
+        self.__history[self.__counter % self.__history.size] = iteration_intensity
+        self.__iteration_intensities_sum += iteration_intensity
+        self.__iteration_intensities_sum_squares += iteration_intensity**2
+        self.__counter += 1
+
+        if not self.__spill_file_name is None and self.__counter - self.__spilled == self.__history.size: self.spill()
+
+    # iteration indices and integrated intensities of the iterations kept in memory
+    def get_iteration_intensities(self):
+        first = max(0, self.__counter - self.__history.size)
+        indices = numpy.arange(first, self.__counter)
+
+        return indices, self.__history[indices % self.__history.size]
+
+    def get_first_iteration_intensity(self):
+        return self.__first_iteration_intensity
+
+    def get_total_intensity(self):
+        return self.__iteration_intensities_sum
+
+    def get_mean_intensity(self):
+        return self.__iteration_intensities_sum / self.__counter
+
+    def get_standard_deviation_intensity(self):
+        mean = self.get_mean_intensity()
+
+        return numpy.sqrt(max(0.0, self.__iteration_intensities_sum_squares / self.__counter - mean**2))
+
+    def spill(self):
+        if self.__spill_file_name is None: return
+
+        indices, intensities = self.get_iteration_intensities()
+        intensities = intensities[indices >= self.__spilled]
+
+        with h5py.File(self.__spill_file_name, "a") as f:
+            dataset = f["iteration_intensities"]
+            dataset.resize((self.__spilled + intensities.size,))
+            dataset[self.__spilled:] = intensities
+
+            for name, data in [("counter", self.__counter),
+                               ("x", self.__x),
+                               ("y", self.__y),
+                               ("intensity", self.__intensity),
+                               ("phase", self.__phase),
+                               ("csd_x", self.get_csd_coordinate_x()),
+                               ("csd_y", self.get_csd_coordinate_y()),
+                               ("W_x1_0_x2_0", self.__W_x1_0_x2_0),
+                               ("W_0_y1_0_y2", self.__W_0_y1_0_y2)]:
+                if name in f: del f[name]
+                f[name] = data
+
+        self.__spilled = self.__counter
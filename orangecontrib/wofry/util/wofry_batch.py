@@ -0,0 +1,375 @@
+"""
+Headless execution of WOFRY beamlines (the WOBeamline carried by WofryData), without Qt.
+
+The beamline is read from a pickle file (as saved by save_beamline, e.g. from the Wavefront File Writer widget), the
+optical elements are propagated with the propagator and parameters stored in the beamline and the output wavefronts
+of a parameter sweep are written in a single HDF5 file, one group per case.
+
+Sweep parameters are named:
+
+    source.<name>              attribute of the light source (e.g. source.energy)
+    oe<N>.p, oe<N>.q           distances of the optical element N (1, 2, ...)
+    oe<N>.<name>               attribute of the optical element N (e.g. oe2.focal_x), or keyword of the elements
+                               created by create_from_keywords (e.g. oe3.grazing_angle_in)
+    oe<N>.propagator.<name>    additional parameter of the propagator of the optical element N
+
+The cases can be run in parallel by a pool of processes (workers > 1), each one receiving the beamline once: the
+results are gathered in the order of the cases.
+
+Usage:
+
+    python -m orangecontrib.wofry.util.wofry_batch beamline.pkl -s sweep.json -o output.h5 -j 32
+"""
+import sys, os, ast, copy, csv, json, pickle, argparse, multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from wofry.propagator.propagator import PropagationManager, PropagationElements, PropagationParameters
+from wofryimpl.propagator.propagators1D import initialize_default_propagator_1D
+from wofryimpl.propagator.propagators2D import initialize_default_propagator_2D
+
+from orangecontrib.wofry.util.wofry_propagators import PropagatorCache, CachedFresnel1D, CachedFresnelZoom1D, CachedFresnel2D, CachedFresnelZoomXY2D
+from orangecontrib.wofry.util.wofry_h5file import COMPRESSION_FILTERS, open_h5_file, write_h5_wavefront
+
+def initialize_propagators():
+    propagation_manager = PropagationManager.Instance()
+
+    if propagation_manager.get_propagators_number() == 0:
+        initialize_default_propagator_1D()
+        initialize_default_propagator_2D()
+
+#########################################################
+# BEAMLINE FILES
+
+def save_beamline(beamline, file_name):
+    with open(file_name, "wb") as f:
+        pickle.dump(beamline, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_beamline(file_name):
+    with open(file_name, "rb") as f:
+        beamline = pickle.load(f)
+
+    if beamline.get_light_source() is None: raise ValueError("The beamline in " + file_name + " has no light source")
+
+    return beamline
+
+#########################################################
+# SWEEPS
+
+def _convert_value(value):
+    if not isinstance(value, str): return value
+
+    for type in (int, float):
+        try:
+            return type(value)
+        except ValueError:
+            pass
+
+    return value.strip()
+
+def load_sweep(file_name):
+    """
+    Reads the cases of a sweep as a list of {parameter name: value} dictionaries, from a JSON file (list of
+    dictionaries, or dictionary of lists of equal length) or from a CSV file (one column per parameter).
+    """
+    if os.path.splitext(file_name)[1].lower() == ".csv":
+        with open(file_name, newline="") as f:
+            return [{name.strip(): _convert_value(value) for name, value in row.items()} for row in csv.DictReader(f)]
+    else:
+        with open(file_name) as f:
+            sweep = json.load(f)
+
+        if isinstance(sweep, dict):
+            lengths = set([len(values) for values in sweep.values()])
+            if len(lengths) > 1: raise ValueError("The parameters of the sweep must have the same number of values")
+
+            return [dict(zip(sweep.keys(), values)) for values in zip(*sweep.values())]
+        else:
+            return list(sweep)
+
+# variable names separated by commas are all set to the same value, as in the scan loops triggers
+def get_scan_cases(variable_name, values):
+    names = [name.strip() for name in variable_name.split(",") if name.strip() != ""]
+
+    return [{name: value for name in names} for value in values]
+
+# the elements created by create_from_keywords (e.g. WOMirror1D, WOLens1D) read their parameters from the keywords
+def _get_keywords(item):
+    keywords = getattr(item, "_keywords_at_creation", None)
+
+    return keywords if isinstance(keywords, dict) else {}
+
+def _set_attribute(item, name, value):
+    if name in _get_keywords(item): item._keywords_at_creation[name] = value
+    elif hasattr(item, "_" + name): setattr(item, "_" + name, value)
+    elif hasattr(item, name):       setattr(item, name, value)
+    else: raise ValueError("%s has no parameter %s" % (item.__class__.__name__, name))
+
+def _get_attribute(item, name):
+    if name in _get_keywords(item): return item._keywords_at_creation[name]
+    elif hasattr(item, "_" + name): return getattr(item, "_" + name)
+    elif hasattr(item, name):       return getattr(item, name)
+    else: raise ValueError("%s has no parameter %s" % (item.__class__.__name__, name))
+
+def get_beamline_parameter(beamline, name):
+    tokens = name.strip().split(".")
+
+    if len(tokens) == 2 and tokens[0] == "source":
+        return _get_attribute(beamline.get_light_source(), tokens[1])
+    elif len(tokens) >= 2 and tokens[0].startswith("oe"):
+        index = _get_element_index(beamline, tokens[0], name)
+
+        beamline_element = beamline.get_beamline_element_at(index)
+
+        if len(tokens) == 3 and tokens[1] == "propagator":
+            propagation_info = beamline.get_propagation_info_at(index)
+            names = list(propagation_info.get("propagator_additional_parameters_names", []))
+
+            if not tokens[2] in names: raise ValueError("The propagator has no parameter " + name)
+
+            return propagation_info["propagator_additional_parameters_values"][names.index(tokens[2])]
+        elif len(tokens) == 2 and tokens[1] in ("p", "q"):
+            return _get_attribute(beamline_element.get_coordinates(), tokens[1])
+        elif len(tokens) == 2:
+            return _get_attribute(beamline_element.get_optical_element(), tokens[1])
+        else:
+            raise ValueError("Bad parameter " + name)
+    else:
+        raise ValueError("Bad parameter " + name)
+
+def _get_element_index(beamline, token, name):
+    try:
+        index = int(token[2:]) - 1
+    except ValueError:
+        raise ValueError("Bad optical element in parameter " + name)
+
+    if index < 0 or index >= beamline.get_beamline_elements_number():
+        raise ValueError("Optical element %d not in the beamline (parameter %s)" % (index + 1, name))
+
+    return index
+
+def set_beamline_parameter(beamline, name, value):
+    tokens = name.strip().split(".")
+
+    if len(tokens) == 2 and tokens[0] == "source":
+        _set_attribute(beamline.get_light_source(), tokens[1], value)
+    elif len(tokens) >= 2 and tokens[0].startswith("oe"):
+        index = _get_element_index(beamline, tokens[0], name)
+
+        beamline_element = beamline.get_beamline_element_at(index)
+
+        if len(tokens) == 3 and tokens[1] == "propagator":
+            propagation_info = dict(beamline.get_propagation_info_at(index))
+            names  = list(propagation_info.get("propagator_additional_parameters_names", []))
+            values = list(propagation_info.get("propagator_additional_parameters_values", []))
+
+            if tokens[2] in names: values[names.index(tokens[2])] = value
+            else:
+                names.append(tokens[2])
+                values.append(value)
+
+            propagation_info["propagator_additional_parameters_names"]  = names
+            propagation_info["propagator_additional_parameters_values"] = values
+
+            beamline.get_propagation_info_list()[index] = propagation_info
+        elif len(tokens) == 2 and tokens[1] in ("p", "q"):
+            _set_attribute(beamline_element.get_coordinates(), tokens[1], value)
+        elif len(tokens) == 2:
+            _set_attribute(beamline_element.get_optical_element(), tokens[1], value)
+        else:
+            raise ValueError("Bad parameter " + name)
+    else:
+        raise ValueError("Bad parameter " + name)
+
+#########################################################
+# PROPAGATION
+
+# the propagators of this package apply the FFT backend of the additional parameters, with or without kernels cache
+def _get_local_propagator(handler_name, propagator_cache):
+    for propagator_class in (CachedFresnel1D, CachedFresnelZoom1D, CachedFresnel2D, CachedFresnelZoomXY2D):
+        if propagator_class.HANDLER_NAME == handler_name: return propagator_class(propagator_cache)
+
+    return None
+
+# the beamlines saved by older versions store the FFT backend name quoted, as written in the script
+def _get_propagator_parameter_value(value):
+    if isinstance(value, str) and len(value) >= 2 and value[0] == value[-1] and value[0] in ("'", '"'):
+        return ast.literal_eval(value)
+
+    return value
+
+def run_beamline(beamline, propagator_cache=None, input_wavefront=None):
+    """
+    Returns the wavefront at the end of the beamline, propagated as in the script generated by the widgets. The
+    Fresnel propagators use the kernels of propagator_cache, if given, and the FFT backend stored in the beamline. The propagation starts from input_wavefront, if
+    given, instead of the wavefront of the light source.
+    """
+    initialize_propagators()
+
+    if input_wavefront is None: output_wavefront = beamline.get_light_source().get_wavefront()
+    else:                       output_wavefront = input_wavefront
+
+    for index in range(beamline.get_beamline_elements_number()):
+        beamline_element = beamline.get_beamline_element_at(index)
+        coordinates      = beamline_element.get_coordinates()
+        propagation_info = beamline.get_propagation_info_at(index)
+
+        input_wavefront = output_wavefront.duplicate()
+
+        if coordinates.p() == 0.0 and coordinates.q() == 0.0:
+            output_wavefront = beamline_element.get_optical_element().applyOpticalElement(input_wavefront)
+        else:
+            propagation_elements = PropagationElements()
+            propagation_elements.add_beamline_element(beamline_element)
+
+            propagation_parameters = PropagationParameters(wavefront=input_wavefront, propagation_elements=propagation_elements)
+
+            for name, value in zip(propagation_info.get("propagator_additional_parameters_names", []),
+                                   propagation_info.get("propagator_additional_parameters_values", [])):
+                propagation_parameters.set_additional_parameters(name, _get_propagator_parameter_value(value))
+
+            if not "propagator_handler_name" in propagation_info:
+                raise ValueError("Optical element %d has p or q not zero, but no propagator (its distances can be keywords, e.g. p_distance)" % (index + 1))
+
+            handler_name     = propagation_info["propagator_handler_name"]
+            local_propagator = _get_local_propagator(handler_name, propagator_cache)
+
+            if local_propagator is None:
+                output_wavefront = PropagationManager.Instance().do_propagation(propagation_parameters=propagation_parameters,
+                                                                                handler_name=handler_name)
+            else:
+                output_wavefront = local_propagator.do_propagation(parameters=propagation_parameters)
+
+    return output_wavefront
+
+def run_case(beamline, case, propagator_cache=None, input_wavefront=None):
+    case_beamline = copy.deepcopy(beamline)
+    for name, value in case.items(): set_beamline_parameter(case_beamline, name, value)
+
+    return run_beamline(case_beamline, propagator_cache=propagator_cache, input_wavefront=input_wavefront)
+
+# state of the processes of the pool: the beamline is sent once, the kernels cache lives as long as the process
+_worker_beamline = None
+_worker_input_wavefront = None
+_worker_propagator_cache = None
+
+def _initialize_worker(beamline_data, use_propagator_cache):
+    global _worker_beamline, _worker_input_wavefront, _worker_propagator_cache
+
+    _worker_beamline, _worker_input_wavefront = pickle.loads(beamline_data)
+    _worker_propagator_cache = PropagatorCache() if use_propagator_cache else None
+
+def _run_worker_case(case):
+    return run_case(_worker_beamline, case, propagator_cache=_worker_propagator_cache, input_wavefront=_worker_input_wavefront)
+
+def run_cases(beamline, cases, workers=1, use_propagator_cache=True, input_wavefront=None):
+    """
+    Yields (case index, output wavefront or exception) in the order of the cases. With workers > 1 the cases are run
+    by a pool of processes (spawned, so it is safe from a Qt application), with at most 2 x workers cases in flight.
+    """
+    if workers <= 1:
+        propagator_cache = PropagatorCache() if use_propagator_cache else None
+
+        for index, case in enumerate(cases):
+            try:
+                yield index, run_case(beamline, case, propagator_cache=propagator_cache, input_wavefront=input_wavefront)
+            except Exception as exception:
+                yield index, exception
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_initialize_worker,
+                                 initargs=(pickle.dumps((beamline, input_wavefront), protocol=pickle.HIGHEST_PROTOCOL), use_propagator_cache)) as executor:
+            futures = deque()
+            next_case = 0
+
+            while next_case < len(cases) or len(futures) > 0:
+                while next_case < len(cases) and len(futures) < 2 * workers:
+                    futures.append((next_case, executor.submit(_run_worker_case, cases[next_case])))
+                    next_case += 1
+
+                index, future = futures.popleft()
+
+                try:
+                    yield index, future.result()
+                except Exception as exception:
+                    yield index, exception
+
+def run_sweep(beamline, cases, output_file_name, first_case=0, last_case=None, use_propagator_cache=True,
+              compression=None, compression_level=4, single_precision=False, workers=1, verbose=True):
+    """
+    Propagates a copy of the beamline for each case (from first_case to last_case included) and writes the output
+    wavefronts in the groups case_NNNN of the output file, with the case parameters as attributes. Failed cases are
+    reported and skipped. Returns the indices of the failed cases.
+    """
+    if len(cases) == 0: cases = [{}]
+    if last_case is None: last_case = len(cases) - 1
+
+    indices = list(range(first_case, min(last_case, len(cases) - 1) + 1))
+    failed_cases = []
+
+    with open_h5_file(output_file_name, overwrite=True) as f:
+        for position, output_wavefront in run_cases(beamline, [cases[index] for index in indices],
+                                                    workers=workers, use_propagator_cache=use_propagator_cache):
+            index = indices[position]
+            case  = cases[index]
+
+            try:
+                if isinstance(output_wavefront, Exception): raise output_wavefront
+
+                filepath = "case_%04d" % index
+
+                write_h5_wavefront(f, output_wavefront, filepath,
+                                   compression=compression,
+                                   compression_level=compression_level,
+                                   single_precision=single_precision)
+
+                for name, value in case.items(): f[filepath].attrs[name] = value
+                f[filepath].attrs["integrated_intensity"] = output_wavefront.get_integrated_intensity()
+
+                f.flush()
+
+                if verbose: print("case %d: %s, integrated intensity %g" % (index, str(case), output_wavefront.get_integrated_intensity()))
+            except Exception as exception:
+                failed_cases.append(index)
+
+                print("case %d: %s, failed: %s" % (index, str(case), str(exception)), file=sys.stderr)
+
+    return failed_cases
+
+#########################################################
+# COMMAND LINE
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs a WOFRY beamline (or a parameter sweep of it) without Qt.")
+    parser.add_argument("beamline", help="beamline file (pickle, as saved from the Wavefront File Writer widget)")
+    parser.add_argument("-s", "--sweep", default=None, help="sweep file: JSON (list of cases, or parameter lists) or CSV (one column per parameter)")
+    parser.add_argument("-o", "--output", default="wofry_batch.h5", help="output HDF5 file")
+    parser.add_argument("--first", type=int, default=0, help="first case to run (to split a sweep in several jobs)")
+    parser.add_argument("--last", type=int, default=None, help="last case to run")
+    parser.add_argument("--compression", choices=[str(compression) for compression in COMPRESSION_FILTERS], default="None")
+    parser.add_argument("--compression-level", type=int, default=4)
+    parser.add_argument("--single-precision", action="store_true", help="write complex amplitudes as complex64")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="number of processes running the cases")
+    parser.add_argument("--no-propagator-cache", action="store_true", help="do not reuse the Fresnel kernels between cases")
+    parser.add_argument("-q", "--quiet", action="store_true")
+
+    arguments = parser.parse_args(argv)
+
+    beamline = load_beamline(arguments.beamline)
+    cases    = [] if arguments.sweep is None else load_sweep(arguments.sweep)
+
+    failed_cases = run_sweep(beamline, cases, arguments.output,
+                             first_case=arguments.first,
+                             last_case=arguments.last,
+                             use_propagator_cache=not arguments.no_propagator_cache,
+                             compression=None if arguments.compression == "None" else arguments.compression,
+                             compression_level=arguments.compression_level,
+                             single_precision=arguments.single_precision,
+                             workers=arguments.workers,
+                             verbose=not arguments.quiet)
+
+    return 1 if len(failed_cases) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+import os, json, hashlib, h5py
+
+from wofry.propagator.wavefront1D.generic_wavefront import GenericWavefront1D
+from orangecontrib.wofry.util.wofry_coherent_modes import WOUndulatorCoherentModeDecomposition1D
+
+# to be increased when the content of the files changes
+CMD_CACHE_VERSION = 1
+
+# total size of the files kept in the cache: the least recently used ones are removed above it
+DEFAULT_CMD_CACHE_MAX_SIZE_IN_MB = 1000.0
+
+def get_default_cmd_cache_directory():
+    return os.path.join(os.path.expanduser("~"), ".wofry", "cmd_cache")
+
+def get_cmd_cache_key(parameters):
+    """
+    Hash of the parameters of WOUndulatorCoherentModeDecomposition1D (the keyword arguments of the constructor).
+    """
+    try:
+        from importlib.metadata import version
+        wofryimpl_version = version("wofryimpl")
+    except Exception:
+        wofryimpl_version = "unknown"
+
+    text = json.dumps({"cache_version": CMD_CACHE_VERSION,
+                       "wofryimpl_version": wofryimpl_version,
+                       "parameters": {name: repr(value) for name, value in parameters.items()}}, sort_keys=True)
+
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def get_cmd_cache_file_name(cache_directory, parameters):
+    return os.path.join(cache_directory, "cmd_" + get_cmd_cache_key(parameters) + ".h5")
+
+def _write_wavefront(f, name, wavefront):
+    if not wavefront is None:
+        group = f.create_group(name)
+        group["abscissas"]         = wavefront.get_abscissas()
+        group["complex_amplitude"] = wavefront.get_complex_amplitude()
+        group["photon_energy"]     = wavefront.get_photon_energy()
+
+def _read_wavefront(f, name):
+    if not name in f: return None
+
+    group = f[name]
+    wavefront = GenericWavefront1D.initialize_wavefront_from_arrays(group["abscissas"][()], group["complex_amplitude"][()])
+    wavefront.set_photon_energy(group["photon_energy"][()])
+
+    return wavefront
+
+def save_coherent_mode_decomposition(file_name, parameters, coherent_mode_decomposition):
+    """
+    Writes the results of the calculation (CSD, eigenvalues, eigenvectors and intermediate wavefronts). The file is
+    written aside and renamed, so that a file in the cache is always complete.
+    """
+    directory = os.path.dirname(file_name)
+    if directory != "" and not os.path.isdir(directory): os.makedirs(directory)
+
+    temporary_file_name = file_name + ".%d.tmp" % os.getpid()
+
+    with h5py.File(temporary_file_name, "w") as f:
+        f.attrs["cache_version"] = CMD_CACHE_VERSION
+        f.attrs["parameters"]    = json.dumps({name: repr(value) for name, value in parameters.items()}, sort_keys=True)
+
+        f["abscissas"]    = coherent_mode_decomposition.abscissas
+        f["CSD"]          = coherent_mode_decomposition.CSD
+        f["eigenvalues"]  = coherent_mode_decomposition.eigenvalues
+        f["eigenvectors"] = coherent_mode_decomposition.eigenvectors
+
+        _write_wavefront(f, "far_field_wavefront", coherent_mode_decomposition.far_field_wavefront)
+        _write_wavefront(f, "output_wavefront", coherent_mode_decomposition.output_wavefront)
+
+    os.replace(temporary_file_name, file_name)
+
+def load_coherent_mode_decomposition(file_name, parameters):
+    """
+    Returns a WOUndulatorCoherentModeDecomposition1D with the results read from the file, as after calculate().
+    """
+    coherent_mode_decomposition = WOUndulatorCoherentModeDecomposition1D(**parameters)
+
+    with h5py.File(file_name, "r") as f:
+        coherent_mode_decomposition.abscissas    = f["abscissas"][()]
+        coherent_mode_decomposition.CSD          = f["CSD"][()]
+        coherent_mode_decomposition.eigenvalues  = f["eigenvalues"][()]
+        coherent_mode_decomposition.eigenvectors = f["eigenvectors"][()]
+
+        coherent_mode_decomposition.far_field_wavefront = _read_wavefront(f, "far_field_wavefront")
+        coherent_mode_decomposition.output_wavefront    = _read_wavefront(f, "output_wavefront")
+
+    return coherent_mode_decomposition
+
+def get_results(coherent_mode_decomposition):
+    return {"CSD": coherent_mode_decomposition.CSD,
+            "abscissas": coherent_mode_decomposition.abscissas,
+            "eigenvalues": coherent_mode_decomposition.eigenvalues,
+            "eigenvectors": coherent_mode_decomposition.eigenvectors}
+
+def _get_cmd_cache_files(cache_directory):
+    if not os.path.isdir(cache_directory): return []
+
+    return [os.path.join(cache_directory, file_name) for file_name in os.listdir(cache_directory)
+            if file_name.startswith("cmd_") and file_name.endswith(".h5")]
+
+def get_cmd_cache_size(cache_directory):
+    return sum(os.path.getsize(file_name) for file_name in _get_cmd_cache_files(cache_directory))
+
+def evict_cmd_cache(cache_directory, max_size_in_MB=DEFAULT_CMD_CACHE_MAX_SIZE_IN_MB, keep=None):
+    """
+    Removes the least recently used files (modification time, updated at each read) until the cache is not larger than
+    max_size_in_MB. The file keep (the one just written) is never removed.
+    """
+    files = sorted(_get_cmd_cache_files(cache_directory), key=os.path.getmtime)
+    size  = sum(os.path.getsize(file_name) for file_name in files)
+
+    for file_name in files:
+        if size <= max_size_in_MB * 1e6: break
+        if not keep is None and os.path.abspath(file_name) == os.path.abspath(keep): continue
+
+        size -= os.path.getsize(file_name)
+        os.remove(file_name)
+
+def calculate_coherent_mode_decomposition(parameters, cache_directory=None, max_size_in_MB=DEFAULT_CMD_CACHE_MAX_SIZE_IN_MB):
+    """
+    Returns the coherent mode decomposition for the parameters (keyword arguments of WOUndulatorCoherentModeDecomposition1D)
+    and its results, read from the cache directory if already calculated (None for no cache). The cache is kept below
+    max_size_in_MB.
+    """
+    file_name = None if cache_directory is None else get_cmd_cache_file_name(cache_directory, parameters)
+
+    if not file_name is None and os.path.isfile(file_name):
+        try:
+            coherent_mode_decomposition = load_coherent_mode_decomposition(file_name, parameters)
+            os.utime(file_name) # most recently used
+            print("Coherent mode decomposition read from cache: " + file_name)
+
+            return coherent_mode_decomposition, get_results(coherent_mode_decomposition)
+        except Exception as exception:
+            print("Cannot read the cache file " + file_name + ": " + str(exception))
+
+    coherent_mode_decomposition = WOUndulatorCoherentModeDecomposition1D(**parameters)
+    coherent_mode_decomposition.calculate()
+
+    # the electron energy is changed during the calculation with energy dispersion
+    coherent_mode_decomposition.electron_energy = parameters["electron_energy"]
+
+    if not file_name is None:
+        try:
+            save_coherent_mode_decomposition(file_name, parameters, coherent_mode_decomposition)
+            evict_cmd_cache(cache_directory, max_size_in_MB=max_size_in_MB, keep=file_name)
+        except Exception as exception:
+            print("Cannot write the cache file " + file_name + ": " + str(exception))
+
+    return coherent_mode_decomposition, get_results(coherent_mode_decomposition)
+
+def clear_cmd_cache(cache_directory):
+    for file_name in _get_cmd_cache_files(cache_directory): os.remove(file_name)
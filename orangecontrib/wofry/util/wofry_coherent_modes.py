@@ -0,0 +1,121 @@
+import numpy
+from scipy.sparse.linalg import eigsh
+
+from wofryimpl.propagator.util.undulator_coherent_mode_decomposition_1d import UndulatorCoherentModeDecomposition1D
+
+from orangecontrib.wofry.util.wofry_objects import WofryModeStack2D
+
+def get_top_eigenmodes(matrix, occupation_threshold, initial_number_of_modes=20):
+    """
+    Eigenvalues (decreasing) and eigenvectors (rows) of the hermitian matrix, only the first ones needed to reach the
+    cumulated occupation threshold (fraction of the trace). The modes are calculated by Lanczos iterations (ARPACK),
+    doubling their number until the threshold is reached; for small matrices, or when too many modes are needed, the
+    full decomposition is used.
+    """
+    size = matrix.shape[0]
+    trace = numpy.real(numpy.trace(matrix))
+
+    number_of_modes = min(max(1, int(initial_number_of_modes)), size)
+
+    while True:
+        if number_of_modes >= size // 4:
+            eigenvalues, eigenvectors = numpy.linalg.eigh(matrix)
+        else:
+            eigenvalues, eigenvectors = eigsh(matrix, k=number_of_modes, which="LA")
+
+        indices = numpy.argsort(eigenvalues)[::-1]
+        eigenvalues  = eigenvalues[indices]
+        eigenvectors = eigenvectors[:, indices].T
+
+        cumulated_occupation = numpy.cumsum(eigenvalues) / trace
+
+        if cumulated_occupation[-1] >= occupation_threshold or eigenvalues.size == size:
+            # at least the modes asked initially
+            last = max(min(number_of_modes, size), numpy.searchsorted(cumulated_occupation, occupation_threshold) + 1)
+
+            return eigenvalues[0:last], eigenvectors[0:last, :]
+
+        number_of_modes *= 2
+
+class WOUndulatorCoherentModeDecomposition1D(UndulatorCoherentModeDecomposition1D):
+    """
+    Coherent mode decomposition calculating, if occupation_threshold is given, only the first modes up to that
+    cumulated occupation (partial eigensolver), instead of the full spectrum of the CSD. The number of modes and the
+    coherent fraction are printed only if verbose.
+    """
+    def __init__(self, occupation_threshold=None, minimum_number_of_modes=20, verbose=False, **parameters):
+        super().__init__(**parameters)
+
+        self.occupation_threshold    = occupation_threshold
+        self.minimum_number_of_modes = minimum_number_of_modes
+        self.verbose                 = verbose
+
+    def _diagonalize(self, normalize_eigenvectors=False):
+        if self.occupation_threshold is None:
+            super()._diagonalize(normalize_eigenvectors=normalize_eigenvectors)
+        else:
+            self.eigenvalues, self.eigenvectors = get_top_eigenmodes(self.CSD,
+                                                                     self.occupation_threshold,
+                                                                     initial_number_of_modes=self.minimum_number_of_modes)
+
+            if normalize_eigenvectors:
+                step = self.abscissas[1] - self.abscissas[0]
+                self.eigenvectors /= numpy.sqrt(numpy.sum(numpy.abs(self.eigenvectors)**2, axis=1) * step)[:, numpy.newaxis]
+
+            if self.verbose:
+                print("Modes calculated: %d, occupation: %g" % (self.eigenvalues.size, self.eigenvalues.sum() / numpy.real(numpy.trace(self.CSD))))
+                print("Coherence Fraction (from modes): ", self.eigenvalues[0] / numpy.real(numpy.trace(self.CSD)))
+
+# above it the N x N eigenvalues of GaussianSchellModel2D.sortedModeIndices are not calculated
+GSM_2D_FULL_SORT_MAXIMUM_MODES = 2048
+
+def get_gsm_2d_sorted_modes(gsm_2d, number_of_modes):
+    """
+    Mode orders (n, m) and eigenvalues beta_x(n) * beta_y(m) of the first number_of_modes (N) modes of a
+    GaussianSchellModel2D, by decreasing eigenvalue.
+
+    Up to GSM_2D_FULL_SORT_MAXIMUM_MODES the order is the one of sortedModeIndices(i, n_points=N), including the modes
+    with equal eigenvalues (the same sort of the N x N grid is done). For more modes the (n, m) mode is preceded by all
+    the (n' <= n, m' <= m) modes, so only the orders with (n + 1) (m + 1) <= N are candidates and O(N log N) values are
+    sorted: the eigenvalues are the same, but equal ones are ordered by decreasing n, then m (the order of
+    sortedModeIndices depends there on its unstable sort, and it cannot be calculated for so many modes anyway).
+    """
+    number_of_modes = max(1, int(number_of_modes))
+
+    # scalar calls (O(N)), to have the same rounding of the eigenvalues of GaussianSchellModel2D
+    eigenvalues_x = numpy.array([gsm_2d._mode_x.beta(i) for i in range(number_of_modes)])
+    eigenvalues_y = numpy.array([gsm_2d._mode_y.beta(i) for i in range(number_of_modes)])
+
+    if number_of_modes <= GSM_2D_FULL_SORT_MAXIMUM_MODES:
+        # as in sortedModeIndices
+        f = numpy.outer(eigenvalues_x, eigenvalues_y)
+        indices = f.flatten().argsort()[::-1][0:number_of_modes]
+        n, m = numpy.unravel_index(indices, (number_of_modes, number_of_modes))
+
+        return n, m, f.flatten()[indices]
+
+    n = numpy.arange(number_of_modes)
+    n_candidates = numpy.repeat(n, number_of_modes // (n + 1))
+    m_candidates = numpy.arange(n_candidates.size) - numpy.repeat(numpy.cumsum(number_of_modes // (n + 1)) - number_of_modes // (n + 1),
+                                                                 number_of_modes // (n + 1))
+
+    eigenvalues = eigenvalues_x[n_candidates] * eigenvalues_y[m_candidates]
+
+    indices = numpy.lexsort((-m_candidates, -n_candidates, -eigenvalues))[0:number_of_modes]
+
+    return n_candidates[indices], m_candidates[indices], eigenvalues[indices]
+
+def get_gsm_2d_mode_stack(gsm_2d, coordinate_x, coordinate_y, orders_x, orders_y, wavelength=1e-10, mode_indices=None):
+    """
+    WofryModeStack2D of the (orders_x[i], orders_y[i]) modes of a GaussianSchellModel2D, as set by
+    GenericWavefront2D.set_gaussian_hermite_mode(): the 1D factors sqrt(beta_x(n)) phi_x(n) and sqrt(beta_y(m)) phi_y(m)
+    are calculated once for each order up to the largest one.
+    """
+    orders_x = numpy.array(orders_x, dtype=int)
+    orders_y = numpy.array(orders_y, dtype=int)
+
+    factors_x = numpy.array([numpy.sqrt(gsm_2d._mode_x.beta(n)) * gsm_2d._mode_x.phi(n, coordinate_x) for n in range(orders_x.max() + 1)]) + 0j
+    factors_y = numpy.array([numpy.sqrt(gsm_2d._mode_y.beta(m)) * gsm_2d._mode_y.phi(m, coordinate_y) for m in range(orders_y.max() + 1)]) + 0j
+
+    return WofryModeStack2D(coordinate_x, coordinate_y, factors_x, factors_y, orders_x, orders_y,
+                            wavelength=wavelength, mode_indices=mode_indices)
@@ -0,0 +1,457 @@
+import os, time, warnings, numpy, h5py
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+from wofry.propagator.polarization import Polarization
+from wofry.propagator.wavefront1D.generic_wavefront import GenericWavefront1D
+from wofry.propagator.wavefront2D.generic_wavefront import GenericWavefront2D
+from wofryimpl.propagator.light_source_h5file import WOH5FileLightSource
+
+# rows read from the file at each step when binning, to keep the temporary buffers small
+BLOCK_SIZE_IN_MB = 64.0
+
+COMPRESSION_FILTERS = [None, "gzip", "lzf", "blosc"]
+
+def _get_index_range(coordinates, roi, binning):
+    if roi is None:
+        first, last = 0, coordinates.size
+    else:
+        first = numpy.searchsorted(coordinates, min(roi), side="left")
+        last  = numpy.searchsorted(coordinates, max(roi), side="right")
+
+    last = first + ((last - first) // binning) * binning
+
+    if last <= first: raise ValueError("Region of interest [%g, %g] contains less than %d points" % (min(roi), max(roi), binning))
+
+    return first, last
+
+def _bin_coordinates(coordinates, binning):
+    return coordinates.reshape(-1, binning).mean(axis=1)
+
+# binned pixel: the mean intensity (so the integrated intensity is kept) with the phase of the mean complex amplitude
+def _bin_complex_amplitude(data, axis):
+    intensity = numpy.mean(numpy.abs(data)**2, axis=axis)
+    phase     = numpy.angle(numpy.mean(data, axis=axis))
+
+    return numpy.sqrt(intensity) * numpy.exp(1j * phase)
+
+def _read_dataset_1D(dataset, x_range, binning):
+    data = dataset[x_range[0]:x_range[1]].astype(numpy.complex128)
+
+    return data if binning == 1 else _bin_complex_amplitude(data.reshape(-1, binning), axis=1)
+
+# data are stored transposed: the first index of the dataset is the vertical one
+def _read_dataset_2D(dataset, x_range, y_range, binning):
+    binning_x, binning_y = binning
+
+    if binning_x == 1 and binning_y == 1: return dataset[y_range[0]:y_range[1], x_range[0]:x_range[1]].T.astype(numpy.complex128)
+
+    n_columns = x_range[1] - x_range[0]
+    rows_per_block = binning_y * max(1, int(BLOCK_SIZE_IN_MB * 1e6 / (dataset.dtype.itemsize * n_columns * binning_y)))
+
+    data = numpy.zeros(((y_range[1] - y_range[0]) // binning_y, n_columns // binning_x), dtype=numpy.complex128)
+
+    for first_row in range(y_range[0], y_range[1], rows_per_block):
+        last_row = min(first_row + rows_per_block, y_range[1])
+        block = dataset[first_row:last_row, x_range[0]:x_range[1]]
+
+        data[(first_row - y_range[0]) // binning_y:(last_row - y_range[0]) // binning_y, :] = \
+            _bin_complex_amplitude(block.reshape(-1, binning_y, n_columns // binning_x, binning_x), axis=(1, 3))
+
+    return data.T
+
+def get_h5_wavefront_dimension(filename, filepath="wfr"):
+    with h5py.File(filename, 'r') as f:
+        return 1 if filepath + "/wfr_mesh" in f else 2
+
+def load_h5_wavefront(filename, filepath="wfr", x_roi=None, y_roi=None, binning_x=1, binning_y=1):
+    """
+    Loads a 1D or 2D wavefront saved by save_h5_file, reading from the file only the region of interest (x_roi and
+    y_roi are [min, max] in m, None for the full range). Binning joins binning_x * binning_y pixels while reading: each
+    binned pixel has their mean intensity and the phase of their mean complex amplitude.
+    """
+    binning_x = int(binning_x)
+    binning_y = int(binning_y)
+
+    if binning_x < 1 or binning_y < 1: raise ValueError("Binning must be a positive integer")
+
+    try:
+        f = h5py.File(filename, 'r')
+    except OSError:
+        raise Exception("Cannot open file %s." % filename)
+
+    try:
+        group = f[filepath]
+
+        photon_energy = group["wfr_photon_energy"][()]
+        dataset_s = group["wfr_complex_amplitude_s"]
+        dataset_p = group["wfr_complex_amplitude_p"] if "wfr_complex_amplitude_p" in group else None
+
+        if "wfr_mesh" in group:
+            mesh = group["wfr_mesh"][()]
+            x = numpy.linspace(mesh[0], mesh[1], int(mesh[2]))
+            x_range = _get_index_range(x, x_roi, binning_x)
+
+            complex_amplitude_s = _read_dataset_1D(dataset_s, x_range, binning_x)
+            complex_amplitude_p = None if dataset_p is None else _read_dataset_1D(dataset_p, x_range, binning_x)
+
+            wavefront = GenericWavefront1D.initialize_wavefront_from_arrays(_bin_coordinates(x[x_range[0]:x_range[1]], binning_x),
+                                                                          complex_amplitude_s,
+                                                                          complex_amplitude_p)
+        else:
+            mesh_X = group["wfr_mesh_X"][()]
+            mesh_Y = group["wfr_mesh_Y"][()]
+            x = numpy.linspace(mesh_X[0], mesh_X[1], int(mesh_X[2]))
+            y = numpy.linspace(mesh_Y[0], mesh_Y[1], int(mesh_Y[2]))
+            x_range = _get_index_range(x, x_roi, binning_x)
+            y_range = _get_index_range(y, y_roi, binning_y)
+
+            complex_amplitude_s = _read_dataset_2D(dataset_s, x_range, y_range, (binning_x, binning_y))
+            complex_amplitude_p = None if dataset_p is None else _read_dataset_2D(dataset_p, x_range, y_range, (binning_x, binning_y))
+
+            wavefront = GenericWavefront2D.initialize_wavefront_from_arrays(x_array=_bin_coordinates(x[x_range[0]:x_range[1]], binning_x),
+                                                                          y_array=_bin_coordinates(y[y_range[0]:y_range[1]], binning_y),
+                                                                          z_array=complex_amplitude_s,
+                                                                          z_array_pi=complex_amplitude_p)
+    except ValueError as e:
+        raise e
+    except (KeyError, OSError):
+        raise Exception("Cannot load oasys/wofry wavefront from file %s." % filename)
+    finally:
+        f.close()
+
+    wavefront.set_photon_energy(photon_energy)
+
+    return wavefront
+
+def is_compression_available(compression):
+    return compression != "blosc" or not hdf5plugin is None
+
+def get_dataset_options(shape, compression=None, compression_level=4, chunks=None):
+    """
+    Keyword arguments of h5py create_dataset for the given storage layout. chunks is None (contiguous, or automatic if
+    compressed), True (automatic) or a chunk shape, clipped to the dataset shape.
+    """
+    options = {}
+
+    if not chunks is None and not chunks is True:
+        chunks = tuple(int(max(1, min(c, n))) for c, n in zip(chunks, shape))
+
+    if compression == "gzip":
+        options["compression"] = "gzip"
+        options["compression_opts"] = int(compression_level)
+    elif compression == "lzf":
+        options["compression"] = "lzf"
+    elif compression == "blosc":
+        if hdf5plugin is None:
+            warnings.warn("Blosc filter not available (hdf5plugin not installed): using gzip")
+            return get_dataset_options(shape, "gzip", compression_level, chunks)
+
+        options.update(hdf5plugin.Blosc(cname="lz4", clevel=int(compression_level), shuffle=hdf5plugin.Blosc.SHUFFLE))
+    elif not compression is None:
+        raise ValueError("Compression filter not recognized: " + str(compression))
+
+    if not compression is None and chunks is None: chunks = True
+    if not chunks is None: options["chunks"] = chunks
+
+    return options
+
+def write_h5_wavefront(f, wavefront, filepath="wfr", intensity=True, compression=None, compression_level=4, chunks=None, single_precision=False):
+    """
+    Writes the wavefront in the group filepath of the open h5py file f, with the same layout of save_h5_file (readable
+    by load_h5_file). Complex amplitudes are stored as complex64 if single_precision, chunks are in the (x, y) order.
+    """
+    complex_type = numpy.complex64 if single_precision else numpy.complex128
+    real_type    = numpy.float32 if single_precision else numpy.float64
+
+    dimension = int(wavefront.get_dimension())
+
+    # 2D arrays are stored transposed
+    def prepare(data, dtype):
+        return data.astype(dtype) if dimension == 1 else data.T.astype(dtype)
+
+    chunks = chunks if (chunks is None or chunks is True or dimension == 1) else tuple(reversed(chunks))
+
+    def create_dataset(group, name, data):
+        return group.create_dataset(name, data=data, **get_dataset_options(data.shape, compression, compression_level, chunks))
+
+    if filepath in f: del f[filepath]
+    f1 = f.create_group(filepath)
+
+    create_dataset(f1, "wfr_complex_amplitude_s", prepare(wavefront.get_complex_amplitude(), complex_type))
+    if wavefront.is_polarized():
+        create_dataset(f1, "wfr_complex_amplitude_p", prepare(wavefront.get_complex_amplitude(polarization=Polarization.PI), complex_type))
+
+    f1.attrs['NX_class'] = 'NXentry'
+    f1.attrs['default'] = 'intensity'
+
+    f1["wfr_dimension"] = dimension
+    f1["wfr_photon_energy"] = wavefront.get_photon_energy()
+
+    if dimension == 1:
+        x = wavefront.get_abscissas()
+        f1["wfr_mesh"] = numpy.array([x[0], x[-1], x.size])
+    else:
+        x = wavefront.get_coordinate_x()
+        y = wavefront.get_coordinate_y()
+        f1["wfr_mesh_X"] = numpy.array([x[0], x[-1], x.size])
+        f1["wfr_mesh_Y"] = numpy.array([y[0], y[-1], y.size])
+
+    if intensity:
+        f2 = f1.create_group("intensity")
+        create_dataset(f2, "wfr_intensity", prepare(wavefront.get_intensity(polarization=Polarization.TOTAL if wavefront.is_polarized() else Polarization.SIGMA), real_type))
+
+        # NX plot attributes for automatic plot with silx view
+        f2.attrs['NX_class'] = 'NXdata'
+        f2.attrs['signal'] = 'wfr_intensity'
+        if dimension == 1:
+            f2.attrs['axes'] = b'axis_x'
+        else:
+            f2.attrs['axes'] = [b'axis_y', b'axis_x']
+            f2["wfr_intensity"].attrs['interpretation'] = 'image'
+
+            ds = f2.create_dataset('axis_y', data=1e6*y)
+            ds.attrs['units'] = 'microns'
+            ds.attrs['long_name'] = 'Y Pixel Size (microns)'
+
+        ds = f2.create_dataset('axis_x', data=1e6*x)
+        ds.attrs['units'] = 'microns'
+        ds.attrs['long_name'] = 'X Pixel Size (microns)'
+
+def open_h5_file(filename, overwrite=True):
+    """
+    Opens a file for writing wavefronts, creating it (with the oasys-wofry root attributes) if it does not exist or if
+    overwrite.
+    """
+    if overwrite or not os.path.isfile(filename):
+        f = h5py.File(filename, 'w')
+        f.attrs['default']      = 'entry'
+        f.attrs['file_name']    = filename
+        f.attrs['file_time']    = time.time()
+        f.attrs['creator']      = 'oasys-wofry'
+        f.attrs['HDF5_Version'] = h5py.version.hdf5_version
+        f.attrs['h5py_version'] = h5py.version.version
+    else:
+        f = h5py.File(filename, 'a')
+
+    return f
+
+def save_h5_wavefront(wavefront, filename, filepath="wfr", overwrite=True, intensity=True, compression=None, compression_level=4, chunks=None, single_precision=False):
+    with open_h5_file(filename, overwrite=overwrite) as f:
+        write_h5_wavefront(f, wavefront, filepath=filepath, intensity=intensity,
+                           compression=compression, compression_level=compression_level,
+                           chunks=chunks, single_precision=single_precision)
+
+# first free name in the sequence filepath_0000, filepath_0001, ...
+def get_next_frame_path(filename, filepath="wfr"):
+    if not os.path.isfile(filename): return filepath + "_0000"
+
+    with h5py.File(filename, 'r') as f:
+        index = 0
+        while "%s_%04d" % (filepath, index) in f: index += 1
+
+    return "%s_%04d" % (filepath, index)
+
+class WavefrontStackWriter(object):
+    """
+    Writes a series of wavefronts (e.g. a scan) as a stack in the group filepath: the complex amplitudes go in a
+    resizable (n_frames, ...) dataset with the scan values, photon energies and meshes as parallel datasets.
+    The file stays open between writes and the frames are written in batches of flush_every.
+    """
+    def __init__(self, filename, filepath="wfr", compression=None, compression_level=4, chunks=None, single_precision=False, flush_every=10):
+        super().__init__()
+
+        self.__filename = filename
+        self.__filepath = filepath
+        self.__compression = compression
+        self.__compression_level = compression_level
+        self.__chunks = chunks
+        self.__complex_type = numpy.complex64 if single_precision else numpy.complex128
+        self.__flush_every = max(1, int(flush_every))
+
+        self.__file = open_h5_file(filename, overwrite=False)
+        if filepath in self.__file: del self.__file[filepath]
+        self.__group = self.__file.create_group(filepath)
+
+        self.__buffer = []
+        self.__number_of_frames = 0
+
+    def get_filename(self):
+        return self.__filename
+
+    def get_filepath(self):
+        return self.__filepath
+
+    def get_number_of_frames(self):
+        return self.__number_of_frames + len(self.__buffer)
+
+    def is_open(self):
+        return not self.__file is None
+
+    def append(self, wavefront, scan_value=numpy.nan, variable_name=None):
+        if self.__file is None: raise Exception("Wavefront stack file %s is closed" % self.__filename)
+
+        if "wfr_dimension" in self.__group:
+            if int(wavefront.get_dimension()) != self.__group["wfr_dimension"][()] or \
+                    wavefront.get_complex_amplitude().shape != self.__group["wfr_complex_amplitude_s"].shape[1:][::-1]:
+                raise ValueError("Wavefront shape differs from the ones already in the stack")
+        elif len(self.__buffer) > 0:
+            if wavefront.get_complex_amplitude().shape != self.__buffer[0][0].get_complex_amplitude().shape:
+                raise ValueError("Wavefront shape differs from the ones already in the stack")
+
+        if not variable_name is None: self.__group.attrs["scan_variable_name"] = variable_name
+
+        self.__buffer.append((wavefront, scan_value))
+
+        if len(self.__buffer) >= self.__flush_every: self.flush()
+
+    def __create_datasets(self, wavefront):
+        dimension = int(wavefront.get_dimension())
+        shape = wavefront.get_complex_amplitude().shape[::-1] # 2D arrays are stored transposed
+
+        self.__group.attrs['NX_class'] = 'NXentry'
+        self.__group["wfr_dimension"] = dimension
+
+        if self.__chunks is None or self.__chunks is True:
+            chunks = (1,) + shape
+        else:
+            chunks = (1,) + tuple(self.__chunks[::-1])
+
+        options = get_dataset_options((1,) + shape, self.__compression, self.__compression_level, chunks)
+
+        self.__group.create_dataset("wfr_complex_amplitude_s", shape=(0,) + shape, maxshape=(None,) + shape, dtype=self.__complex_type, **options)
+        if wavefront.is_polarized():
+            self.__group.create_dataset("wfr_complex_amplitude_p", shape=(0,) + shape, maxshape=(None,) + shape, dtype=self.__complex_type, **options)
+
+        self.__group.create_dataset("scan_values", shape=(0,), maxshape=(None,), dtype=numpy.float64)
+        self.__group.create_dataset("wfr_photon_energy", shape=(0,), maxshape=(None,), dtype=numpy.float64)
+
+        for name in (["wfr_mesh"] if dimension == 1 else ["wfr_mesh_X", "wfr_mesh_Y"]):
+            self.__group.create_dataset(name, shape=(0, 3), maxshape=(None, 3), dtype=numpy.float64)
+
+    def flush(self):
+        if self.__file is None or len(self.__buffer) == 0: return
+
+        if not "wfr_dimension" in self.__group: self.__create_datasets(self.__buffer[0][0])
+
+        first = self.__number_of_frames
+        last  = first + len(self.__buffer)
+
+        for name in self.__group:
+            if isinstance(self.__group[name], h5py.Dataset) and name != "wfr_dimension":
+                self.__group[name].resize(last, axis=0)
+
+        dimension = self.__group["wfr_dimension"][()]
+
+        def transpose(data):
+            return data if dimension == 1 else data.T
+
+        complex_amplitudes = numpy.array([transpose(wavefront.get_complex_amplitude()) for wavefront, _ in self.__buffer])
+        self.__group["wfr_complex_amplitude_s"][first:last] = complex_amplitudes
+
+        if "wfr_complex_amplitude_p" in self.__group:
+            self.__group["wfr_complex_amplitude_p"][first:last] = \
+                numpy.array([transpose(wavefront.get_complex_amplitude(polarization=Polarization.PI)) for wavefront, _ in self.__buffer])
+
+        self.__group["scan_values"][first:last] = numpy.array([scan_value for _, scan_value in self.__buffer], dtype=numpy.float64)
+        self.__group["wfr_photon_energy"][first:last] = numpy.array([wavefront.get_photon_energy() for wavefront, _ in self.__buffer])
+
+        def mesh(coordinates):
+            return [coordinates[0], coordinates[-1], coordinates.size]
+
+        if dimension == 1:
+            self.__group["wfr_mesh"][first:last] = numpy.array([mesh(wavefront.get_abscissas()) for wavefront, _ in self.__buffer])
+        else:
+            self.__group["wfr_mesh_X"][first:last] = numpy.array([mesh(wavefront.get_coordinate_x()) for wavefront, _ in self.__buffer])
+            self.__group["wfr_mesh_Y"][first:last] = numpy.array([mesh(wavefront.get_coordinate_y()) for wavefront, _ in self.__buffer])
+
+        self.__number_of_frames = last
+        self.__buffer = []
+
+        self.__file.flush()
+
+    def close(self):
+        if self.__file is None: return
+
+        self.flush()
+        self.__file.close()
+        self.__file = None
+
+def load_h5_stack_wavefront(filename, filepath="wfr", index=0):
+    """
+    Loads the frame index of a stack written by WavefrontStackWriter, returns the wavefront and the scan value.
+    """
+    with h5py.File(filename, 'r') as f:
+        group = f[filepath]
+
+        complex_amplitude_s = group["wfr_complex_amplitude_s"][index].astype(numpy.complex128)
+        complex_amplitude_p = group["wfr_complex_amplitude_p"][index].astype(numpy.complex128) if "wfr_complex_amplitude_p" in group else None
+        photon_energy = group["wfr_photon_energy"][index]
+        scan_value = group["scan_values"][index]
+
+        if group["wfr_dimension"][()] == 1:
+            mesh = group["wfr_mesh"][index]
+            wavefront = GenericWavefront1D.initialize_wavefront_from_arrays(numpy.linspace(mesh[0], mesh[1], int(mesh[2])),
+                                                                          complex_amplitude_s,
+                                                                          complex_amplitude_p)
+        else:
+            mesh_X = group["wfr_mesh_X"][index]
+            mesh_Y = group["wfr_mesh_Y"][index]
+            wavefront = GenericWavefront2D.initialize_wavefront_from_arrays(x_array=numpy.linspace(mesh_X[0], mesh_X[1], int(mesh_X[2])),
+                                                                          y_array=numpy.linspace(mesh_Y[0], mesh_Y[1], int(mesh_Y[2])),
+                                                                          z_array=complex_amplitude_s.T,
+                                                                          z_array_pi=None if complex_amplitude_p is None else complex_amplitude_p.T)
+
+    wavefront.set_photon_energy(photon_energy)
+
+    return wavefront, scan_value
+
+class WOH5FileROILightSource(WOH5FileLightSource):
+    """
+    WOH5FileLightSource loading only a region of interest of the stored wavefront, with optional binning.
+    """
+    def __init__(self,
+                 name                = "Undefined",
+                 electron_beam       = None,
+                 magnetic_structure  = None,
+                 h5file              = "",
+                 filepath            = "wfr",
+                 x_roi               = None,
+                 y_roi               = None,
+                 binning_x           = 1,
+                 binning_y           = 1,
+                 ):
+        super().__init__(name=name, electron_beam=electron_beam, magnetic_structure=magnetic_structure, h5file=h5file, filepath=filepath)
+
+        self._x_roi = x_roi
+        self._y_roi = y_roi
+        self._binning_x = binning_x
+        self._binning_y = binning_y
+
+        parameters = self.get_source_wavefront_parameters()
+        parameters['x_roi'] = x_roi
+        parameters['y_roi'] = y_roi
+        parameters['binning_x'] = binning_x
+        parameters['binning_y'] = binning_y
+
+    def get_wavefront(self):
+        wf = load_h5_wavefront(self._h5file, filepath=self._filepath,
+                               x_roi=self._x_roi, y_roi=self._y_roi,
+                               binning_x=self._binning_x, binning_y=self._binning_y)
+
+        self.dimension = int(wf.get_dimension())
+        return wf
+
+    def to_python_code(self, do_plot=True, add_import_section=False):
+        txt = ""
+
+        txt += "#\n# create output_wavefront\n#"
+
+        txt += "\nfrom orangecontrib.wofry.util.wofry_h5file import load_h5_wavefront"
+        txt += "\noutput_wavefront = load_h5_wavefront('%s', filepath='%s', x_roi=%s, y_roi=%s, binning_x=%d, binning_y=%d)" % \
+               (self._h5file, self._filepath, repr(self._x_roi), repr(self._y_roi), self._binning_x, self._binning_y)
+
+        return txt
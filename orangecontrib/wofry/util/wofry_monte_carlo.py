@@ -0,0 +1,180 @@
+"""
+Monte-Carlo tolerance studies of WOFRY beamlines: the parameters (named as in wofry_batch, e.g. oe1.p, oe2.grazing_angle_in,
+oe1.propagator.magnification_x) are perturbed around their nominal values by random samples drawn from the given
+distributions with a fixed seed, the samples are propagated (in parallel by wofry_batch.run_cases) and the running mean
+and variance of the output intensity profile and of scalar figures of merit are updated as the results arrive.
+"""
+import csv, numpy
+
+from orangecontrib.wofry.util.wofry_batch import get_beamline_parameter, run_case, run_cases
+from orangecontrib.wofry.util.wofry_tolerance import get_sweep_statistics
+
+DISTRIBUTIONS = ["gaussian", "uniform"]
+
+def parse_perturbations(text):
+    """
+    Perturbations from a text like "oe1.p gaussian 0 0.01; oe1.q uniform -0.01 0.01" (separated by ";" or new lines):
+    parameter name, distribution, and mean and sigma ("gaussian") or minimum and maximum ("uniform") of the deviation
+    from the nominal value. Returns a list of (name, distribution, value_1, value_2).
+    """
+    perturbations = []
+
+    for line in text.replace(";", "\n").split("\n"):
+        line = line.split("#")[0].strip()
+        if line == "": continue
+
+        tokens = line.split()
+        if len(tokens) != 4: raise ValueError("Bad perturbation (name distribution value_1 value_2): " + line)
+        if not tokens[1] in DISTRIBUTIONS: raise ValueError("Bad distribution (%s): %s" % (", ".join(DISTRIBUTIONS), line))
+
+        perturbations.append((tokens[0], tokens[1], float(tokens[2]), float(tokens[3])))
+
+    return perturbations
+
+def sample_perturbations(beamline, perturbations, number_of_samples, seed=None):
+    """
+    Cases ({name: value}) of the samples: the nominal values read from the beamline plus the random deviations, drawn
+    parameter by parameter in the order of the perturbations (the same seed gives the same samples).
+    """
+    random_state = numpy.random.RandomState(seed)
+
+    values = {}
+    for name, distribution, value_1, value_2 in perturbations:
+        nominal = get_beamline_parameter(beamline, name)
+
+        if distribution == "gaussian": values[name] = nominal + random_state.normal(value_1, value_2, number_of_samples)
+        elif distribution == "uniform": values[name] = nominal + random_state.uniform(value_1, value_2, number_of_samples)
+        else: raise ValueError("Bad distribution: " + distribution)
+
+    return [{name: float(values[name][i]) for name in values.keys()} for i in range(number_of_samples)]
+
+class RunningStatistics(object):
+    """
+    Mean and variance of scalars or arrays added one at a time (Welford's algorithm).
+    """
+    def __init__(self):
+        self.__count = 0
+        self.__mean = None
+        self.__m2 = None
+
+    def add(self, values):
+        values = numpy.array(values, dtype=float)
+
+        self.__count += 1
+
+        if self.__mean is None:
+            self.__mean = values
+            self.__m2 = numpy.zeros_like(values)
+        else:
+            delta = values - self.__mean
+            self.__mean = self.__mean + delta / self.__count
+            self.__m2 = self.__m2 + delta * (values - self.__mean)
+
+    def get_count(self):
+        return self.__count
+
+    def get_mean(self):
+        return self.__mean
+
+    def get_variance(self):
+        if self.__count < 2: return None if self.__m2 is None else numpy.zeros_like(self.__m2)
+        else:                return self.__m2 / (self.__count - 1)
+
+    def get_standard_deviation(self):
+        variance = self.get_variance()
+
+        return None if variance is None else numpy.sqrt(variance)
+
+class MonteCarloStatistics(object):
+    """
+    Running statistics of the output intensity profile (on the abscissas of the nominal output) and of the figures
+    of merit of the samples.
+    """
+    def __init__(self, abscissas):
+        self.__abscissas = abscissas
+        self.__intensity = RunningStatistics()
+        self.__figures_of_merit = {}
+
+    def add(self, abscissas, intensity, figures_of_merit):
+        if abscissas.size != self.__abscissas.size or not numpy.allclose(abscissas, self.__abscissas):
+            intensity = numpy.interp(self.__abscissas, abscissas, intensity, left=0.0, right=0.0)
+
+        self.__intensity.add(intensity)
+
+        for name, value in figures_of_merit.items():
+            if not name in self.__figures_of_merit: self.__figures_of_merit[name] = RunningStatistics()
+            self.__figures_of_merit[name].add(value)
+
+    def get_number_of_samples(self):
+        return self.__intensity.get_count()
+
+    def get_abscissas(self):
+        return self.__abscissas
+
+    def get_intensity(self):
+        return self.__intensity
+
+    def get_figures_of_merit(self):
+        return self.__figures_of_merit
+
+    def get_summary(self):
+        text = "samples: %d\n" % self.get_number_of_samples()
+        for name, statistics in self.__figures_of_merit.items():
+            text += "%-12s mean: %12.6g   std: %12.6g\n" % (name, statistics.get_mean(), statistics.get_standard_deviation())
+
+        return text
+
+def get_figures_of_merit(wavefront, reference_peak_intensity, input_integrated_intensity=None):
+    """
+    Strehl ratio (peak intensity relative to the nominal output), FWHM, centroid and transmission of the wavefront.
+    """
+    statistics = get_sweep_statistics(wavefront.get_abscissas(),
+                                      numpy.array([wavefront.get_complex_amplitude()]),
+                                      reference_peak_intensity,
+                                      input_integrated_intensity)
+
+    return {name: float(values[0]) for name, values in statistics.items()}
+
+def run_monte_carlo(beamline, samples, input_wavefront=None, workers=1, use_propagator_cache=True):
+    """
+    Propagates the nominal beamline and the samples (cases of sample_perturbations), yielding for each sample, as it
+    is completed, (sample index, figures of merit or exception, MonteCarloStatistics updated with the sample).
+    """
+    nominal_wavefront = run_case(beamline, {}, input_wavefront=input_wavefront)
+
+    reference_peak_intensity = nominal_wavefront.get_intensity().max()
+    if input_wavefront is None: input_integrated_intensity = None
+    else:                       input_integrated_intensity = input_wavefront.get_intensity().sum() * input_wavefront.delta()
+
+    statistics = MonteCarloStatistics(nominal_wavefront.get_abscissas())
+
+    for index, output_wavefront in run_cases(beamline, samples, workers=workers, use_propagator_cache=use_propagator_cache,
+                                             input_wavefront=input_wavefront):
+        if isinstance(output_wavefront, Exception):
+            yield index, output_wavefront, statistics
+        else:
+            figures_of_merit = get_figures_of_merit(output_wavefront, reference_peak_intensity, input_integrated_intensity)
+
+            statistics.add(output_wavefront.get_abscissas(), output_wavefront.get_intensity(), figures_of_merit)
+
+            yield index, figures_of_merit, statistics
+
+def save_monte_carlo_results(file_name, samples, figures_of_merit):
+    """
+    Writes a CSV file with the parameters and the figures of merit (a list, None for the failed samples) of the samples.
+    """
+    parameter_names = list(samples[0].keys()) if len(samples) > 0 else []
+    figure_names = []
+    for values in figures_of_merit:
+        if not values is None:
+            figure_names = list(values.keys())
+            break
+
+    with open(file_name, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["sample"] + parameter_names + figure_names)
+
+        for index, (sample, values) in enumerate(zip(samples, figures_of_merit)):
+            writer.writerow([index] +
+                            ["%.10g" % sample[name] for name in parameter_names] +
+                            ["%.10g" % values[name] if not values is None else "nan" for name in figure_names])
@@ -1,33 +1,255 @@
+import numpy
+
 from wofryimpl.beamline.beamline import WOBeamline
 from wofry.propagator.wavefront import Wavefront
+from wofry.propagator.wavefront1D.generic_wavefront import GenericWavefront1D
+from wofry.propagator.wavefront2D.generic_wavefront import GenericWavefront2D
 
 class WofryData(object):
-    def __init__(self, beamline=None, wavefront=None):
+    """
+    Data exchanged between Wofry widgets.
+
+    Wavefront and beamline are shared by reference (copy-on-write): get_wavefront() and get_beamline()
+    return read-only instances, while get_writable_wavefront() and get_writable_beamline() make a private
+    copy on the first call and return it afterwards.
+
+    The optional mode stack carries a set of coherent modes propagated together with the wavefront (that is
+    the first mode of the stack). If only the mode stack is given, the wavefront is calculated from it on request.
+    Writing or replacing the wavefront drops the mode stack, which would not match it anymore.
+    """
+    def __init__(self, beamline=None, wavefront=None, mode_stack=None):
         super().__init__()
         if beamline is None:
             self.__beamline = WOBeamline()
         else:
             self.__beamline = beamline
 
-        if wavefront is None:
+        if wavefront is None and mode_stack is None:
             self.__wavefront = Wavefront()
         else:
             self.__wavefront = wavefront
 
+        self.__mode_stack = mode_stack
+
+        self.__owns_beamline  = False
+        self.__owns_wavefront = False
+
     def get_beamline(self):
         return self.__beamline
 
     def get_wavefront(self):
+        if self.__wavefront is None: self.__wavefront = self.__mode_stack.get_mode_wavefront(0)
+
+        return self.__wavefront
+
+    def get_mode_stack(self):
+        return self.__mode_stack
+
+    def get_writable_beamline(self):
+        if not self.__owns_beamline:
+            self.__beamline = self.__beamline.duplicate()
+            self.__owns_beamline = True
+
+        return self.__beamline
+
+    def get_writable_wavefront(self):
+        if not self.__owns_wavefront:
+            self.__wavefront = self.get_wavefront().duplicate()
+            self.__owns_wavefront = True
+
+        self.__mode_stack = None
+
         return self.__wavefront
 
     def set_beamline(self, beamline):
-        self.__beamline = beamline.duplicate()
+        self.__beamline = beamline
+        self.__owns_beamline = False
 
     def set_wavefront(self, wavefront):
-        self.__wavefront = wavefront.duplicate()
+        self.__wavefront = wavefront
+        self.__owns_wavefront = False
+        self.__mode_stack = None
+
+    def set_mode_stack(self, mode_stack):
+        self.__mode_stack = mode_stack
 
     def duplicate(self):
-        return WofryData(wavefront=self.get_wavefront().duplicate(),
-                         beamline=self.get_beamline().duplicate())
+        # from now on the buffers are shared with the copy: both have to copy them before writing
+        self.__owns_beamline  = False
+        self.__owns_wavefront = False
+
+        return WofryData(wavefront=self.__wavefront,
+                         beamline=self.get_beamline(),
+                         mode_stack=self.get_mode_stack())
+
+class WofryModeStack(object):
+    """
+    Coherent modes of a 1D wavefront on the same abscissas: the rows of a (n_modes, n_points) array of complex
+    amplitudes (already weighted by the square root of the eigenvalues). Never modified in place.
+    """
+    def __init__(self, abscissas, complex_amplitudes, wavelength=1e-10, mode_indices=None):
+        super().__init__()
+        self.__abscissas = abscissas
+        self.__complex_amplitudes = numpy.atleast_2d(complex_amplitudes)
+        self.__wavelength = wavelength
+
+        if mode_indices is None:
+            self.__mode_indices = numpy.arange(self.__complex_amplitudes.shape[0])
+        else:
+            self.__mode_indices = numpy.array(mode_indices)
+
+    @classmethod
+    def initialize_from_wavefronts(cls, wavefronts, mode_indices=None):
+        return WofryModeStack(abscissas=wavefronts[0].get_abscissas(),
+                              complex_amplitudes=numpy.array([wavefront.get_complex_amplitude() for wavefront in wavefronts]),
+                              wavelength=wavefronts[0].get_wavelength(),
+                              mode_indices=mode_indices)
+
+    def get_abscissas(self):
+        return self.__abscissas
+
+    def get_complex_amplitudes(self):
+        return self.__complex_amplitudes
+
+    def get_wavelength(self):
+        return self.__wavelength
+
+    def get_mode_indices(self):
+        return self.__mode_indices
+
+    def get_number_of_modes(self):
+        return self.__complex_amplitudes.shape[0]
+
+    def get_mode_wavefront(self, index):
+        return GenericWavefront1D.initialize_wavefront_from_arrays(self.__abscissas,
+                                                                   self.__complex_amplitudes[index].copy(),
+                                                                   wavelength=self.__wavelength)
+
+    # incoherent sum of the modes intensities
+    def get_intensity(self):
+        return numpy.sum(numpy.abs(self.__complex_amplitudes)**2, axis=0)
+
+
+class WofryModeStack2D(object):
+    """
+    Separable coherent modes of a 2D wavefront: the mode i is the outer product of the row orders_x[i] of the
+    (n_x, n_points_x) array of x factors and of the row orders_y[i] of the (n_y, n_points_y) array of y factors (both
+    already weighted by the square root of their eigenvalues). Only the 1D factors are stored, the 2D complex amplitude
+    of a mode is calculated when requested. Never modified in place.
+    """
+    def __init__(self, coordinate_x, coordinate_y, factors_x, factors_y, orders_x, orders_y, wavelength=1e-10, mode_indices=None):
+        super().__init__()
+        self.__coordinate_x = coordinate_x
+        self.__coordinate_y = coordinate_y
+        self.__factors_x = numpy.atleast_2d(factors_x)
+        self.__factors_y = numpy.atleast_2d(factors_y)
+        self.__orders_x = numpy.array(orders_x, dtype=int)
+        self.__orders_y = numpy.array(orders_y, dtype=int)
+        self.__wavelength = wavelength
+
+        if mode_indices is None:
+            self.__mode_indices = numpy.arange(self.__orders_x.size)
+        else:
+            self.__mode_indices = numpy.array(mode_indices)
+
+    @classmethod
+    def initialize_from_wavefront(cls, wavefront, tolerance=1e-8, block_size=2**20):
+        """
+        Single mode stack of a separable (rank 1) GenericWavefront2D: the factors are the column and the row crossing
+        at the maximum of the amplitude. Returns None if the wavefront is polarized or if the outer product of the
+        factors differs from the complex amplitude more than tolerance (relative to the maximum).
+        The complex amplitude is scanned by blocks of about block_size points (no temporary of its size), and a few
+        rows and columns are checked first, so that non separable wavefronts are rejected quickly.
+        """
+        if wavefront.is_polarized(): return None
+
+        complex_amplitude = wavefront.get_complex_amplitude()
+        n_x, n_y = complex_amplitude.shape
+        rows_per_block = max(1, block_size // n_y)
+
+        i, j, maximum = 0, 0, 0.0
+        for first in range(0, n_x, rows_per_block):
+            amplitude = numpy.abs(complex_amplitude[first:first + rows_per_block])
+            k, l = numpy.unravel_index(numpy.argmax(amplitude), amplitude.shape)
+            if amplitude[k, l] > maximum: i, j, maximum = first + k, l, amplitude[k, l]
+
+        if maximum == 0.0: return None
+
+        factor_x = complex_amplitude[:, j].copy()
+        factor_y = complex_amplitude[i, :] / complex_amplitude[i, j]
+
+        threshold = tolerance * maximum
+
+        rows    = numpy.unique(numpy.linspace(0, n_x - 1, 9).astype(int))
+        columns = numpy.unique(numpy.linspace(0, n_y - 1, 9).astype(int))
+
+        if numpy.abs(complex_amplitude[rows, :] - numpy.outer(factor_x[rows], factor_y)).max() > threshold: return None
+        if numpy.abs(complex_amplitude[:, columns] - numpy.outer(factor_x, factor_y[columns])).max() > threshold: return None
+
+        for first in range(0, n_x, rows_per_block):
+            last = min(first + rows_per_block, n_x)
+            if numpy.abs(complex_amplitude[first:last] - numpy.outer(factor_x[first:last], factor_y)).max() > threshold: return None
+
+        return WofryModeStack2D(wavefront.get_coordinate_x(), wavefront.get_coordinate_y(), factor_x, factor_y,
+                                [0], [0], wavelength=wavefront.get_wavelength())
+
+    def get_coordinate_x(self):
+        return self.__coordinate_x
+
+    def get_coordinate_y(self):
+        return self.__coordinate_y
+
+    def get_factors_x(self):
+        return self.__factors_x
+
+    def get_factors_y(self):
+        return self.__factors_y
+
+    def get_orders_x(self):
+        return self.__orders_x
+
+    def get_orders_y(self):
+        return self.__orders_y
+
+    def get_wavelength(self):
+        return self.__wavelength
+
+    def get_mode_indices(self):
+        return self.__mode_indices
+
+    def get_number_of_modes(self):
+        return self.__orders_x.size
+
+    # the x and y factors as 1D stacks (e.g. to propagate them separately)
+    def get_mode_stack_x(self):
+        return WofryModeStack(self.__coordinate_x, self.__factors_x, wavelength=self.__wavelength)
+
+    def get_mode_stack_y(self):
+        return WofryModeStack(self.__coordinate_y, self.__factors_y, wavelength=self.__wavelength)
+
+    def get_sub_stack(self, first_index, last_index):
+        """
+        Modes from first_index to last_index (excluded), sharing the factors with this stack.
+        """
+        return WofryModeStack2D(self.__coordinate_x, self.__coordinate_y, self.__factors_x, self.__factors_y,
+                                self.__orders_x[first_index:last_index], self.__orders_y[first_index:last_index],
+                                wavelength=self.__wavelength, mode_indices=self.__mode_indices[first_index:last_index])
+
+    def get_mode_factors(self, index):
+        return self.__factors_x[self.__orders_x[index]], self.__factors_y[self.__orders_y[index]]
+
+    def get_mode_complex_amplitude(self, index):
+        return numpy.outer(*self.get_mode_factors(index))
+
+    def get_mode_wavefront(self, index):
+        return GenericWavefront2D.initialize_wavefront_from_arrays(self.__coordinate_x,
+                                                                   self.__coordinate_y,
+                                                                   self.get_mode_complex_amplitude(index),
+                                                                   wavelength=self.__wavelength)
 
+    # incoherent sum of the modes intensities, without calculating the 2D modes
+    def get_intensity(self):
+        occupation = numpy.zeros((self.__factors_x.shape[0], self.__factors_y.shape[0]))
+        numpy.add.at(occupation, (self.__orders_x, self.__orders_y), 1.0)
 
+        return numpy.abs(self.__factors_x.T)**2 @ occupation @ numpy.abs(self.__factors_y)**2
@@ -0,0 +1,310 @@
+import os, numpy
+from collections import OrderedDict
+from scipy import interpolate
+
+from wofryimpl.beamline.optical_elements.mirrors.mirror import WOMirror1D
+from wofryimpl.beamline.optical_elements.refractors.lens import WOLens1D
+from wofryimpl.beamline.optical_elements.refractors.thin_object import WOThinObject1D
+from wofryimpl.beamline.optical_elements.util.s4_conic import S4Conic
+
+#
+# 1D profiles (e.g. from DABAM): (n_points, 2) arrays of abscissas and heights [m], kept in memory and optionally
+# written to binary .npy files (text files are still read, as by the wofryimpl elements).
+#
+
+def save_profile(file_name, profile):
+    directory = os.path.dirname(file_name)
+    if directory != "" and not os.path.isdir(directory): os.makedirs(directory)
+
+    numpy.save(file_name, numpy.asarray(profile, dtype=float))
+
+def load_profile(file_name):
+    if file_name.endswith(".npy"): return numpy.load(file_name)
+    else:                          return numpy.loadtxt(file_name)
+
+def get_in_memory_profile_name(widget):
+    return "dabam_profile_" + str(id(widget)) + " (in memory)"
+
+# the profiles kept in memory are lost when the workspace is closed, their label is still in the settings
+def check_in_memory_profile_name(file_name):
+    if file_name.endswith(" (in memory)"):
+        raise ValueError("The DABAM profile kept in memory (%s) is no longer available: re-send the DABAM profile, or save it to file" % file_name)
+
+class ProfileCache(object):
+    """
+    LRU cache of the profiles read from files (or received as arrays), resampled, and of their interpolators, keyed on
+    the source (file path and modification time, or array) and on the resampling parameters.
+    """
+    def __init__(self, max_entries=16):
+        self.__entries = OrderedDict()
+        self.__max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, builder, reference=None):
+        # reference: the array the key was built from (its id is in the key), to avoid reusing a recycled id
+        if key in self.__entries and self.__entries[key][0] is reference:
+            self.__entries.move_to_end(key)
+            self.hits += 1
+
+            return self.__entries[key][1]
+
+        self.misses += 1
+        value = builder()
+
+        self.__entries[key] = (reference, value)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__max_entries: self.__entries.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        self.__entries.clear()
+
+    def get_number_of_entries(self):
+        return len(self.__entries)
+
+def _resample_profile(profile, oversampling_factor):
+    x = profile[:, 0].copy()
+    y = profile[:, 1].copy()
+
+    if oversampling_factor != 1:
+        xnew = numpy.linspace(x[0], x[-1], int(x.size * oversampling_factor))
+        y = numpy.interp(xnew, x, y)
+        x = xnew
+
+    # shared by the elements using the cache: not to be modified
+    x.flags.writeable = False
+    y.flags.writeable = False
+
+    return x, y
+
+class _ProfileElement(object):
+    """
+    Mixin for the wofryimpl elements reading a 1D profile from a file: the profile can be given as an array, which is
+    used instead of reading the file, and .npy files are accepted. With a ProfileCache, the profile and the quantities
+    derived from it only (resampling, interpolators) are shared between the elements created during scans.
+    """
+    _profile = None
+    _loaded_profile = None
+    _profile_cache = None
+
+    def set_profile(self, profile):
+        self._profile = None if profile is None else numpy.asarray(profile, dtype=float)
+
+    def set_profile_cache(self, profile_cache):
+        self._profile_cache = profile_cache
+
+    def _get_profile_file_name(self):
+        raise NotImplementedError()
+
+    def get_profile(self):
+        if not self._profile is None: return self._profile
+
+        if self._loaded_profile is None:
+            self._loaded_profile = self._get_cached("profile", (), lambda: load_profile(self._get_profile_file_name()))
+
+        return self._loaded_profile
+
+    def _get_cached(self, name, parameters, builder):
+        if self._profile_cache is None: return builder()
+
+        if self._profile is None:
+            file_name = os.path.abspath(self._get_profile_file_name())
+            key = ("file", file_name, os.path.getmtime(file_name), name) + tuple(parameters)
+        else:
+            key = ("array", id(self._profile), name) + tuple(parameters)
+
+        return self._profile_cache.get(key, builder, reference=self._profile)
+
+    # the generated scripts use these classes, to read .npy files
+    def _replace_class_in_python_code(self, txt, base_class, module_name):
+        txt = txt.replace("from " + module_name + " import " + base_class.__name__,
+                          "from orangecontrib.wofry.util.wofry_profiles import " + self.__class__.__name__)
+        txt = txt.replace("optical_element = " + base_class.__name__ + "(",
+                          "optical_element = " + self.__class__.__name__ + "(")
+        txt = txt.replace("optical_element = " + base_class.__name__ + ".create_from_keywords(",
+                          "optical_element = " + self.__class__.__name__ + ".create_from_keywords(")
+
+        file_name = self._get_profile_file_name()
+        if not os.path.isfile(file_name):
+            txt = "\n# WARNING: the profile %s was received in memory: save it to a file to run this script" % file_name + txt
+
+        return txt
+
+class WOMirror1DWithProfile(_ProfileElement, WOMirror1D):
+
+    @classmethod
+    def create_from_keywords(cls, profile=None, profile_cache=None, **keywords):
+        out = cls(keywords_at_creation=WOMirror1D.create_from_keywords(**keywords)._keywords_at_creation)
+        out.set_profile(profile)
+        out.set_profile_cache(profile_cache)
+
+        return out
+
+    def _get_profile_file_name(self):
+        return self._keywords_at_creation["error_file"]
+
+    def get_height_profile(self, input_wavefront):
+        if self._keywords_at_creation["error_flag"] == 0: return super().get_height_profile(input_wavefront)
+
+        shape                          = self._keywords_at_creation["shape"]
+        p_focus                        = self._keywords_at_creation["p_focus"]
+        q_focus                        = self._keywords_at_creation["q_focus"]
+        grazing_angle_in               = self._keywords_at_creation["grazing_angle_in"]
+        error_file_oversampling_factor = self._keywords_at_creation["error_file_oversampling_factor"]
+
+        # only the shape depends on the geometry
+        x2_oe, y2_oe = self._get_cached("resampled", (error_file_oversampling_factor,),
+                                        lambda: _resample_profile(self.get_profile(), error_file_oversampling_factor))
+
+        if shape == 0:
+            pass
+        elif shape == 1:
+            y2_oe = y2_oe + S4Conic.initialize_as_sphere_from_focal_distances(p_focus, q_focus, grazing_angle_in).height(x2_oe)
+        elif shape == 2:
+            y2_oe = y2_oe + S4Conic.initialize_as_ellipsoid_from_focal_distances(p_focus, q_focus, grazing_angle_in).height(x2_oe)
+        elif shape == 3:
+            y2_oe = y2_oe + S4Conic.initialize_as_paraboloid_from_focal_distances(p_focus, q_focus, grazing_angle_in).height(x2_oe)
+        else:
+            raise Exception("Wrong shape")
+
+        return x2_oe, y2_oe
+
+    def to_python_code(self, do_plot=False):
+        txt = super().to_python_code(do_plot=do_plot)
+
+        if self._keywords_at_creation["error_flag"] == 0: return txt
+        else: return self._replace_class_in_python_code(txt, WOMirror1D, "wofryimpl.beamline.optical_elements.mirrors.mirror")
+
+class WOLens1DWithProfile(_ProfileElement, WOLens1D):
+
+    @classmethod
+    def create_from_keywords(cls, profile=None, profile_cache=None, **keywords):
+        lens = WOLens1D.create_from_keywords(**keywords)
+
+        out = cls(name=lens.get_name(), material=lens.get_material(), thickness=lens.get_thickness(),
+                  keywords_at_creation=lens._keywords_at_creation)
+        out.set_profile(profile)
+        out.set_profile_cache(profile_cache)
+
+        return out
+
+    def _get_profile_file_name(self):
+        return self._keywords_at_creation["error_file"]
+
+    def get_surface_thickness_mesh(self, input_wavefront):
+        keywords = self._keywords_at_creation
+
+        if keywords["error_flag"] == 0: return super().get_surface_thickness_mesh(input_wavefront)
+
+        # thickness without errors from the base class, the profile is added here
+        self._keywords_at_creation = dict(keywords, error_flag=0, write_profile_flag=0)
+        try:
+            abscissas_on_lens, lens_thickness = super().get_surface_thickness_mesh(input_wavefront)
+        finally:
+            self._keywords_at_creation = keywords
+
+        lens_thickness += self.get_error_thickness(abscissas_on_lens)
+
+        if keywords["write_profile_flag"]:
+            numpy.savetxt(keywords["write_profile"], numpy.column_stack((abscissas_on_lens, lens_thickness)), fmt="%g")
+            print("File %s written to disk." % keywords["write_profile"])
+
+        return abscissas_on_lens, lens_thickness
+
+    # thickness added by the error profile, interpolated on the abscissas
+    def get_error_thickness(self, abscissas):
+        error_edge_management = self._keywords_at_creation["error_edge_management"]
+
+        finterpolate = self._get_cached("interpolator", (error_edge_management,),
+                                        lambda: self._get_interpolator(error_edge_management))
+
+        return finterpolate(abscissas)
+
+    def _get_interpolator(self, error_edge_management):
+        profile = self.get_profile()
+
+        if error_edge_management == 0:
+            return interpolate.interp1d(profile[:, 0], profile[:, 1], fill_value="extrapolate")
+        elif error_edge_management == 1:
+            return interpolate.interp1d(profile[:, 0], profile[:, 1], fill_value=(0, 0), bounds_error=False)
+        else:
+            raise Exception("Bad value of error_edge_management")
+
+    # as in the base class, with the profile from get_profile()
+    def applyOpticalElement(self, input_wavefront, parameters=None, element_index=None):
+        keywords = self._keywords_at_creation
+
+        if keywords["error_flag"] == 0: return super().applyOpticalElement(input_wavefront, parameters, element_index)
+
+        refraction_index_delta, att_coefficient = self.get_refraction_index(input_wavefront.get_photon_energy())
+
+        if keywords["verbose"] and keywords["number_of_curved_surfaces"] > 0:
+            print("\n\n\n ==========  parameters in use : ")
+            print("\n\nRadius of curvature R = %g um" % (1e6 * keywords["radius"]))
+            print("Number of lenses N: %d" % keywords["n_lenses"])
+            print("Number of curved refractive surfaces in a lens Nd = %d" % (keywords["number_of_curved_surfaces"]))
+            print("Focal distance F = R / (Nd N delta) = %g m" % (keywords["radius"] / (keywords["number_of_curved_surfaces"] * keywords["n_lenses"] * refraction_index_delta)))
+
+        output_wavefront = input_wavefront.duplicate()
+        abscissas_on_lens, lens_thickness = self.get_surface_thickness_mesh(input_wavefront=input_wavefront)
+
+        output_wavefront.rescale_amplitudes(numpy.exp(-1.0 * att_coefficient * lens_thickness / 2)) # factor of 2 because it is amplitude
+        output_wavefront.add_phase_shifts(-1.0 * output_wavefront.get_wavenumber() * refraction_index_delta * lens_thickness)
+
+        profile = self.get_profile()
+        profile_limits_projected = profile[-1, 0] - profile[0, 0]
+        wavefront_dimension = output_wavefront.get_abscissas()[-1] - output_wavefront.get_abscissas()[0]
+
+        if keywords["verbose"]:
+            print("profile deformation dimension: %f um" % (1e6 * profile_limits_projected))
+            print("wavefront window dimension: %f um" % (1e6 * wavefront_dimension))
+
+        if wavefront_dimension <= profile_limits_projected:
+            if keywords["verbose"]: print("Wavefront window inside error profile domain: no action needed")
+        else:
+            if keywords["error_edge_management"] == 0:
+                if keywords["verbose"]: print("Profile deformation extrapolated to fit wavefront dimensions")
+            else:
+                output_wavefront.clip(profile[0, 0], profile[-1, 0])
+                if keywords["verbose"]: print("Wavefront clipped to limits of deformation profile")
+
+        return output_wavefront
+
+    def to_python_code(self):
+        txt = super().to_python_code()
+
+        if self._keywords_at_creation["error_flag"] == 0: return txt
+        else: return self._replace_class_in_python_code(txt, WOLens1D, "wofryimpl.beamline.optical_elements.refractors.lens")
+
+class WOThinObject1DWithProfile(_ProfileElement, WOThinObject1D):
+
+    def __init__(self, profile=None, profile_cache=None, **keywords):
+        super().__init__(**keywords)
+
+        self.set_profile(profile)
+        self.set_profile_cache(profile_cache)
+
+    def _get_profile_file_name(self):
+        return self.get_file_with_thickness_mesh()
+
+    def get_surface_thickness_mesh(self, wavefront):
+        xx, zz = self._get_cached("thickness", (), self._get_thickness_profile)
+
+        x = wavefront.get_abscissas()
+
+        return x, numpy.interp(x, xx, zz)
+
+    def _get_thickness_profile(self):
+        profile = self.get_profile()
+
+        xx = profile[:, 0]
+        zz = profile[:, 1]
+        if zz.min() < 0: zz = zz - zz.min()
+
+        return xx, zz
+
+    def to_python_code(self, data=None):
+        return self._replace_class_in_python_code(super().to_python_code(data=data), WOThinObject1D,
+                                                  "wofryimpl.beamline.optical_elements.refractors.thin_object")
@@ -0,0 +1,524 @@
+import os, numpy
+from collections import OrderedDict
+
+from srxraylib.util.data_structures import ScaledArray
+
+from wofry.propagator.wavefront1D.generic_wavefront import GenericWavefront1D
+from wofry.propagator.wavefront2D.generic_wavefront import GenericWavefront2D
+from wofry.propagator.propagator import PropagationManager, PropagationParameters
+from wofryimpl.propagator.propagators1D.fresnel import Fresnel1D
+from wofryimpl.propagator.propagators1D.fresnel_zoom import FresnelZoom1D
+from wofryimpl.propagator.propagators2D.fresnel import Fresnel2D
+from wofryimpl.propagator.propagators2D.fresnel_zoom_xy import FresnelZoomXY2D
+from wofryimpl.beamline.optical_elements.ideal_elements.screen import WOScreen
+from wofryimpl.beamline.optical_elements.ideal_elements.ideal_lens import WOIdealLens
+from wofryimpl.beamline.optical_elements.absorbers.slit import WOSlit, WOGaussianSlit
+from syned.beamline.shape import Rectangle
+
+from orangecontrib.wofry.util.wofry_objects import WofryModeStack, WofryModeStack2D
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft as pyfftw_fft
+    pyfftw.interfaces.cache.enable() # keeps the FFTW plans of the last transforms
+except ImportError:
+    pyfftw_fft = None
+
+FFT_BACKENDS = ["numpy", "scipy", "pyfftw"]
+
+def is_fft_backend_available(fft_backend):
+    if fft_backend == "numpy":    return True
+    elif fft_backend == "scipy":  return not scipy_fft is None
+    elif fft_backend == "pyfftw": return not pyfftw_fft is None
+    else: return False
+
+def get_fft2_functions(fft_backend="numpy", fft_workers=-1):
+    """
+    Returns the (fft2, ifft2) functions of the given backend, using fft_workers threads (negative values count
+    back from the number of cores, -1 = all cores). Falls back to numpy if the backend is not installed (the widgets
+    warn when the settings are checked).
+    """
+    if not is_fft_backend_available(fft_backend): fft_backend = "numpy"
+
+    if fft_backend == "scipy":
+        return (lambda array: scipy_fft.fft2(array, workers=fft_workers),
+                lambda array: scipy_fft.ifft2(array, workers=fft_workers))
+    elif fft_backend == "pyfftw":
+        threads = fft_workers if fft_workers > 0 else max(1, os.cpu_count() + 1 + fft_workers)
+
+        return (lambda array: pyfftw_fft.fft2(array, threads=threads),
+                lambda array: pyfftw_fft.ifft2(array, threads=threads))
+    else:
+        return numpy.fft.fft2, numpy.fft.ifft2
+
+def get_fft_functions(fft_backend="numpy", fft_workers=-1):
+    """
+    As get_fft2_functions, for the 1D (fft, ifft) along the last axis (stacks of factors or modes).
+    """
+    if not is_fft_backend_available(fft_backend): fft_backend = "numpy"
+
+    if fft_backend == "scipy":
+        return (lambda array: scipy_fft.fft(array, axis=-1, workers=fft_workers),
+                lambda array: scipy_fft.ifft(array, axis=-1, workers=fft_workers))
+    elif fft_backend == "pyfftw":
+        threads = fft_workers if fft_workers > 0 else max(1, os.cpu_count() + 1 + fft_workers)
+
+        return (lambda array: pyfftw_fft.fft(array, axis=-1, threads=threads),
+                lambda array: pyfftw_fft.ifft(array, axis=-1, threads=threads))
+    else:
+        return (lambda array: numpy.fft.fft(array, axis=-1),
+                lambda array: numpy.fft.ifft(array, axis=-1))
+
+def set_local_propagators_in_python_code(text_code):
+    """
+    Script of a beamline (WOBeamline.to_python_code) propagating with CachedFresnel2D and CachedFresnelZoomXY2D instead
+    of the wofryimpl propagators, which ignore the FFT backend given by the additional parameters. Only the
+    propagations with an FFT backend (set when it is not numpy) are changed: otherwise the script is left as it is, to
+    run with wofry and wofryimpl only.
+    """
+    propagators = []
+
+    for propagator_class in (CachedFresnel2D, CachedFresnelZoomXY2D):
+        propagation_code = "output_wavefront = propagator.do_propagation(propagation_parameters=propagation_parameters," + \
+                           "    handler_name='%s')" % propagator_class.HANDLER_NAME
+        local_propagation_code = "output_wavefront = %s().do_propagation(parameters=propagation_parameters)" % propagator_class.__name__
+
+        position = text_code.find(propagation_code)
+        while position >= 0:
+            # the parameters of this propagation are set after the last PropagationParameters
+            parameters_code = text_code[text_code.rfind("PropagationParameters(", 0, position):position]
+
+            if "set_additional_parameters('fft_backend'" in parameters_code:
+                text_code = text_code[:position] + local_propagation_code + text_code[position + len(propagation_code):]
+                if not propagator_class.__name__ in propagators: propagators.append(propagator_class.__name__)
+
+            position = text_code.find(propagation_code, position + 1)
+
+    # the values are written with str()
+    for fft_backend in FFT_BACKENDS:
+        text_code = text_code.replace("set_additional_parameters('fft_backend', %s)" % fft_backend,
+                                      "set_additional_parameters('fft_backend', %s)" % repr(fft_backend))
+
+    if len(propagators) > 0:
+        import_code = "from wofry.propagator.propagator import PropagationManager, PropagationElements, PropagationParameters"
+        text_code = text_code.replace(import_code, import_code + "\nfrom orangecontrib.wofry.util.wofry_propagators import " + ", ".join(propagators), 1)
+
+    return text_code
+
+class PropagatorCache(object):
+    """
+    LRU cache of the distance-dependent kernels (transfer functions and chirps) of the Fresnel propagators,
+    limited by the total size of the stored arrays (in MB).
+    """
+    def __init__(self, size_limit=256.0):
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.set_size_limit(size_limit)
+
+    def set_size_limit(self, size_limit):
+        self.__size_limit = int(size_limit * 2**20)
+        self.__evict()
+
+    def get_size(self):
+        return self.__size / 2**20
+
+    def get_kernels(self, key, builder):
+        if key in self.__entries:
+            self.__entries.move_to_end(key)
+            self.hits += 1
+
+            return self.__entries[key]
+
+        self.misses += 1
+        kernels = builder()
+        size = sum([kernel.nbytes for kernel in kernels])
+
+        if size <= self.__size_limit:
+            self.__entries[key] = kernels
+            self.__size += size
+            self.__evict()
+
+        return kernels
+
+    def clear(self):
+        self.__entries.clear()
+        self.__size = 0
+
+    @classmethod
+    def get_kernels_from(cls, cache, key, builder):
+        return builder() if cache is None else cache.get_kernels(key, builder)
+
+    def __evict(self):
+        while self.__size > self.__size_limit and len(self.__entries) > 0:
+            _, kernels = self.__entries.popitem(last=False)
+            self.__size -= sum([kernel.nbytes for kernel in kernels])
+
+#
+# The following propagators give the same results of the wofryimpl ones (and share their handler names, so the
+# generated scripts are unchanged), but take the kernels from a PropagatorCache (if given): repeated propagations on
+# an unchanged grid (e.g. scans of the optical element parameters) skip the kernels construction.
+# The 2D ones run the FFTs with the backend given by the additional parameters "fft_backend" and "fft_workers".
+#
+
+class CachedFresnel1D(Fresnel1D):
+    def __init__(self, cache=None):
+        super().__init__()
+        self._cache = cache
+
+    def do_specific_progation(self, wavefront, propagation_distance, parameters=None, element_index=None):
+        _, ifft = self.propagate_complex_amplitudes(wavefront.get_abscissas(), wavefront.get_complex_amplitude(),
+                                                    wavefront.get_wavelength(), propagation_distance, parameters, element_index)
+
+        return GenericWavefront1D(wavefront.get_wavelength(), ScaledArray.initialize_from_steps(ifft, wavefront.offset(), wavefront.delta()))
+
+    # complex_amplitudes can be a (n_modes, n_points) stack: the FFTs run along the last axis
+    def propagate_complex_amplitudes(self, abscissas, complex_amplitudes, wavelength, propagation_distance, parameters=None, element_index=None):
+        size = abscissas.size
+        delta = abscissas[1] - abscissas[0]
+
+        def build_kernels():
+            fft_scale = numpy.fft.fftfreq(size) / delta
+
+            return (numpy.exp((-1.0j) * numpy.pi * wavelength * propagation_distance * fft_scale**2),)
+
+        key = (self.HANDLER_NAME, size, delta, wavelength, propagation_distance)
+
+        transfer_function, = PropagatorCache.get_kernels_from(self._cache, key, build_kernels)
+
+        return abscissas, numpy.fft.ifft(numpy.fft.fft(complex_amplitudes, axis=-1) * transfer_function, axis=-1)
+
+class CachedFresnelZoom1D(FresnelZoom1D):
+    def __init__(self, cache=None):
+        super().__init__()
+        self._cache = cache
+
+    def do_specific_progation(self, wavefront, propagation_distance, parameters, element_index=None):
+        x_rescaling, ifft = self.propagate_complex_amplitudes(wavefront.get_abscissas(), wavefront.get_complex_amplitude(),
+                                                              wavefront.get_wavelength(), propagation_distance, parameters, element_index)
+
+        return GenericWavefront1D.initialize_wavefront_from_arrays(x_rescaling, ifft, wavelength=wavefront.get_wavelength())
+
+    # complex_amplitudes can be a (n_modes, n_points) stack: the FFTs run along the last axis
+    def propagate_complex_amplitudes(self, abscissas, complex_amplitudes, wavelength, propagation_distance, parameters, element_index=None):
+        magnification_x = self.get_additional_parameter("magnification_x", 1.0, parameters, element_index=element_index)
+
+        wavenumber = 2 * numpy.pi / wavelength
+        size = abscissas.size
+        delta = abscissas[1] - abscissas[0]
+        x_rescaling = abscissas * magnification_x
+
+        def build_kernels():
+            fft_scale = numpy.fft.fftfreq(size) / delta
+
+            r1sq = abscissas ** 2 * (1 - magnification_x)
+            r2sq = x_rescaling ** 2 * ((magnification_x - 1) / magnification_x)
+            fsq = (fft_scale ** 2 / magnification_x)
+
+            return (numpy.exp(1.0j * wavenumber / 2 / propagation_distance * r1sq),
+                    numpy.exp(-1.0j * numpy.pi * wavelength * propagation_distance * fsq),
+                    numpy.exp(1.0j * wavenumber / 2 / propagation_distance * r2sq) / numpy.sqrt(magnification_x))
+
+        key = (self.HANDLER_NAME, size, delta, abscissas[0], wavelength, propagation_distance, magnification_x)
+
+        Q1, Q2, Q3 = PropagatorCache.get_kernels_from(self._cache, key, build_kernels)
+
+        return x_rescaling, numpy.fft.ifft(numpy.fft.fft(complex_amplitudes * Q1, axis=-1) * Q2, axis=-1) * Q3
+
+def propagate_mode_stack_1D(mode_stack, propagation_parameters, handler_name, local_propagator=None):
+    """
+    Propagates all the modes of a WofryModeStack through the elements of the propagation parameters (whose wavefront
+    is ignored). With CachedFresnel1D or CachedFresnelZoom1D as local propagator the free space propagations run as one
+    FFT along the modes stack, otherwise every mode is propagated by the PropagationManager with the given handler.
+    The optical elements are always applied mode by mode.
+    """
+    additional_parameters = propagation_parameters._additional_parameters
+    propagation_elements  = propagation_parameters.get_PropagationElements()
+
+    if not isinstance(local_propagator, (CachedFresnel1D, CachedFresnelZoom1D)):
+        propagator = PropagationManager.Instance()
+
+        wavefronts = []
+        for index in range(mode_stack.get_number_of_modes()):
+            mode_propagation_parameters = PropagationParameters(wavefront=mode_stack.get_mode_wavefront(index),
+                                                                propagation_elements=propagation_elements,
+                                                                **additional_parameters)
+            wavefronts.append(propagator.do_propagation(propagation_parameters=mode_propagation_parameters, handler_name=handler_name))
+
+        return WofryModeStack.initialize_from_wavefronts(wavefronts, mode_indices=mode_stack.get_mode_indices())
+
+    abscissas          = mode_stack.get_abscissas()
+    complex_amplitudes = mode_stack.get_complex_amplitudes()
+    wavelength         = mode_stack.get_wavelength()
+
+    for element_index in range(propagation_elements.get_propagation_elements_number()):
+        element = propagation_elements.get_propagation_element(element_index)
+        coordinates = element.get_coordinates()
+
+        if coordinates.p() != 0.0:
+            abscissas, complex_amplitudes = local_propagator.propagate_complex_amplitudes(abscissas, complex_amplitudes, wavelength,
+                                                                                          coordinates.p(), propagation_parameters, element_index)
+
+        wavefronts = []
+        for index in range(complex_amplitudes.shape[0]):
+            wavefront = GenericWavefront1D.initialize_wavefront_from_arrays(abscissas, complex_amplitudes[index].copy(), wavelength=wavelength)
+            wavefronts.append(element.get_optical_element().applyOpticalElement(wavefront, propagation_parameters, element_index=element_index))
+
+        abscissas          = wavefronts[0].get_abscissas()
+        complex_amplitudes = numpy.array([wavefront.get_complex_amplitude() for wavefront in wavefronts])
+
+        if coordinates.q() != 0.0:
+            abscissas, complex_amplitudes = local_propagator.propagate_complex_amplitudes(abscissas, complex_amplitudes, wavelength,
+                                                                                          coordinates.q(), propagation_parameters, element_index)
+
+    return WofryModeStack(abscissas, complex_amplitudes, wavelength=wavelength, mode_indices=mode_stack.get_mode_indices())
+
+class CachedFresnel2D(Fresnel2D):
+    def __init__(self, cache=None):
+        super().__init__()
+        self._cache = cache
+
+    def do_specific_progation(self, wavefront, propagation_distance, parameters, element_index=None):
+        shift_half_pixel = self.get_additional_parameter("shift_half_pixel", False, parameters, element_index=element_index)
+
+        wavelength = wavefront.get_wavelength()
+        shape = wavefront.size()
+        delta = wavefront.delta()
+
+        def build_kernels():
+            freq_x = numpy.linspace(-1.0, 1.0, shape[0]) * 0.5 / delta[0]
+            freq_y = numpy.linspace(-1.0, 1.0, shape[1]) * 0.5 / delta[1]
+
+            if shift_half_pixel:
+                freq_x = freq_x - 0.5 * numpy.abs(freq_x[1] - freq_x[0])
+                freq_y = freq_y - 0.5 * numpy.abs(freq_y[1] - freq_y[0])
+
+            freq_xy = numpy.array(numpy.meshgrid(freq_y, freq_x))
+
+            return (numpy.exp((-1.0j) * numpy.pi * wavelength * propagation_distance *
+                              numpy.fft.fftshift(freq_xy[0] * freq_xy[0] + freq_xy[1] * freq_xy[1])),)
+
+        key = (self.HANDLER_NAME, shape, delta, wavelength, propagation_distance, bool(shift_half_pixel))
+
+        transfer_function, = PropagatorCache.get_kernels_from(self._cache, key, build_kernels)
+
+        fft2, ifft2 = get_fft2_functions(self.get_additional_parameter("fft_backend", "numpy", parameters, element_index=element_index),
+                                         self.get_additional_parameter("fft_workers", -1, parameters, element_index=element_index))
+
+        fft = fft2(wavefront.get_complex_amplitude())
+        fft *= transfer_function
+
+        return GenericWavefront2D.initialize_wavefront_from_arrays(x_array=wavefront.get_coordinate_x(),
+                                                                   y_array=wavefront.get_coordinate_y(),
+                                                                   z_array=ifft2(fft),
+                                                                   wavelength=wavelength)
+
+    # factors of separable wavefronts, as (n_modes, n_points) stacks: the transfer function is the product of the x and y ones
+    def propagate_separable_factors(self, coordinate_x, coordinate_y, factors_x, factors_y, wavelength, propagation_distance, parameters, element_index=None):
+        shift_half_pixel = self.get_additional_parameter("shift_half_pixel", False, parameters, element_index=element_index)
+
+        fft, ifft = get_fft_functions(self.get_additional_parameter("fft_backend", "numpy", parameters, element_index=element_index),
+                                      self.get_additional_parameter("fft_workers", -1, parameters, element_index=element_index))
+
+        def propagate(coordinate, factors):
+            size = coordinate.size
+            delta = coordinate[1] - coordinate[0]
+
+            def build_kernels():
+                freq = numpy.linspace(-1.0, 1.0, size) * 0.5 / delta
+                if shift_half_pixel: freq = freq - 0.5 * numpy.abs(freq[1] - freq[0])
+
+                return (numpy.exp((-1.0j) * numpy.pi * wavelength * propagation_distance * numpy.fft.fftshift(freq * freq)),)
+
+            key = (self.HANDLER_NAME, "separable", size, delta, wavelength, propagation_distance, bool(shift_half_pixel))
+
+            transfer_function, = PropagatorCache.get_kernels_from(self._cache, key, build_kernels)
+
+            return ifft(fft(factors) * transfer_function)
+
+        return coordinate_x, coordinate_y, propagate(coordinate_x, factors_x), propagate(coordinate_y, factors_y)
+
+class CachedFresnelZoomXY2D(FresnelZoomXY2D):
+    def __init__(self, cache=None):
+        super().__init__()
+        self._cache = cache
+
+    def do_specific_progation(self, wavefront, propagation_distance, parameters, element_index=None):
+        magnification_x = self.get_additional_parameter("magnification_x", 1.0, parameters, element_index=element_index)
+        magnification_y = self.get_additional_parameter("magnification_y", 1.0, parameters, element_index=element_index)
+
+        wavelength = wavefront.get_wavelength()
+        wavenumber = wavefront.get_wavenumber()
+        shape = wavefront.size()
+        delta = wavefront.delta()
+
+        def build_kernels():
+            freq_x = numpy.fft.ifftshift(numpy.fft.fftfreq(shape[0], delta[0]))
+            freq_y = numpy.fft.ifftshift(numpy.fft.fftfreq(shape[1], delta[1]))
+
+            f_x, f_y = numpy.meshgrid(freq_x, freq_y, indexing='ij')
+            fsq = numpy.fft.fftshift(f_x ** 2 / magnification_x + f_y ** 2 / magnification_y)
+
+            x = wavefront.get_mesh_x()
+            y = wavefront.get_mesh_y()
+            x_rescaling = x * magnification_x
+            y_rescaling = y * magnification_y
+
+            r1sq = x ** 2 * (1 - magnification_x) + y ** 2 * (1 - magnification_y)
+            r2sq = x_rescaling ** 2 * ((magnification_x - 1) / magnification_x) + y_rescaling ** 2 * ((magnification_y - 1) / magnification_y)
+
+            return (numpy.exp(1.0j * wavenumber / 2 / propagation_distance * r1sq),
+                    numpy.exp(-1.0j * numpy.pi * wavelength * propagation_distance * fsq),
+                    numpy.exp(1.0j * wavenumber / 2 / propagation_distance * r2sq) / numpy.sqrt(magnification_x * magnification_y))
+
+        key = (self.HANDLER_NAME, shape, delta, wavefront.offset(), wavelength, propagation_distance, magnification_x, magnification_y)
+
+        Q1, Q2, Q3 = PropagatorCache.get_kernels_from(self._cache, key, build_kernels)
+
+        fft2, ifft2 = get_fft2_functions(self.get_additional_parameter("fft_backend", "numpy", parameters, element_index=element_index),
+                                         self.get_additional_parameter("fft_workers", -1, parameters, element_index=element_index))
+
+        ifft = ifft2(fft2(wavefront.get_complex_amplitude() * Q1) * Q2) * Q3
+
+        return GenericWavefront2D.initialize_wavefront_from_arrays(x_array=wavefront.get_coordinate_x() * magnification_x,
+                                                                   y_array=wavefront.get_coordinate_y() * magnification_y,
+                                                                   z_array=ifft,
+                                                                   wavelength=wavelength)
+
+    # factors of separable wavefronts, as (n_modes, n_points) stacks: the three kernels are products of x and y ones
+    def propagate_separable_factors(self, coordinate_x, coordinate_y, factors_x, factors_y, wavelength, propagation_distance, parameters, element_index=None):
+        magnification_x = self.get_additional_parameter("magnification_x", 1.0, parameters, element_index=element_index)
+        magnification_y = self.get_additional_parameter("magnification_y", 1.0, parameters, element_index=element_index)
+
+        fft, ifft = get_fft_functions(self.get_additional_parameter("fft_backend", "numpy", parameters, element_index=element_index),
+                                      self.get_additional_parameter("fft_workers", -1, parameters, element_index=element_index))
+
+        wavenumber = 2 * numpy.pi / wavelength
+
+        def propagate(coordinate, factors, magnification):
+            size = coordinate.size
+            delta = coordinate[1] - coordinate[0]
+            rescaling = coordinate * magnification
+
+            def build_kernels():
+                fsq = numpy.fft.fftfreq(size, delta) ** 2 / magnification
+
+                r1sq = coordinate ** 2 * (1 - magnification)
+                r2sq = rescaling ** 2 * ((magnification - 1) / magnification)
+
+                return (numpy.exp(1.0j * wavenumber / 2 / propagation_distance * r1sq),
+                        numpy.exp(-1.0j * numpy.pi * wavelength * propagation_distance * fsq),
+                        numpy.exp(1.0j * wavenumber / 2 / propagation_distance * r2sq) / numpy.sqrt(magnification))
+
+            key = (self.HANDLER_NAME, "separable", size, delta, coordinate[0], wavelength, propagation_distance, magnification)
+
+            Q1, Q2, Q3 = PropagatorCache.get_kernels_from(self._cache, key, build_kernels)
+
+            return rescaling, ifft(fft(factors * Q1) * Q2) * Q3
+
+        coordinate_x, factors_x = propagate(coordinate_x, factors_x, magnification_x)
+        coordinate_y, factors_y = propagate(coordinate_y, factors_y, magnification_y)
+
+        return coordinate_x, coordinate_y, factors_x, factors_y
+
+#
+# Separable propagation: when the wavefront is a sum of products of x and y factors (WofryModeStack2D) and the
+# transmissions of the optical elements are products of x and y ones, the 2D propagation reduces to 1D propagations
+# of the factors.
+#
+
+def is_separable_optical_element(optical_element):
+    """
+    True for the elements whose transmission is the product of an x and a y one: screens, ideal lenses, rectangular
+    and gaussian slits, and any element implementing get_separable_transmissions(coordinate_x, coordinate_y, wavelength).
+    """
+    if hasattr(optical_element, "get_separable_transmissions"): return True
+
+    # subclasses may change the transmission
+    element_type = type(optical_element)
+
+    return element_type in (WOScreen, WOIdealLens, WOGaussianSlit) or \
+           (element_type is WOSlit and isinstance(optical_element.get_boundary_shape(), Rectangle))
+
+def get_separable_transmissions(optical_element, coordinate_x, coordinate_y, wavelength):
+    """
+    x and y complex amplitude transmissions of a separable optical element, as applied by applyOpticalElement().
+    """
+    if hasattr(optical_element, "get_separable_transmissions"):
+        return optical_element.get_separable_transmissions(coordinate_x, coordinate_y, wavelength)
+
+    if isinstance(optical_element, WOScreen):
+        return numpy.ones(coordinate_x.size), numpy.ones(coordinate_y.size)
+    elif isinstance(optical_element, WOIdealLens):
+        wavenumber = 2 * numpy.pi / wavelength
+
+        def transmission(coordinate, focal):
+            if focal is None or focal == 0.0: return numpy.ones(coordinate.size)
+            else: return numpy.exp(-1.0j * wavenumber * coordinate**2 / focal / 2)
+
+        return transmission(coordinate_x, optical_element.focal_x()), transmission(coordinate_y, optical_element.focal_y())
+    elif isinstance(optical_element, WOSlit):
+        x_min, x_max, y_min, y_max = optical_element.get_boundary_shape().get_boundaries()
+
+        return (numpy.logical_and(coordinate_x >= x_min, coordinate_x <= x_max).astype(float),
+                numpy.logical_and(coordinate_y >= y_min, coordinate_y <= y_max).astype(float))
+    elif isinstance(optical_element, WOGaussianSlit):
+        boundaries = optical_element.get_boundary_shape().get_boundaries()
+        aperture_diameter_x = numpy.abs(boundaries[1] - boundaries[0])
+        aperture_diameter_y = numpy.abs(boundaries[2] - boundaries[3])
+
+        return (numpy.exp(-(coordinate_x**2) / 2 / (aperture_diameter_x / 2.35)**2),
+                numpy.exp(-(coordinate_y**2) / 2 / (aperture_diameter_y / 2.35)**2))
+    else:
+        raise ValueError("Optical element is not separable")
+
+def is_separable_propagation(propagation_elements, local_propagator):
+    if not isinstance(local_propagator, (CachedFresnel2D, CachedFresnelZoomXY2D)): return False
+
+    for element_index in range(propagation_elements.get_propagation_elements_number()):
+        if not is_separable_optical_element(propagation_elements.get_propagation_element(element_index).get_optical_element()): return False
+
+    return True
+
+def propagate_mode_stack_2D_separable(mode_stack, propagation_parameters, local_propagator):
+    """
+    Propagates a WofryModeStack2D through the elements of the propagation parameters (whose wavefront is ignored),
+    with a CachedFresnel2D or CachedFresnelZoomXY2D as local propagator and separable elements only (see
+    is_separable_propagation): the x and y factors are propagated and transmitted separately, with 1D FFTs.
+    """
+    propagation_elements = propagation_parameters.get_PropagationElements()
+
+    coordinate_x = mode_stack.get_coordinate_x()
+    coordinate_y = mode_stack.get_coordinate_y()
+    factors_x    = mode_stack.get_factors_x()
+    factors_y    = mode_stack.get_factors_y()
+    wavelength   = mode_stack.get_wavelength()
+
+    for element_index in range(propagation_elements.get_propagation_elements_number()):
+        element = propagation_elements.get_propagation_element(element_index)
+        coordinates = element.get_coordinates()
+
+        if coordinates.p() != 0.0:
+            coordinate_x, coordinate_y, factors_x, factors_y = local_propagator.propagate_separable_factors(coordinate_x, coordinate_y,
+                                                                                                           factors_x, factors_y, wavelength,
+                                                                                                           coordinates.p(), propagation_parameters, element_index)
+
+        transmission_x, transmission_y = get_separable_transmissions(element.get_optical_element(), coordinate_x, coordinate_y, wavelength)
+
+        factors_x = factors_x * transmission_x
+        factors_y = factors_y * transmission_y
+
+        if coordinates.q() != 0.0:
+            coordinate_x, coordinate_y, factors_x, factors_y = local_propagator.propagate_separable_factors(coordinate_x, coordinate_y,
+                                                                                                           factors_x, factors_y, wavelength,
+                                                                                                           coordinates.q(), propagation_parameters, element_index)
+
+    return WofryModeStack2D(coordinate_x, coordinate_y, factors_x, factors_y, mode_stack.get_orders_x(), mode_stack.get_orders_y(),
+                            wavelength=wavelength, mode_indices=mode_stack.get_mode_indices())
@@ -0,0 +1,255 @@
+"""
+Tolerance sweeps of the 1D real lens (WOLens1D): the thickness profiles of all the misalignment cases are built as one
+(n_cases, n_points) array, applied to the same incoming wavefront and the resulting stack of wavefronts is propagated
+in one go; only summary statistics (Strehl ratio, FWHM, centroid, transmission) are kept for each case.
+"""
+import csv, itertools, numpy
+
+from barc4ro.projected_thickness import proj_thick_1D_crl
+
+from syned.beamline.beamline_element import BeamlineElement
+from syned.beamline.element_coordinates import ElementCoordinates
+from wofry.propagator.propagator import PropagationElements, PropagationParameters
+from wofryimpl.beamline.optical_elements.ideal_elements.screen import WOScreen1D
+
+from orangecontrib.wofry.util.wofry_objects import WofryModeStack
+from orangecontrib.wofry.util.wofry_propagators import propagate_mode_stack_1D
+
+# keywords of WOLens1D (distances in m, angles in rad)
+LENS_MISALIGNMENT_PARAMETERS = ["xc", "ang_rot", "wt_offset_ffs", "offset_ffs", "tilt_ffs", "wt_offset_bfs", "offset_bfs", "tilt_bfs"]
+
+SAMPLINGS = ["grid", "uniform", "gaussian"]
+
+def get_sweep_cases(ranges, sampling="grid", number_of_points=5, number_of_cases=1000, seed=None):
+    """
+    Values of the parameters for each case, as {name: array(n_cases)}. The ranges are {name: (value_1, value_2)}:
+    minimum and maximum for the "grid" (number_of_points values per parameter, all the combinations) and the "uniform"
+    samplings, mean and standard deviation for the "gaussian" one (number_of_cases random cases).
+    """
+    names = list(ranges.keys())
+
+    if sampling == "grid":
+        axes = [numpy.linspace(ranges[name][0], ranges[name][1], number_of_points if ranges[name][0] != ranges[name][1] else 1) for name in names]
+        values = numpy.array(list(itertools.product(*axes))).reshape(-1, len(names))
+
+        return {name: values[:, i].copy() for i, name in enumerate(names)}
+    elif sampling in ("uniform", "gaussian"):
+        random_state = numpy.random.RandomState(seed)
+
+        if sampling == "uniform": return {name: random_state.uniform(ranges[name][0], ranges[name][1], number_of_cases) for name in names}
+        else:                     return {name: random_state.normal(ranges[name][0], ranges[name][1], number_of_cases) for name in names}
+    else:
+        raise ValueError("Bad sampling: " + str(sampling))
+
+def get_number_of_cases(cases):
+    return 0 if len(cases) == 0 else len(next(iter(cases.values())))
+
+# the front (or back) parabolic surface of barc4ro.proj_thick_1D_crl without rotations, parameters as (n_cases, 1)
+def _get_parabolic_surface_batch(x, xc, offset, wt_offset, aperture, radius, wall_thickness, L_half):
+    wall_thickness_surface = wall_thickness + wt_offset * 2
+
+    with numpy.errstate(invalid="ignore"):
+        aperture_surface = numpy.where(wt_offset != 0, 2 * numpy.sqrt(2 * (L_half - wall_thickness_surface / 2) * radius), aperture)
+
+    u = x - xc - offset
+
+    delta_z = u ** 2 / radius / 2 + wall_thickness_surface / 2
+    delta_z = numpy.where((u < -0.5 * aperture_surface) | (u > 0.5 * aperture_surface), L_half, delta_z)
+    delta_z = numpy.where((wall_thickness_surface < 0) & (delta_z < 0), 0.0, delta_z)
+
+    return delta_z
+
+def get_lens_thickness_batch(lens, abscissas, cases):
+    """
+    Thickness profiles (n_cases, n_points) of the parabolic WOLens1D for the misalignments of the cases (missing
+    parameters are 0), as calculated by WOLens1D.get_surface_thickness_mesh with mis_flag=1. The cases with lateral
+    offsets and penetration depths only are calculated together; those with rotations (ang_rot, tilt_ffs, tilt_bfs),
+    which need an interpolation of the rotated profile, one by one by barc4ro.
+    """
+    keywords = lens._keywords_at_creation
+
+    if keywords["shape"] != 1 or keywords["number_of_curved_surfaces"] == 0:
+        raise ValueError("Misalignments are implemented only for parabolic lenses")
+
+    number_of_cases = get_number_of_cases(cases)
+    parameters = {name: numpy.asarray(cases.get(name, numpy.zeros(number_of_cases)), dtype=float).reshape(-1, 1) for name in LENS_MISALIGNMENT_PARAMETERS}
+
+    aperture       = keywords["lens_aperture"]
+    radius         = keywords["radius"]
+    wall_thickness = keywords["wall_thickness"]
+    n_ref_lens     = keywords["number_of_curved_surfaces"]
+
+    x = numpy.asarray(abscissas, dtype=float)
+    L_half = (aperture / 2) ** 2 / 2 / radius + wall_thickness / 2
+
+    lens_thickness = _get_parabolic_surface_batch(x, parameters["xc"], parameters["offset_ffs"], parameters["wt_offset_ffs"],
+                                                  aperture, radius, wall_thickness, L_half)
+    if n_ref_lens == 2:
+        lens_thickness = lens_thickness + _get_parabolic_surface_batch(x, parameters["xc"], parameters["offset_bfs"], parameters["wt_offset_bfs"],
+                                                                       aperture, radius, wall_thickness, L_half)
+
+    rotated = numpy.where((parameters["ang_rot"] != 0) | (parameters["tilt_ffs"] != 0) | (parameters["tilt_bfs"] != 0))[0]
+
+    for i in rotated:
+        _, lens_thickness[i] = proj_thick_1D_crl(1, aperture, radius,
+                                                 _n=n_ref_lens,
+                                                 _wall_thick=wall_thickness,
+                                                 _xc=parameters["xc"][i, 0],
+                                                 _nx=100,
+                                                 _ang_rot_ex=parameters["ang_rot"][i, 0],
+                                                 _offst_ffs_x=parameters["offset_ffs"][i, 0],
+                                                 _tilt_ffs_x=parameters["tilt_ffs"][i, 0],
+                                                 _wt_offst_ffs=parameters["wt_offset_ffs"][i, 0],
+                                                 _offst_bfs_x=parameters["offset_bfs"][i, 0],
+                                                 _tilt_bfs_x=parameters["tilt_bfs"][i, 0],
+                                                 _wt_offst_bfs=parameters["wt_offset_bfs"][i, 0],
+                                                 isdgr=False,
+                                                 project=True,
+                                                 _axis=x.copy())
+
+    lens_thickness *= keywords["n_lenses"]
+
+    # the error profile does not depend on the misalignments (WOLens1DWithProfile)
+    if keywords["error_flag"]: lens_thickness += lens.get_error_thickness(x)
+
+    return lens_thickness
+
+def apply_lens_batch(lens, wavefront, lens_thickness):
+    """
+    Complex amplitudes (n_cases, n_points) of the wavefront after the lens, for each of the thickness profiles, as by
+    WOLens1D.applyOpticalElement.
+    """
+    keywords = lens._keywords_at_creation
+
+    refraction_index_delta, att_coefficient = lens.get_refraction_index(wavefront.get_photon_energy())
+
+    complex_amplitudes = wavefront.get_complex_amplitude() * numpy.exp(-1.0 * att_coefficient * lens_thickness / 2) * \
+                         numpy.exp(1.0j * (-1.0 * wavefront.get_wavenumber() * refraction_index_delta * lens_thickness))
+
+    if keywords["error_flag"] and keywords["error_edge_management"] != 0:
+        profile = lens.get_profile()
+        abscissas = wavefront.get_abscissas()
+
+        if abscissas[-1] - abscissas[0] > profile[-1, 0] - profile[0, 0]:
+            complex_amplitudes[:, (abscissas < profile[0, 0]) | (abscissas > profile[-1, 0])] = 0.0
+
+    return complex_amplitudes
+
+def propagate_batch(abscissas, complex_amplitudes, wavelength, distance, handler_name, additional_parameters=None, local_propagator=None):
+    """
+    Propagates the stack of wavefronts (rows of complex_amplitudes) in free space, by propagate_mode_stack_1D.
+    """
+    mode_stack = WofryModeStack(abscissas, complex_amplitudes, wavelength=wavelength)
+
+    if distance == 0.0: return mode_stack
+
+    propagation_elements = PropagationElements()
+    propagation_elements.add_beamline_element(BeamlineElement(optical_element=WOScreen1D(),
+                                                              coordinates=ElementCoordinates(p=distance, q=0.0)))
+
+    propagation_parameters = PropagationParameters(wavefront=mode_stack.get_mode_wavefront(0),
+                                                   propagation_elements=propagation_elements)
+    if not additional_parameters is None:
+        for name, value in additional_parameters.items(): propagation_parameters.set_additional_parameters(name, value)
+
+    return propagate_mode_stack_1D(mode_stack, propagation_parameters, handler_name=handler_name, local_propagator=local_propagator)
+
+def get_fwhm_batch(abscissas, intensities):
+    """
+    FWHM of each row of intensities, between the outermost half maximum crossings (linear interpolation).
+    """
+    half_maximum = 0.5 * intensities.max(axis=1, keepdims=True)
+    above = intensities >= half_maximum
+
+    n = abscissas.size
+    rows = numpy.arange(intensities.shape[0])
+    first = numpy.argmax(above, axis=1)
+    last  = n - 1 - numpy.argmax(above[:, ::-1], axis=1)
+
+    def crossing(inside, outside):
+        i_in  = intensities[rows, inside]
+        i_out = intensities[rows, outside]
+
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            t = numpy.where(i_in != i_out, (i_in - half_maximum[:, 0]) / (i_in - i_out), 0.0)
+
+        return abscissas[inside] + t * (abscissas[outside] - abscissas[inside])
+
+    left  = crossing(first, numpy.maximum(first - 1, 0))
+    right = crossing(last,  numpy.minimum(last + 1, n - 1))
+
+    return right - left
+
+def get_sweep_statistics(abscissas, complex_amplitudes, reference_peak_intensity, input_integrated_intensity=None):
+    intensities = numpy.abs(complex_amplitudes) ** 2
+    integrated_intensities = intensities.sum(axis=1) * (abscissas[1] - abscissas[0])
+
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        statistics = {"strehl":   intensities.max(axis=1) / reference_peak_intensity,
+                      "fwhm":     get_fwhm_batch(abscissas, intensities),
+                      "centroid": (intensities * abscissas).sum(axis=1) / intensities.sum(axis=1)}
+
+        if not input_integrated_intensity is None:
+            statistics["transmission"] = integrated_intensities / input_integrated_intensity
+
+    return statistics
+
+def run_lens_tolerance_sweep(lens, input_wavefront, cases, q=0.0, handler_name=None, additional_parameters=None,
+                             local_propagator=None, batch_size=256, callback=None):
+    """
+    Tolerance sweep of the WOLens1D over the misalignment cases ({name: array(n_cases)}): the input wavefront (at the
+    lens) is transmitted by the misaligned lenses and propagated by the distance q, batch_size cases at a time.
+
+    Returns the statistics ({name: array(n_cases)}) and the output wavefront of the aligned lens, which is the reference
+    of the Strehl ratio (peak intensity ratio). callback, if given, is called with the fraction of the cases done after
+    each batch (it can raise an exception to stop the sweep).
+    """
+    abscissas  = input_wavefront.get_abscissas()
+    wavelength = input_wavefront.get_wavelength()
+
+    def propagate(batch_cases):
+        lens_thickness = get_lens_thickness_batch(lens, abscissas, batch_cases)
+        complex_amplitudes = apply_lens_batch(lens, input_wavefront, lens_thickness)
+
+        return propagate_batch(abscissas, complex_amplitudes, wavelength, q, handler_name,
+                               additional_parameters=additional_parameters, local_propagator=local_propagator)
+
+    reference_wavefront = propagate({name: numpy.zeros(1) for name in LENS_MISALIGNMENT_PARAMETERS}).get_mode_wavefront(0)
+    reference_peak_intensity = reference_wavefront.get_intensity().max()
+    input_integrated_intensity = input_wavefront.get_intensity().sum() * input_wavefront.delta()
+
+    number_of_cases = get_number_of_cases(cases)
+    statistics = None
+
+    for first in range(0, number_of_cases, batch_size):
+        output_mode_stack = propagate({name: numpy.asarray(values)[first:first + batch_size] for name, values in cases.items()})
+
+        batch_statistics = get_sweep_statistics(output_mode_stack.get_abscissas(),
+                                                output_mode_stack.get_complex_amplitudes(),
+                                                reference_peak_intensity,
+                                                input_integrated_intensity)
+
+        if statistics is None: statistics = {name: [] for name in batch_statistics.keys()}
+        for name, values in batch_statistics.items(): statistics[name].append(values)
+
+        if not callback is None: callback(min(first + batch_size, number_of_cases) / number_of_cases)
+
+    statistics = {name: numpy.concatenate(values) for name, values in statistics.items()} if not statistics is None else {}
+
+    return statistics, reference_wavefront
+
+def save_sweep_results(file_name, cases, statistics):
+    names = list(cases.keys()) + list(statistics.keys())
+    columns = [numpy.asarray(cases[name]) for name in cases.keys()] + [statistics[name] for name in statistics.keys()]
+
+    with open(file_name, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for i in range(get_number_of_cases(cases)): writer.writerow(["%.10g" % column[i] for column in columns])
+
+def get_sweep_summary(statistics):
+    text = ""
+    for name, values in statistics.items():
+        text += "%-12s mean: %12.6g   std: %12.6g   min: %12.6g   max: %12.6g\n" % (name, numpy.nanmean(values), numpy.nanstd(values),
+                                                                                  numpy.nanmin(values), numpy.nanmax(values))
+    return text
@@ -0,0 +1,154 @@
+import os, numpy
+
+from wofryimpl.beamline.optical_elements.refractors.lens import WOLens
+from wofryimpl.beamline.optical_elements.refractors.thin_object import WOThinObject
+
+from orangecontrib.wofry.util.wofry_profiles import ProfileCache
+
+#
+# 2D refractors with the thickness map and the complex transmission screen kept in a cache, keyed on the element and
+# material parameters and on the wavefront grid: repeated propagations through an unchanged element (e.g. scanning the
+# downstream distances) reuse them instead of recalculating (lens) or reloading and interpolating (thin object) them.
+#
+
+def get_transmission_cache(max_entries=4):
+    # each entry is a full 2D map
+    return ProfileCache(max_entries=max_entries)
+
+def _get_grid_key(wavefront):
+    x = wavefront.get_coordinate_x()
+    y = wavefront.get_coordinate_y()
+
+    return (float(x[0]), float(x[-1]), x.size, float(y[0]), float(y[-1]), y.size)
+
+def _set_read_only(*arrays):
+    # shared by the elements using the cache: not to be modified (copies, the coordinates can be those of the wavefront)
+    arrays = tuple(numpy.array(array) for array in arrays)
+    for array in arrays: array.flags.writeable = False
+
+    return arrays
+
+class _TransmissionElement(object):
+    """
+    Mixin for the wofryimpl 2D refractors: with a cache (ProfileCache), the thickness mesh and the complex transmission
+    amp * exp(i phase) on the wavefront grid are calculated once for each set of parameters.
+    """
+    _transmission_cache = None
+
+    def set_transmission_cache(self, transmission_cache):
+        self._transmission_cache = transmission_cache
+
+    def _get_thickness_key(self):
+        raise NotImplementedError()
+
+    def _get_material_key(self):
+        return (self.get_material(),)
+
+    # (x, y, thickness) of the base class
+    def _calculate_surface_thickness_mesh(self, wavefront):
+        raise NotImplementedError()
+
+    def get_surface_thickness_mesh(self, wavefront):
+        if self._transmission_cache is None: return self._calculate_surface_thickness_mesh(wavefront)
+
+        key = ("thickness",) + self._get_thickness_key() + _get_grid_key(wavefront)
+
+        return self._transmission_cache.get(key, lambda: _set_read_only(*self._calculate_surface_thickness_mesh(wavefront)))
+
+    def get_transmission(self, wavefront):
+        """
+        Returns the refraction index delta, the attenuation coefficient and the complex transmission (same shape as
+        the thickness mesh) for the wavefront grid and photon energy.
+        """
+        photon_energy = wavefront.get_photon_energy()
+
+        def calculate():
+            refraction_index_delta, att_coefficient = self.get_refraction_index(photon_energy=photon_energy)
+
+            _, _, thickness = self.get_surface_thickness_mesh(wavefront)
+
+            transmission = numpy.exp(-1.0 * att_coefficient * thickness / 2 # factor of 2 because it is amplitude
+                                     -1.0j * wavefront.get_wavenumber() * refraction_index_delta * thickness)
+
+            return refraction_index_delta, att_coefficient, _set_read_only(transmission)[0]
+
+        if self._transmission_cache is None: return calculate()
+
+        key = ("transmission", float(photon_energy)) + self._get_thickness_key() + self._get_material_key() + _get_grid_key(wavefront)
+
+        return self._transmission_cache.get(key, calculate)
+
+class WOLensWithCache(_TransmissionElement, WOLens):
+
+    @classmethod
+    def create_from_keywords(cls, transmission_cache=None, **keywords):
+        lens = WOLens.create_from_keywords(**keywords)
+
+        out = cls(name=lens.get_name(),
+                  surface_shape1=lens.get_surface_shape(index=0),
+                  surface_shape2=lens.get_surface_shape(index=1),
+                  boundary_shape=lens.get_boundary_shape(),
+                  material=lens.get_material(),
+                  thickness=lens.get_thickness(),
+                  keywords_at_creation=lens._keywords_at_creation)
+        out.set_transmission_cache(transmission_cache)
+
+        return out
+
+    def _get_thickness_key(self):
+        return ("lens",) + tuple(self.get_barc_inputs()) + (self._keywords_at_creation["n_lenses"],)
+
+    def _get_material_key(self):
+        return (self.get_material(), self._keywords_at_creation["refraction_index_delta"], self._keywords_at_creation["att_coefficient"])
+
+    def _calculate_surface_thickness_mesh(self, wavefront):
+        return WOLens.get_surface_thickness_mesh(self, wavefront)
+
+    # as in the base class, with the transmission from get_transmission()
+    def applyOpticalElement(self, wavefront, parameters=None, element_index=None):
+        refraction_index_delta, att_coefficient, transmission = self.get_transmission(wavefront)
+
+        keywords = self._keywords_at_creation
+        if keywords["verbose"]:
+            print("\n\n\n ==========  parameters in use : ")
+            print("\n\nRadius of curvature R = %g um" % (1e6 * keywords["lens_radius"]))
+            print("Number of lenses N: %d" % keywords["n_lenses"])
+            print("Number of curved refractive surfaces in a lens Nd = %d" % (keywords["number_of_curved_surfaces"]))
+            if keywords["number_of_curved_surfaces"] != 0:
+                print("Focal distance F = R / (Nd N delta) = %g m" % (keywords["lens_radius"] / (keywords["number_of_curved_surfaces"] * keywords["n_lenses"] * refraction_index_delta)))
+
+        output_wavefront = wavefront.duplicate()
+        output_wavefront.rescale_amplitudes(transmission)
+
+        return output_wavefront
+
+class WOThinObjectWithCache(_TransmissionElement, WOThinObject):
+
+    def __init__(self, transmission_cache=None, **keywords):
+        super().__init__(**keywords)
+
+        self.set_transmission_cache(transmission_cache)
+
+    def _get_thickness_key(self):
+        file_name = os.path.abspath(self.get_file_with_thickness_mesh())
+
+        return ("thin_object", file_name, os.path.getmtime(file_name), os.path.getsize(file_name))
+
+    def _get_material_key(self):
+        return (self.get_material(), self._refraction_index_delta, self._att_coefficient)
+
+    def _calculate_surface_thickness_mesh(self, wavefront):
+        return WOThinObject.get_surface_thickness_mesh(self, wavefront)
+
+    # as in the base class (the thickness mesh is transposed), with the transmission from get_transmission()
+    def applyOpticalElement(self, wavefront, parameters=None, element_index=None):
+        if self._verbose:
+            print("\n\n\n ==========  parameters from optical element : ")
+            print(self.info())
+
+        _, _, transmission = self.get_transmission(wavefront)
+
+        output_wavefront = wavefront.duplicate()
+        output_wavefront.rescale_amplitudes(transmission.T)
+
+        return output_wavefront
@@ -1,6 +1,7 @@
 import numpy, decimal
 from PyQt5.QtGui import QFont, QPalette, QColor
 from PyQt5.QtWidgets import QWidget, QGridLayout, QLabel, QDialog, QVBoxLayout, QDialogButtonBox
+from PyQt5.QtCore import QThread, pyqtSignal
 
 from matplotlib.patches import FancyArrowPatch, ArrowStyle
 
@@ -160,9 +161,10 @@ class ImageViewWithFWHM(QWidget):
         self.get_ImageView().getColormapAction().setVisible(True)
         self.get_ImageView().setKeepDataAspectRatio(False)
 
+    # full_data: (histogram, xx, yy) at full resolution when the image is decimated, for the widths and the total
     def plot_2D(self, histogram,xx=None,yy=None,
                 title="", xtitle="", ytitle="", xum="[mm]", yum="[mm]",
-                plotting_range=None,factor1=1.0,factor2=1.0,colormap=None):
+                plotting_range=None,factor1=1.0,factor2=1.0,colormap=None,full_data=None):
 
         if xx is None:
             xx = numpy.arange(histogram.shape[0])
@@ -193,27 +195,47 @@ class ImageViewWithFWHM(QWidget):
         scale = (abs((xmax-xmin)/nbins_h)*factor1, abs((ymax-ymin)/nbins_v)*factor2)
 
         # silx inverts axis!!!! histogram must be calculated reversed
-        data_to_plot = []
-        for y_index in range(0, nbins_v):
-            x_values = []
-            for x_index in range(0, nbins_h):
-                x_values.append(histogram[x_index][y_index])
-
-            data_to_plot.append(x_values)
-
-        data_to_plot = numpy.array(data_to_plot)
+        data_to_plot = numpy.array(numpy.asarray(histogram)[0:nbins_h, 0:nbins_v].T)
 
         histogram_h = numpy.sum(data_to_plot, axis=0) # data to plot axis are inverted
         histogram_v = numpy.sum(data_to_plot, axis=1)
 
         ticket = {}
-        ticket['total'] = numpy.sum(data_to_plot)
 
-        ticket['fwhm_h'], ticket['fwhm_quote_h'], ticket['fwhm_coordinates_h'] = get_fwhm(histogram_h, xx)
-        ticket['sigma_h'] = get_sigma(histogram_h, xx)
+        if full_data is None:
+            ticket['total'] = numpy.sum(data_to_plot)
+
+            ticket['fwhm_h'], ticket['fwhm_quote_h'], ticket['fwhm_coordinates_h'] = get_fwhm(histogram_h, xx)
+            ticket['sigma_h'] = get_sigma(histogram_h, xx)
+
+            ticket['fwhm_v'], ticket['fwhm_quote_v'], ticket['fwhm_coordinates_v'] = get_fwhm(histogram_v, yy)
+            ticket['sigma_v'] = get_sigma(histogram_v, yy)
+        else:
+            full_histogram, full_xx, full_yy = full_data
+
+            if not plotting_range is None:
+                range_x = numpy.where(numpy.logical_and(full_xx>=plotting_range[0], full_xx<=plotting_range[1]))[0]
+                range_y = numpy.where(numpy.logical_and(full_yy>=plotting_range[2], full_yy<=plotting_range[3]))[0]
+
+                full_histogram = numpy.asarray(full_histogram)[range_x[0]:range_x[-1]+1, range_y[0]:range_y[-1]+1]
+                full_xx = full_xx[range_x]
+                full_yy = full_yy[range_y]
+
+            # not transposed, to not copy the full array
+            full_histogram_h = numpy.sum(full_histogram, axis=1)
+            full_histogram_v = numpy.sum(full_histogram, axis=0)
+
+            ticket['total'] = numpy.sum(full_histogram_h)
+
+            ticket['fwhm_h'], _, ticket['fwhm_coordinates_h'] = get_fwhm(full_histogram_h, full_xx)
+            ticket['sigma_h'] = get_sigma(full_histogram_h, full_xx)
+
+            ticket['fwhm_v'], _, ticket['fwhm_coordinates_v'] = get_fwhm(full_histogram_v, full_yy)
+            ticket['sigma_v'] = get_sigma(full_histogram_v, full_yy)
 
-        ticket['fwhm_v'], ticket['fwhm_quote_v'], ticket['fwhm_coordinates_v'] = get_fwhm(histogram_v, yy)
-        ticket['sigma_v'] = get_sigma(histogram_v, yy)
+            # the arrows are drawn on the histograms of the decimated image shown
+            ticket['fwhm_quote_h'] = 0.5 * numpy.max(histogram_h)
+            ticket['fwhm_quote_v'] = 0.5 * numpy.max(histogram_v)
 
         self.plot_canvas.setColormap(colormap=colormap)
         self.plot_canvas.setImage(data_to_plot, origin=origin, scale=scale)
@@ -308,6 +330,130 @@ class ImageViewWithFWHM(QWidget):
 
         self.info_box.clear()
 
+class DecimatedImage(object):
+    """
+    Screen resolution views of a 2D array (data2D[x, y], as in the wavefronts) on the dataX, dataY axes.
+    A pyramid of levels binned by 2, 4, 8, ... is built lazily (never transposing or copying the full array): each
+    view is taken from the finest level with no more than max_pixels per axis in the requested range.
+    reduction is "mean", "max" or "sum".
+    """
+    def __init__(self, data2D, dataX, dataY, max_pixels=1024, reduction="mean"):
+        super().__init__()
+
+        self.__levels = {1: numpy.asarray(data2D)}
+        self.__dataX = numpy.asarray(dataX)
+        self.__dataY = numpy.asarray(dataY)
+        self.__max_pixels = max(2, int(max_pixels))
+        self.__reduction = reduction
+
+    def __reduce(self, data, axis):
+        if self.__reduction == "max": return data.max(axis=axis)
+        elif self.__reduction == "sum": return data.sum(axis=axis)
+        else: return data.mean(axis=axis)
+
+    def __get_level(self, factor):
+        if not factor in self.__levels:
+            previous = self.__get_level(factor // 2)
+
+            nx, ny = previous.shape[0] // 2, previous.shape[1] // 2
+
+            # the first reduction takes contiguous rows: no temporary copy of the full level
+            level = self.__reduce(previous[0:2*nx].reshape(nx, 2, previous.shape[1]), axis=1)
+            level = self.__reduce(level[:, 0:2*ny].reshape(nx, ny, 2), axis=2)
+
+            self.__levels[factor] = level
+
+        return self.__levels[factor]
+
+    def get_full_size(self):
+        return self.__levels[1].shape
+
+    def get_coordinates(self):
+        return self.__dataX, self.__dataY
+
+    def get_factor(self, x_range=None, y_range=None):
+        first_x, last_x = self.__get_index_range(self.__dataX, x_range)
+        first_y, last_y = self.__get_index_range(self.__dataY, y_range)
+
+        factor = 1
+        while max(last_x - first_x, last_y - first_y) / factor > self.__max_pixels and \
+                min(self.__levels[1].shape) // (2 * factor) >= 2:
+            factor *= 2
+
+        return factor
+
+    @classmethod
+    def __get_index_range(cls, coordinates, range):
+        if range is None: return 0, coordinates.size
+
+        first = max(0, numpy.searchsorted(coordinates, min(range), side="left") - 1)
+        last  = min(coordinates.size, numpy.searchsorted(coordinates, max(range), side="right") + 1)
+
+        return first, max(last, first + 1)
+
+    def get_image(self, x_range=None, y_range=None):
+        """
+        Returns the binned data, its coordinates and the binning factor for the given ranges (None for full range).
+        """
+        factor = self.get_factor(x_range, y_range)
+        level = self.__get_level(factor)
+
+        nx, ny = level.shape
+
+        first_x, last_x = self.__get_index_range(self.__dataX, x_range)
+        first_y, last_y = self.__get_index_range(self.__dataY, y_range)
+
+        first_x, last_x = first_x // factor, min(nx, -(-last_x // factor))
+        first_y, last_y = first_y // factor, min(ny, -(-last_y // factor))
+
+        dataX = self.__dataX[0:nx*factor].reshape(nx, factor).mean(axis=1)
+        dataY = self.__dataY[0:ny*factor].reshape(ny, factor).mean(axis=1)
+
+        return level[first_x:last_x, first_y:last_y], dataX[first_x:last_x], dataY[first_y:last_y], factor
+
+class TaskCancelled(Exception):
+    pass
+
+class WorkerThread(QThread):
+    """
+    Runs task() outside the GUI thread: the result (or the exception) is delivered by the signals, with the task id.
+    A task can report its progress (set_task_progress) and stop when cancelled (check_task_cancelled).
+    """
+    task_completed = pyqtSignal(int, object)
+    task_failed    = pyqtSignal(int, object)
+    task_progress  = pyqtSignal(int, int)
+
+    def __init__(self, task_id, task, parent=None):
+        super().__init__(parent)
+        self.task_id = task_id
+        self.task = task
+        self.__cancelled = False
+
+    # the task stops at its next check_task_cancelled()
+    def cancel(self):
+        self.__cancelled = True
+
+    def is_cancelled(self):
+        return self.__cancelled
+
+    def run(self):
+        try:
+            result = self.task()
+        except Exception as exception:
+            self.task_failed.emit(self.task_id, exception)
+        else:
+            self.task_completed.emit(self.task_id, result)
+
+# to be called by the tasks, between their steps: they do nothing when the task runs in the GUI thread
+
+def check_task_cancelled():
+    thread = QThread.currentThread()
+    if isinstance(thread, WorkerThread) and thread.is_cancelled(): raise TaskCancelled()
+
+def set_task_progress(value):
+    thread = QThread.currentThread()
+    if isinstance(thread, WorkerThread): thread.task_progress.emit(thread.task_id, int(value))
+
 if __name__=="__main__":
 
 
@@ -19,8 +19,8 @@ from syned.widget.widget_decorator import WidgetDecorator
 from wofry.propagator.wavefront1D.generic_wavefront import GenericWavefront1D
 
 from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_profiles import save_profile, get_in_memory_profile_name, check_in_memory_profile_name, ProfileCache, WOMirror1DWithProfile
 from orangecontrib.wofry.widgets.gui.ow_optical_element_1d import OWWOOpticalElement1D
-from wofryimpl.beamline.optical_elements.mirrors.mirror import WOMirror1D
 
 
 
@@ -62,6 +62,12 @@ class OWMirror1D(OWWOOpticalElement1D):
     mirror_points = Setting(500)
     write_profile = Setting(0)
     write_input_wavefront = Setting(0)
+    save_dabam_profile = Setting(1)
+
+    monte_carlo_perturbations = Setting("p_distance gaussian 0.0 0.001; q_distance gaussian 0.0 0.001")
+
+    dabam_profile = None
+    dabam_profile_name = None
 
 
     input_data = None
@@ -69,6 +75,8 @@ class OWMirror1D(OWWOOpticalElement1D):
 
 
     def __init__(self):
+        self.profile_cache = ProfileCache() # profile and interpolators, reused in scans
+
         super().__init__(is_automatic=True, show_view_options=True, show_script_tab=True)
 
     def draw_specific_box(self):
@@ -102,6 +110,9 @@ class OWMirror1D(OWWOOpticalElement1D):
                                                     labelWidth=120, valueType=str, orientation="horizontal")
         gui.button(file_box_id2, self, "...", callback=self.set_error_file)
 
+        gui.comboBox(self.file_box_id, self, "save_dabam_profile", label="Received DABAM profile",
+                     items=["Keep in memory", "Save to file (.npy)"], sendSelectedValue=False, orientation="horizontal")
+
         oasysgui.lineEdit(self.file_box_id, self, "error_file_oversampling_factor", "Oversampling factor (>=1)",
                           labelWidth=300, valueType=float, orientation="horizontal")
 
@@ -131,7 +142,9 @@ class OWMirror1D(OWWOOpticalElement1D):
         self.grazing_angle_in = congruence.checkStrictlyPositiveNumber(self.grazing_angle_in, "Grazing incidence angle")
         self.p_focus = congruence.checkNumber(self.p_focus, "p focus")
         self.q_focus = congruence.checkNumber(self.q_focus, "q focus")
-        self.error_file = congruence.checkFileName(self.error_file)
+        if not self.error_file == self.dabam_profile_name:
+            check_in_memory_profile_name(self.error_file)
+            self.error_file = congruence.checkFileName(self.error_file)
         self.error_file_oversampling_factor = congruence.checkStrictlyPositiveNumber(self.error_file_oversampling_factor)
 
     def receive_syned_data(self):
@@ -145,20 +158,22 @@ class OWMirror1D(OWWOOpticalElement1D):
                 self.input_data = WofryData(wavefront=wofry_data)
 
             if self.is_automatic_execution:
-                self.propagate_wavefront()
+                self.execute_automatically(self.propagate_wavefront)
 
     def receive_dabam_profile(self, dabam_profile):
         if not dabam_profile is None:
             try:
-                file_name = "dabam_profile_" + str(id(self)) + ".dat"
+                self.dabam_profile = numpy.array(dabam_profile, dtype=float)
+                self.profile_cache.clear()
 
-                file = open(file_name, "w")
+                # kept in memory, the file name is a label (saved only if asked, as binary .npy)
+                if self.save_dabam_profile == 1:
+                    file_name = "dabam_profile_" + str(id(self)) + ".npy"
+                    save_profile(file_name, self.dabam_profile)
+                else:
+                    file_name = get_in_memory_profile_name(self)
 
-                for element in dabam_profile:
-                    file.write(str(element[0]) + " " + str(element[1]) + "\n")
-
-                file.flush()
-                file.close()
+                self.dabam_profile_name = file_name
 
                 self.error_flag = 1
                 self.error_file = file_name
@@ -179,7 +194,9 @@ class OWMirror1D(OWWOOpticalElement1D):
             mirror_length = 0
             mirror_points = 0
 
-        return WOMirror1D.create_from_keywords(
+        return WOMirror1DWithProfile.create_from_keywords(
+                    profile=self.dabam_profile if (self.error_flag == 1 and self.error_file == self.dabam_profile_name) else None,
+                    profile_cache=self.profile_cache,
                     name                         =self.oe_name,
                     shape=self.shape,
                     flip=self.flip,
@@ -213,14 +230,8 @@ class OWMirror1D(OWWOOpticalElement1D):
         input_wavefront  = self.input_data.get_wavefront()
         beamline         = self.input_data.get_beamline().duplicate()
 
-        optical_element = self.get_optical_element()
-        optical_element.name = self.oe_name if not self.oe_name is None else self.windowTitle()
-
-        beamline_element = BeamlineElement(optical_element=optical_element,
-                                           coordinates=ElementCoordinates(p=0.0, # to avoid using standard propagators
-                                                                          q=0.0, # to avoid using standard propagators
-                                                                          angle_radial=numpy.radians(self.angle_radial),
-                                                                          angle_azimuthal=numpy.radians(self.angle_azimuthal)))
+        beamline_element = self.get_beamline_element()
+        optical_element  = beamline_element.get_optical_element()
 
         beamline.append_beamline_element(beamline_element)
 
@@ -253,6 +264,26 @@ class OWMirror1D(OWWOOpticalElement1D):
     # overwritten methods
     #
 
+    # p and q are propagated by the mirror (p_distance and q_distance)
+    def get_beamline_element(self):
+        optical_element = self.get_optical_element()
+        optical_element.name = self.oe_name if not self.oe_name is None else self.windowTitle()
+
+        return BeamlineElement(optical_element=optical_element,
+                               coordinates=ElementCoordinates(p=0.0, # to avoid using standard propagators
+                                                              q=0.0, # to avoid using standard propagators
+                                                              angle_radial=numpy.radians(self.angle_radial),
+                                                              angle_azimuthal=numpy.radians(self.angle_azimuthal)))
+
+    def get_propagator_info(self):
+        return None
+
+    # the distances are the keywords p_distance and q_distance of the mirror
+    def get_monte_carlo_perturbations(self):
+        names = {"oe1.p": "oe1.p_distance", "oe1.q": "oe1.q_distance"}
+
+        return [(names.get(name, name), distribution, value_1, value_2) for name, distribution, value_1, value_2 in super().get_monte_carlo_perturbations()]
+
     # overwritten method for specific built-in propagator
     def create_propagation_setting_tab(self):
         self.tab_pro = oasysgui.createTabPage(self.tabs_setting, "Propagation Setting")
@@ -16,11 +16,16 @@ from oasys.util.oasys_util import TriggerIn, TriggerOut, EmittingStream
 
 from syned.widget.widget_decorator import WidgetDecorator
 
+from wofry.propagator.propagator import PropagationElements, PropagationParameters
+
+from orangecontrib.wofry.util.wofry_util import check_task_cancelled, set_task_progress
 from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_profiles import save_profile, get_in_memory_profile_name, check_in_memory_profile_name, ProfileCache, WOLens1DWithProfile
+from orangecontrib.wofry.util.wofry_tolerance import LENS_MISALIGNMENT_PARAMETERS, SAMPLINGS, get_sweep_cases, get_number_of_cases, \
+    propagate_batch, run_lens_tolerance_sweep, save_sweep_results, get_sweep_summary
 
 from orangecontrib.wofry.widgets.gui.ow_optical_element_1d import OWWOOpticalElement1D
 
-from wofryimpl.beamline.optical_elements.refractors.lens import WOLens1D
 
 
 class OWWORealLens1D(OWWOOpticalElement1D):
@@ -65,6 +70,7 @@ class OWWORealLens1D(OWWOOpticalElement1D):
     error_edge_management = Setting(0)
     write_profile_flag = Setting(0)
     write_profile = Setting("profile1D.dat")
+    save_dabam_profile = Setting(1)
 
     image1_path = os.path.join(resources.package_dirname("orangecontrib.wofry.widgets.gui"), "misc", "Refractor_parameters.png")
 
@@ -80,11 +86,39 @@ class OWWORealLens1D(OWWOOpticalElement1D):
     offset_bfs = Setting(0.0)
     tilt_bfs = Setting(0.0)
 
+    # tolerance sweep: (min, max) or (mean, sigma) of each misalignment
+    tolerance_sampling = Setting(0)
+    tolerance_points = Setting(3)
+    tolerance_cases = Setting(1000)
+    tolerance_seed = Setting(0)
+    tolerance_batch_size = Setting(256)
+    tolerance_file = Setting("lens_tolerance.csv")
+    tolerance_xc_1 = Setting(0.0)
+    tolerance_xc_2 = Setting(0.0)
+    tolerance_ang_rot_1 = Setting(0.0)
+    tolerance_ang_rot_2 = Setting(0.0)
+    tolerance_wt_offset_ffs_1 = Setting(0.0)
+    tolerance_wt_offset_ffs_2 = Setting(0.0)
+    tolerance_offset_ffs_1 = Setting(0.0)
+    tolerance_offset_ffs_2 = Setting(0.0)
+    tolerance_tilt_ffs_1 = Setting(0.0)
+    tolerance_tilt_ffs_2 = Setting(0.0)
+    tolerance_wt_offset_bfs_1 = Setting(0.0)
+    tolerance_wt_offset_bfs_2 = Setting(0.0)
+    tolerance_offset_bfs_1 = Setting(0.0)
+    tolerance_offset_bfs_2 = Setting(0.0)
+    tolerance_tilt_bfs_1 = Setting(0.0)
+    tolerance_tilt_bfs_2 = Setting(0.0)
+
     image2_path = os.path.join(resources.package_dirname("orangecontrib.wofry.widgets.gui"), "misc", "Refractor_misalignments.png")
 
     input_data = None
+    dabam_profile = None
+    dabam_profile_name = None
 
     def __init__(self):
+        self.profile_cache = ProfileCache() # profile and interpolators, reused in scans
+
         super().__init__(is_automatic=True, show_view_options=True, show_script_tab=True)
 
     def draw_specific_box(self):
@@ -181,6 +215,9 @@ class OWWORealLens1D(OWWOOpticalElement1D):
         gui.button(file_box_id, self, "...", callback=self.set_error_file)
         self.error_file_id.setToolTip("error_file")
 
+        gui.comboBox(self.error_profile, self, "save_dabam_profile", label="Received DABAM profile",
+                     items=["Keep in memory", "Save to file (.npy)"], sendSelectedValue=False, orientation="horizontal")
+
         gui.comboBox(self.error_profile, self, "error_edge_management", label="Manage edges",
                      items=["Extrapolate deformation profile", "Crop beam to deformation profile dimension"],
                      callback=self.set_visible,
@@ -252,6 +289,41 @@ class OWWORealLens1D(OWWOOpticalElement1D):
         label2.setPixmap(QPixmap(self.image2_path))
         self.figure_box2.layout().addWidget(label2)
 
+        #
+        # Tab tolerance sweep
+        #
+        self.tab_tol = oasysgui.createTabPage(self.tabs_setting, "Tolerance")
+
+        box_tolerance = oasysgui.widgetBox(self.tab_tol, "Misalignments sweep (only for parabolic shape)", addSpace=False, orientation="vertical")
+
+        gui.comboBox(box_tolerance, self, "tolerance_sampling", label="Sampling", labelWidth=250,
+                     items=["Grid (min, max)", "Uniform random (min, max)", "Gaussian random (mean, sigma)"],
+                     sendSelectedValue=False, orientation="horizontal", callback=self.set_visible)
+
+        self.box_tolerance_points_id = oasysgui.widgetBox(box_tolerance, "", addSpace=False, orientation="vertical")
+        oasysgui.lineEdit(self.box_tolerance_points_id, self, "tolerance_points", "Points per parameter (min != max)",
+                          labelWidth=300, valueType=int, orientation="horizontal")
+
+        self.box_tolerance_cases_id = oasysgui.widgetBox(box_tolerance, "", addSpace=False, orientation="vertical")
+        oasysgui.lineEdit(self.box_tolerance_cases_id, self, "tolerance_cases", "Number of cases",
+                          labelWidth=300, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(self.box_tolerance_cases_id, self, "tolerance_seed", "Random seed (0: random)",
+                          labelWidth=300, valueType=int, orientation="horizontal")
+
+        for name, units in zip(LENS_MISALIGNMENT_PARAMETERS, ["m", "rad", "m", "m", "rad", "m", "m", "rad"]):
+            box = oasysgui.widgetBox(box_tolerance, "", addSpace=False, orientation="horizontal")
+            oasysgui.lineEdit(box, self, "tolerance_" + name + "_1", "%s [%s]" % (name, units),
+                              labelWidth=130, valueType=float, orientation="horizontal")
+            oasysgui.lineEdit(box, self, "tolerance_" + name + "_2", "",
+                              valueType=float, orientation="horizontal")
+
+        oasysgui.lineEdit(box_tolerance, self, "tolerance_batch_size", "Cases propagated together",
+                          labelWidth=300, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(box_tolerance, self, "tolerance_file", "Results file (.csv)",
+                          labelWidth=150, valueType=str, orientation="horizontal")
+
+        gui.button(box_tolerance, self, "Run Tolerance Sweep", callback=self.run_tolerance_sweep)
+
         self.set_visible()
 
     def get_material_name(self, index=None):
@@ -279,6 +351,8 @@ class OWWORealLens1D(OWWOOpticalElement1D):
         self.box_offset_bfs_id.setVisible(self.mis_flag in [1] and self.shape in [1])
         self.box_tilt_bfs_id.setVisible(self.mis_flag in [1] and self.shape in [1])
         self.figure_box2.setVisible(self.mis_flag in [1] and self.shape in [1])
+        self.box_tolerance_points_id.setVisible(self.tolerance_sampling == 0)
+        self.box_tolerance_cases_id.setVisible(self.tolerance_sampling != 0)
 
     def set_error_file(self):
         self.error_file_id.setText(oasysgui.selectFileFromDialog(self, self.error_file, "Open file with profile error"))
@@ -291,7 +365,9 @@ class OWWORealLens1D(OWWOOpticalElement1D):
         self.n_lenses = congruence.checkStrictlyPositiveNumber(self.n_lenses, "Number of Lenses")
         self.refraction_index_delta = congruence.checkNumber(self.refraction_index_delta, "Refraction index delta")
         self.att_coefficient = congruence.checkNumber(self.att_coefficient, "Attenuation coefficient")
-        self.error_file = congruence.checkFileName(self.error_file)
+        if not self.error_file == self.dabam_profile_name:
+            check_in_memory_profile_name(self.error_file)
+            self.error_file = congruence.checkFileName(self.error_file)
         self.n_lenses = congruence.checkNumber(self.n_lenses, "Number of lenses")
 
         self.xc = congruence.checkNumber(self.xc, "xc")
@@ -330,15 +406,17 @@ class OWWORealLens1D(OWWOOpticalElement1D):
     def receive_dabam_profile(self, dabam_profile):
         if not dabam_profile is None:
             try:
-                file_name = "dabam_profile_" + str(id(self)) + ".dat"
-
-                file = open(file_name, "w")
+                self.dabam_profile = numpy.array(dabam_profile, dtype=float)
+                self.profile_cache.clear()
 
-                for element in dabam_profile:
-                    file.write(str(element[0]) + " " + str(element[1]) + "\n")
+                # kept in memory, the file name is a label (saved only if asked, as binary .npy)
+                if self.save_dabam_profile == 1:
+                    file_name = "dabam_profile_" + str(id(self)) + ".npy"
+                    save_profile(file_name, self.dabam_profile)
+                else:
+                    file_name = get_in_memory_profile_name(self)
 
-                file.flush()
-                file.close()
+                self.dabam_profile_name = file_name
 
                 self.error_flag = 1
                 self.error_file = file_name
@@ -349,8 +427,106 @@ class OWWORealLens1D(OWWOOpticalElement1D):
 
                 if self.IS_DEVELOP: raise exception
 
+    def get_tolerance_cases(self):
+        ranges = {name: (getattr(self, "tolerance_" + name + "_1"), getattr(self, "tolerance_" + name + "_2")) for name in LENS_MISALIGNMENT_PARAMETERS}
+
+        return get_sweep_cases(ranges,
+                               sampling=SAMPLINGS[self.tolerance_sampling],
+                               number_of_points=self.tolerance_points,
+                               number_of_cases=self.tolerance_cases,
+                               seed=None if self.tolerance_seed == 0 else self.tolerance_seed)
+
+    def check_tolerance_fields(self):
+        if not self.shape == 1 or self.number_of_curved_surfaces == 0: raise Exception("Misalignments are only available for parabolic lenses")
+
+        if self.tolerance_sampling == 0:
+            self.tolerance_points = congruence.checkStrictlyPositiveNumber(self.tolerance_points, "Points per parameter")
+        else:
+            self.tolerance_cases = congruence.checkStrictlyPositiveNumber(self.tolerance_cases, "Number of cases")
+            self.tolerance_seed = congruence.checkPositiveNumber(self.tolerance_seed, "Random seed")
+        self.tolerance_batch_size = congruence.checkStrictlyPositiveNumber(self.tolerance_batch_size, "Cases propagated together")
+
+        for name in LENS_MISALIGNMENT_PARAMETERS:
+            congruence.checkNumber(getattr(self, "tolerance_" + name + "_1"), name)
+            congruence.checkNumber(getattr(self, "tolerance_" + name + "_2"), name)
+
+        self.tolerance_file = congruence.checkFileName(self.tolerance_file)
+
+    # all the misalignment cases are applied to the wavefront at the lens and propagated together to q
+    def run_tolerance_sweep(self):
+        self.progressBarInit()
+
+        self.wofry_output.setText("")
+
+        sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+
+        try:
+            if self.input_data is None: raise Exception("No Input Data")
+
+            self.check_data()
+            self.check_tolerance_fields()
+
+            cases = self.get_tolerance_cases()
+            lens  = self.get_optical_element()
+
+            input_wavefront = self.input_data.get_wavefront()
+
+            propagation_parameters = PropagationParameters(wavefront=input_wavefront, propagation_elements=PropagationElements())
+            self.set_additional_parameters(propagation_parameters)
+
+            additional_parameters = propagation_parameters._additional_parameters
+            handler_name          = self.get_handler_name()
+            local_propagator      = self.get_local_propagator(batch=True)
+
+            print("Tolerance sweep: %d cases" % get_number_of_cases(cases))
+
+            def progress(fraction):
+                check_task_cancelled()
+                set_task_progress(20 + 60 * fraction)
+
+            def sweep():
+                # the propagation to the lens is the same for all the cases
+                wavefront_on_lens = propagate_batch(input_wavefront.get_abscissas(),
+                                                    numpy.array([input_wavefront.get_complex_amplitude()]),
+                                                    input_wavefront.get_wavelength(),
+                                                    self.p,
+                                                    handler_name,
+                                                    additional_parameters=additional_parameters,
+                                                    local_propagator=local_propagator).get_mode_wavefront(0)
+
+                return run_lens_tolerance_sweep(lens, wavefront_on_lens, cases,
+                                                q=self.q,
+                                                handler_name=handler_name,
+                                                additional_parameters=additional_parameters,
+                                                local_propagator=local_propagator,
+                                                batch_size=self.tolerance_batch_size,
+                                                callback=progress)
+
+            if self.propagate_in_background == 1:
+                self.start_background_task(sweep,
+                                           on_completed=lambda output: self.tolerance_sweep_completed(cases, *output),
+                                           on_failed=self.propagation_failed)
+            else:
+                self.tolerance_sweep_completed(cases, *sweep())
+        except Exception as exception:
+            self.propagation_failed(exception)
+
+    def tolerance_sweep_completed(self, cases, statistics, reference_wavefront):
+        try:
+            save_sweep_results(self.tolerance_file, cases, statistics)
+
+            print("\n\n\n ==========  tolerance sweep (Strehl ratio relative to the aligned lens): ")
+            print(get_sweep_summary(statistics))
+            print("File %s written to disk." % self.tolerance_file)
+
+            self.progressBarFinished()
+        except Exception as exception:
+            self.propagation_failed(exception)
+
     def get_optical_element(self):
-        return WOLens1D.create_from_keywords(
+        return WOLens1DWithProfile.create_from_keywords(
+                    profile                      = self.dabam_profile if (self.error_flag == 1 and self.error_file == self.dabam_profile_name) else None,
+                    profile_cache                = self.profile_cache,
                     name                         =self.oe_name,
                     shape                        = self.shape,
                     radius                       = self.radius,
@@ -7,7 +7,7 @@ from oasys.util.oasys_util import write_surface_file
 
 from syned.beamline.optical_elements.refractors.lens import Lens
 
-from wofryimpl.beamline.optical_elements.refractors.lens import WOLens
+from orangecontrib.wofry.util.wofry_transmission import WOLensWithCache, get_transmission_cache
 from orangecontrib.wofry.widgets.gui.ow_optical_element import OWWOOpticalElement
 
 
@@ -42,6 +42,9 @@ class OWWORealLens2D(OWWOOpticalElement):
     write_profile = Setting("lens_profile_2D.h5")
 
     def __init__(self):
+        # thickness and transmission of the lens, reused while its parameters and the wavefront grid are unchanged
+        self.transmission_cache = get_transmission_cache()
+
         super().__init__(is_automatic=True, show_view_options=True, show_script_tab=True)
 
     def set_visible(self):
@@ -131,7 +134,8 @@ class OWWORealLens2D(OWWOOpticalElement):
 
     def get_optical_element(self):
 
-        return WOLens.create_from_keywords(
+        return WOLensWithCache.create_from_keywords(
+            transmission_cache=self.transmission_cache,
             name=self.name,
             number_of_curved_surfaces=self.number_of_curved_surfaces,
             two_d_lens=self.two_d_lens,
@@ -13,9 +13,9 @@ from oasys.util.oasys_util import TriggerIn, TriggerOut, EmittingStream
 from syned.widget.widget_decorator import WidgetDecorator
 
 from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_profiles import save_profile, get_in_memory_profile_name, check_in_memory_profile_name, ProfileCache, WOThinObject1DWithProfile
 
 from orangecontrib.wofry.widgets.gui.ow_optical_element_1d import OWWOOpticalElement1D
-from wofryimpl.beamline.optical_elements.refractors.thin_object import WOThinObject1D #TODO from wofryimpl....
 
 
 
@@ -44,8 +44,13 @@ class OWWOThinObject1D(OWWOOpticalElement1D):
     write_profile = Setting("thin_object_profile_2D.h5")
 
     file_with_thickness_mesh = Setting("<none>")
+    save_dabam_profile = Setting(1)
+
+    dabam_profile = None
+    dabam_profile_name = None
 
     def __init__(self):
+        self.profile_cache = ProfileCache() # profile and interpolators, reused in scans
 
         super().__init__(is_automatic=True, show_view_options=True, show_script_tab=True)
 
@@ -77,6 +82,9 @@ class OWWOThinObject1D(OWWOOpticalElement1D):
                                                    labelWidth=90, valueType=str, orientation="horizontal")
         gui.button(filein_box, self, "...", callback=self.selectFile)
 
+        gui.comboBox(self.thinobject_box, self, "save_dabam_profile", label="Received DABAM profile",
+                     items=["Keep in memory", "Save to file (.npy)"], sendSelectedValue=False, orientation="horizontal")
+
 
         self.set_visible()
 
@@ -100,7 +108,9 @@ class OWWOThinObject1D(OWWOOpticalElement1D):
 
     def get_optical_element(self):
 
-        return WOThinObject1D(name=self.oe_name,
+        return WOThinObject1DWithProfile(profile=self.dabam_profile if self.file_with_thickness_mesh == self.dabam_profile_name else None,
+                    profile_cache=self.profile_cache,
+                    name=self.oe_name,
                     file_with_thickness_mesh=self.file_with_thickness_mesh,
                     material=self.get_material_name(self.material),
                     refraction_index_delta=self.refraction_index_delta,
@@ -108,7 +118,9 @@ class OWWOThinObject1D(OWWOOpticalElement1D):
 
     def check_data(self):
         super().check_data()
-        congruence.checkFileName(self.file_with_thickness_mesh)
+        if not self.file_with_thickness_mesh == self.dabam_profile_name:
+            check_in_memory_profile_name(self.file_with_thickness_mesh)
+            congruence.checkFileName(self.file_with_thickness_mesh)
 
     def receive_specific_syned_data(self, optical_element):
         pass
@@ -116,15 +128,17 @@ class OWWOThinObject1D(OWWOOpticalElement1D):
     def receive_dabam_profile(self, dabam_profile):
         if not dabam_profile is None:
             try:
-                file_name = "dabam_profile_" + str(id(self)) + ".dat"
+                self.dabam_profile = numpy.array(dabam_profile, dtype=float)
+                self.profile_cache.clear()
 
-                file = open(file_name, "w")
-
-                for element in dabam_profile:
-                    file.write(str(element[0]) + " " + str(element[1]) + "\n")
+                # kept in memory, the file name is a label (saved only if asked, as binary .npy)
+                if self.save_dabam_profile == 1:
+                    file_name = "dabam_profile_" + str(id(self)) + ".npy"
+                    save_profile(file_name, self.dabam_profile)
+                else:
+                    file_name = get_in_memory_profile_name(self)
 
-                file.flush()
-                file.close()
+                self.dabam_profile_name = file_name
 
                 self.file_with_thickness_mesh = file_name
 
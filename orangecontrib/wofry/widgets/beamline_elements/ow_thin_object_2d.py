@@ -11,7 +11,7 @@ from syned.widget.widget_decorator import WidgetDecorator
 from orangecontrib.wofry.util.wofry_objects import WofryData
 from orangecontrib.wofry.widgets.gui.ow_optical_element import OWWOOpticalElement
 
-from wofryimpl.beamline.optical_elements.refractors.thin_object import WOThinObject
+from orangecontrib.wofry.util.wofry_transmission import WOThinObjectWithCache, get_transmission_cache
 
 class OWWOThinObject2D(OWWOOpticalElement):
 
@@ -38,6 +38,8 @@ class OWWOThinObject2D(OWWOOpticalElement):
     file_with_thickness_mesh = Setting("<none>")
 
     def __init__(self):
+        # thickness (read and interpolated from the file) and transmission, reused while the file and the parameters are unchanged
+        self.transmission_cache = get_transmission_cache()
 
         super().__init__(is_automatic=True, show_view_options=True, show_script_tab=True)
 
@@ -93,7 +95,8 @@ class OWWOThinObject2D(OWWOOpticalElement):
 
     def get_optical_element(self):
 
-        return WOThinObject(name=self.name,
+        return WOThinObjectWithCache(transmission_cache=self.transmission_cache,
+                    name=self.name,
                     file_with_thickness_mesh=self.file_with_thickness_mesh,
                     material=self.get_material_name(self.material),
                     refraction_index_delta=self.refraction_index_delta,
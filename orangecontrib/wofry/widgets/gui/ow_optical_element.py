@@ -26,7 +26,11 @@ from wofryimpl.propagator.propagators2D.fraunhofer import Fraunhofer2D
 from wofryimpl.propagator.propagators2D.integral import Integral2D
 from wofryimpl.propagator.propagators2D.fresnel_zoom_xy import FresnelZoomXY2D
 
-from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_util import check_task_cancelled
+from orangecontrib.wofry.util.wofry_objects import WofryData, WofryModeStack2D
+from orangecontrib.wofry.util.wofry_propagators import PropagatorCache, CachedFresnel2D, CachedFresnelZoomXY2D, FFT_BACKENDS, is_fft_backend_available, \
+    set_local_propagators_in_python_code
+from orangecontrib.wofry.util.wofry_propagators import is_separable_propagation, propagate_mode_stack_2D_separable
 from orangecontrib.wofry.widgets.gui.ow_wofry_widget import WofryWidget
 
 try:
@@ -68,6 +72,7 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
     wavefront_to_plot = None
 
     propagators_list = ["Fresnel", "Fresnel (Convolution)", "Fraunhofer", "Integral", "Fresnel Zoom XY"]
+    fft_backends_list = ["numpy", "scipy.fft", "pyFFTW"]
 
     propagator = Setting(4)
     shift_half_pixel = Setting(1)
@@ -77,7 +82,18 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
     magnification_x = Setting(1.0)
     magnification_y = Setting(1.0)
 
+    use_propagator_cache = Setting(1)
+    propagator_cache_size = Setting(256.0)
+    fft_backend = Setting(0)
+    fft_workers = Setting(-1)
+
+    propagate_in_background = Setting(1)
+
+    separable_propagation = Setting(1)
+
     def __init__(self, is_automatic=True, show_view_options=True, show_script_tab=True):
+        self.propagator_cache = PropagatorCache(self.propagator_cache_size)
+
         super().__init__(is_automatic=is_automatic, show_view_options=show_view_options, show_script_tab=show_script_tab)
 
         self.runaction = widget.OWAction("Propagate Wavefront", self)
@@ -173,6 +189,41 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
         oasysgui.lineEdit(self.zoom_box, self, "magnification_y", "Magnification Y",
                           labelWidth=260, valueType=float, orientation="horizontal")
 
+        # kernels cache (Fresnel and Fresnel Zoom XY)
+        self.cache_box = oasysgui.widgetBox(self.tab_pro, "", addSpace=False, orientation="vertical", height=60)
+
+        gui.comboBox(self.cache_box, self, "use_propagator_cache", label="Cache Propagation Kernels", labelWidth=260,
+                     items=["No", "Yes"],
+                     callback=self.set_PropagatorCache,
+                     sendSelectedValue=False, orientation="horizontal")
+
+        self.cache_box_1 = oasysgui.widgetBox(self.cache_box, "", addSpace=False, orientation="vertical")
+
+        oasysgui.lineEdit(self.cache_box_1, self, "propagator_cache_size", "Cache Size Limit [MB]",
+                          labelWidth=260, valueType=float, orientation="horizontal")
+
+        # FFT backend (Fresnel and Fresnel Zoom XY)
+        self.fft_box = oasysgui.widgetBox(self.tab_pro, "", addSpace=False, orientation="vertical", height=60)
+
+        gui.comboBox(self.fft_box, self, "fft_backend", label="FFT Backend", labelWidth=260,
+                     items=self.fft_backends_list,
+                     callback=self.set_FFTBackend,
+                     sendSelectedValue=False, orientation="horizontal")
+
+        self.fft_box_1 = oasysgui.widgetBox(self.fft_box, "", addSpace=False, orientation="vertical")
+
+        oasysgui.lineEdit(self.fft_box_1, self, "fft_workers", "FFT Threads (-1 = all cores)",
+                          labelWidth=260, valueType=int, orientation="horizontal")
+
+        gui.comboBox(self.tab_pro, self, "separable_propagation", label="Separable propagation (if possible)", labelWidth=260,
+                     items=["No", "Yes"],
+                     tooltip="With Fresnel or Fresnel Zoom XY, separable wavefronts through separable o.e. are propagated as x and y factors (1D FFTs, same backend)",
+                     sendSelectedValue=False, orientation="horizontal")
+
+        gui.comboBox(self.tab_pro, self, "propagate_in_background", label="Propagate in background", labelWidth=260,
+                     items=["No", "Yes"],
+                     sendSelectedValue=False, orientation="horizontal")
+
         self.set_Propagator()
 
     def set_Propagator(self):
@@ -180,6 +231,34 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
         self.fraunhofer_box.setVisible(self.propagator == 2)
         self.integral_box.setVisible(self.propagator == 3)
         self.zoom_box.setVisible(self.propagator == 4)
+        self.cache_box.setVisible(self.propagator in (0, 4))
+        self.fft_box.setVisible(self.propagator in (0, 4))
+        self.set_PropagatorCache()
+        self.set_FFTBackend()
+
+    def set_PropagatorCache(self):
+        self.cache_box_1.setVisible(self.use_propagator_cache == 1)
+        if self.use_propagator_cache == 0: self.propagator_cache.clear()
+
+    def set_FFTBackend(self):
+        self.fft_box_1.setVisible(self.fft_backend > 0)
+
+    def get_fft_backend_name(self):
+        return FFT_BACKENDS[self.fft_backend]
+
+    # stored in the beamline only for backends other than numpy: scripts with the default one run with wofryimpl only
+    def get_fft_parameters_names(self):
+        return [] if self.fft_backend == 0 else ['fft_backend', 'fft_workers']
+
+    def get_fft_parameters_values(self):
+        return [] if self.fft_backend == 0 else [self.get_fft_backend_name(), self.fft_workers]
+
+    # appended to the status messages of the propagation
+    def get_fft_backend_warning(self):
+        if self.fft_backend > 0 and not is_fft_backend_available(self.get_fft_backend_name()):
+            return " (FFT backend %s not installed: using numpy)" % self.fft_backends_list[self.fft_backend]
+        else:
+            return ""
 
     def draw_specific_box(self):
         # raise NotImplementedError()
@@ -190,6 +269,9 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
         congruence.checkNumber(self.q, "Distance to next Continuation Plane")
         congruence.checkAngle(self.angle_radial, "Incident Angle (to normal)")
         congruence.checkAngle(self.angle_azimuthal, "Rotation along Beam Axis")
+        if self.use_propagator_cache == 1: congruence.checkStrictlyPositiveNumber(self.propagator_cache_size, "Cache Size Limit")
+        if self.fft_backend > 0:
+            if self.fft_workers == 0: raise ValueError("FFT Threads should be different from 0")
 
     def propagate_wavefront(self):
 
@@ -205,7 +287,6 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
 
             # propagation to o.e.
 
-            input_wavefront  = self.input_data.get_wavefront()
             beamline         = self.input_data.get_beamline().duplicate()
 
             optical_element = self.get_optical_element()
@@ -230,8 +311,8 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
                 propagator_info = {
                     "propagator_class_name": "Fresnel2D",
                     "propagator_handler_name": self.get_handler_name(),
-                    "propagator_additional_parameters_names": [],
-                    "propagator_additional_parameters_values": []}
+                    "propagator_additional_parameters_names": self.get_fft_parameters_names(),
+                    "propagator_additional_parameters_values": self.get_fft_parameters_values()}
             elif self.propagator == 1:
                 propagator_info = {
                     "propagator_class_name": "FresnelConvolution2D",
@@ -256,8 +337,8 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
                 propagator_info = {
                     "propagator_class_name": "FresnelZoomXY2D",
                     "propagator_handler_name": self.get_handler_name(),
-                    "propagator_additional_parameters_names": ['shift_half_pixel', 'magnification_x','magnification_y'],
-                    "propagator_additional_parameters_values": [self.shift_half_pixel, self.magnification_x, self.magnification_y]}
+                    "propagator_additional_parameters_names": ['shift_half_pixel', 'magnification_x','magnification_y'] + self.get_fft_parameters_names(),
+                    "propagator_additional_parameters_values": [self.shift_half_pixel, self.magnification_x, self.magnification_y] + self.get_fft_parameters_values()}
 
 
             beamline.append_beamline_element(beamline_element, propagator_info)
@@ -266,31 +347,84 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
             propagation_elements = PropagationElements()
             propagation_elements.add_beamline_element(beamline_element)
 
-            propagation_parameters = PropagationParameters(wavefront=input_wavefront.duplicate(),
-                                                           propagation_elements=propagation_elements)
+            input_data = self.input_data # the wavefront is calculated by the task, if only the mode stack is given
+            input_mode_stack = input_data.get_mode_stack()
+            separable = self.is_separable_propagation(propagation_elements)
+            copy_input = self.p == 0.0
+
+            propagation_parameters = PropagationParameters(wavefront=None, propagation_elements=propagation_elements)
 
             self.set_additional_parameters(propagation_parameters)
 
-            self.setStatusMessage("Begin Propagation")
+            self.setStatusMessage("Begin Propagation" + self.get_fft_backend_warning())
+            self.progressBarSet(20)
+
+            handler_name = self.get_handler_name()
+            local_propagator = self.get_local_propagator(separable=separable)
+
+            def propagate():
+                check_task_cancelled()
+
+                # separable representation of the input: x and y factors are propagated separately, the 2D wavefront
+                # is calculated only when needed
+                mode_stack = None
+                if separable:
+                    if isinstance(input_mode_stack, WofryModeStack2D): mode_stack = input_mode_stack
+                    else: mode_stack = WofryModeStack2D.initialize_from_wavefront(input_data.get_wavefront())
+
+                if not mode_stack is None:
+                    return None, propagate_mode_stack_2D_separable(mode_stack, propagation_parameters, local_propagator)
+
+                # the input wavefront is shared with the upstream widget: propagators always return a new wavefront,
+                # so a private copy is needed only when the optical element is applied directly to the input
+                input_wavefront = input_data.get_wavefront()
+                wavefront_parameters = PropagationParameters(wavefront=input_wavefront.duplicate() if copy_input else input_wavefront,
+                                                             propagation_elements=propagation_elements,
+                                                             **propagation_parameters._additional_parameters)
+
+                if local_propagator is None:
+                    propagator = PropagationManager.Instance()
+
+                    output_wavefront = propagator.do_propagation(propagation_parameters=wavefront_parameters,
+                                                                 handler_name=handler_name)
+                else:
+                    output_wavefront = local_propagator.do_propagation(parameters=wavefront_parameters)
+
+                return output_wavefront, None
+
+            # the heavy part runs in a worker thread: a newer request makes the results of the running one stale
+            if self.propagate_in_background == 1:
+                self.start_background_task(propagate,
+                                           on_completed=lambda output: self.propagation_completed(beamline, *output),
+                                           on_failed=self.propagation_failed)
+            else:
+                self.propagation_completed(beamline, *propagate())
+        except Exception as exception:
+            self.propagation_failed(exception)
 
-            propagator = PropagationManager.Instance()
+    # if the input can be propagated as x and y factors (checked by the task: the input has to be separable too)
+    def is_separable_propagation(self, propagation_elements):
+        return self.separable_propagation == 1 and \
+               is_separable_propagation(propagation_elements, self.get_local_propagator(separable=True))
 
-            output_wavefront = propagator.do_propagation(propagation_parameters=propagation_parameters,
-                                                         handler_name=self.get_handler_name())
+    def propagation_completed(self, beamline, output_wavefront, output_mode_stack=None):
+        try:
+            self.setStatusMessage("Propagation Completed" + self.get_fft_backend_warning())
 
-            self.setStatusMessage("Propagation Completed")
+            if output_wavefront is None and not self.view_type == 0:
+                output_wavefront = output_mode_stack.get_mode_wavefront(0)
 
             self.wavefront_to_plot = output_wavefront
 
-            self.initializeTabs()
+            # the existing canvases are updated in place
             self.do_plot_results()
             self.progressBarFinished()
 
-            self.send("WofryData", WofryData(beamline=beamline, wavefront=output_wavefront))
+            self.send("WofryData", WofryData(beamline=beamline, wavefront=output_wavefront, mode_stack=output_mode_stack))
             self.send("Trigger", TriggerIn(new_object=True))
 
             try:
-                self.wofry_python_script.set_code(beamline.to_python_code())
+                self.wofry_python_script.set_code(set_local_propagators_in_python_code(beamline.to_python_code()))
             except:
                 pass
 
@@ -300,9 +434,14 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
             except:
                 pass
         except Exception as exception:
-            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+            self.propagation_failed(exception)
+
+    def propagation_failed(self, exception):
+        self.progressBarFinished()
 
-            if self.IS_DEVELOP: raise exception
+        QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+        if self.IS_DEVELOP: raise exception
 
     def print_intensities(self):
         input_wavefront = self.input_data.get_wavefront()
@@ -333,7 +472,29 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
         elif self.propagator == 4:
             return FresnelZoomXY2D.HANDLER_NAME
 
+    # propagators of this package (kernels cache, FFT backends), None to use the ones of the PropagationManager
+    # (separable=True: always the local ones, that can propagate separable factors)
+    def get_local_propagator(self, separable=False):
+        if self.use_propagator_cache == 0 and self.fft_backend == 0 and not separable: return None
+
+        if self.use_propagator_cache == 1:
+            self.propagator_cache.set_size_limit(self.propagator_cache_size)
+            cache = self.propagator_cache
+        else:
+            cache = None
+
+        if self.propagator == 0:
+            return CachedFresnel2D(cache)
+        elif self.propagator == 4:
+            return CachedFresnelZoomXY2D(cache)
+        else:
+            return None
+
     def set_additional_parameters(self, propagation_parameters):
+        if self.propagator in (0, 4):
+            propagation_parameters.set_additional_parameters("fft_backend", self.get_fft_backend_name())
+            propagation_parameters.set_additional_parameters("fft_workers", self.fft_workers)
+
         if self.propagator <= 2:
             propagation_parameters.set_additional_parameters("shift_half_pixel", self.shift_half_pixel==1)
         elif self.propagator == 3:
@@ -359,7 +520,7 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
                 raise Exception("Bad input.")
 
             if self.is_automatic_execution:
-                self.propagate_wavefront()
+                self.execute_automatically(self.propagate_wavefront)
 
     def initializeTabs(self):
         size = len(self.tab)
@@ -398,7 +559,10 @@ class OWWOOpticalElement(WofryWidget, WidgetDecorator):
                                  xtitle="Horizontal [$\mu$m] ( %d pixels)"%(self.wavefront_to_plot.get_coordinate_x().size),
                                  ytitle="Vertical [$\mu$m] ( %d pixels)"%(self.wavefront_to_plot.get_coordinate_y().size))
 
-                self.plot_data2D(data2D=self.wavefront_to_plot.get_phase(from_minimum_intensity=0.1),
+                # the phase is calculated only when its tab is shown
+                wavefront = self.wavefront_to_plot
+
+                self.plot_data2D(data2D=lambda: wavefront.get_phase(from_minimum_intensity=0.1),
                              dataX=1e6*self.wavefront_to_plot.get_coordinate_x(),
                              dataY=1e6*self.wavefront_to_plot.get_coordinate_y(),
                              progressBarValue=progressBarValue,
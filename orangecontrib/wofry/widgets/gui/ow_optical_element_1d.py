@@ -1,4 +1,4 @@
-import numpy, sys
+import numpy, os, sys
 
 from PyQt5.QtGui import QPalette, QColor, QFont
 from PyQt5.QtWidgets import QMessageBox
@@ -18,6 +18,7 @@ from syned.beamline.shape import *
 
 from wofry.propagator.propagator import PropagationManager, PropagationElements, PropagationParameters
 from wofryimpl.propagator.propagators1D import initialize_default_propagator_1D
+from wofryimpl.beamline.beamline import WOBeamline
 from wofryimpl.propagator.propagators1D.fresnel import Fresnel1D
 from wofryimpl.propagator.propagators1D.fresnel_convolution import FresnelConvolution1D
 from wofryimpl.propagator.propagators1D.fraunhofer import Fraunhofer1D
@@ -25,7 +26,10 @@ from wofryimpl.propagator.propagators1D.integral import Integral1D
 from wofryimpl.propagator.propagators1D.fresnel_zoom import FresnelZoom1D
 from wofryimpl.propagator.propagators1D.fresnel_zoom_scaling_theorem import FresnelZoomScaling1D
 
+from orangecontrib.wofry.util.wofry_util import check_task_cancelled, set_task_progress
 from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_propagators import PropagatorCache, CachedFresnel1D, CachedFresnelZoom1D, propagate_mode_stack_1D
+from orangecontrib.wofry.util.wofry_monte_carlo import parse_perturbations, sample_perturbations, run_monte_carlo, save_monte_carlo_results
 from orangecontrib.wofry.widgets.gui.ow_wofry_widget import WofryWidget
 
 try:
@@ -75,10 +79,22 @@ class OWWOOpticalElement1D(WofryWidget, WidgetDecorator):
     scaled_R = Setting(1000.0) # For Fresnel Zoom Scaled
     scaled_Rmax = Setting(100.0) # For Fresnel Zoom Scaled
     scaled_N = Setting(100) # For Fresnel Zoom Scaled
+    use_propagator_cache = Setting(1) # For Fresnel & Fresnel Zoom
+    propagator_cache_size = Setting(256.0) # For Fresnel & Fresnel Zoom
+    propagate_in_background = Setting(1)
+
+    # Monte-Carlo perturbations of this element: "name distribution value_1 value_2; ..." (see wofry_monte_carlo)
+    monte_carlo_perturbations = Setting("p gaussian 0.0 0.001; q gaussian 0.0 0.001")
+    monte_carlo_samples = Setting(100)
+    monte_carlo_seed = Setting(1)
+    monte_carlo_workers = Setting(1)
+    monte_carlo_file = Setting("monte_carlo.csv")
 
     wavefront_radius = 1.0
 
     def __init__(self,is_automatic=True, show_view_options=True, show_script_tab=True):
+        self.propagator_cache = PropagatorCache(self.propagator_cache_size)
+
         super().__init__(is_automatic=is_automatic, show_view_options=show_view_options, show_script_tab=show_script_tab)
 
         self.runaction = widget.OWAction("Propagate Wavefront", self)
@@ -132,6 +148,8 @@ class OWWOOpticalElement1D(WofryWidget, WidgetDecorator):
 
         self.create_propagation_setting_tab()
 
+        self.create_monte_carlo_tab()
+
 
     def create_propagation_setting_tab(self):
 
@@ -190,16 +208,57 @@ class OWWOOpticalElement1D(WofryWidget, WidgetDecorator):
         oasysgui.lineEdit(self.zoom_scaled_box_2, self, "scaled_N", "Number of points for guessing curvature",
                           labelWidth=260, valueType=int, orientation="horizontal")
 
+        # kernels cache (Fresnel and Fresnel Zoom)
+        self.cache_box = oasysgui.widgetBox(self.tab_pro, "", addSpace=False, orientation="vertical", height=60)
+
+        gui.comboBox(self.cache_box, self, "use_propagator_cache", label="Cache Propagation Kernels", labelWidth=260,
+                     items=["No", "Yes"],
+                     callback=self.set_PropagatorCache,
+                     sendSelectedValue=False, orientation="horizontal")
+
+        self.cache_box_1 = oasysgui.widgetBox(self.cache_box, "", addSpace=False, orientation="vertical")
+
+        oasysgui.lineEdit(self.cache_box_1, self, "propagator_cache_size", "Cache Size Limit [MB]",
+                          labelWidth=260, valueType=float, orientation="horizontal")
+
+        gui.comboBox(self.tab_pro, self, "propagate_in_background", label="Propagate in background", labelWidth=260,
+                     items=["No", "Yes"],
+                     sendSelectedValue=False, orientation="horizontal")
+
         self.set_Propagator()
 
 
+    def create_monte_carlo_tab(self):
+
+        self.tab_mc = oasysgui.createTabPage(self.tabs_setting, "Monte Carlo")
+
+        box_mc = oasysgui.widgetBox(self.tab_mc, "Random perturbations of this element", addSpace=False, orientation="vertical")
+
+        tmp = oasysgui.lineEdit(box_mc, self, "monte_carlo_perturbations", "Perturbations", labelWidth=100, valueType=str, orientation="horizontal")
+        tmp.setToolTip("name distribution value_1 value_2, separated by ';'\n" +
+                       "name: p, q, parameter of the element or propagator.<name>\n" +
+                       "distribution: gaussian (mean, sigma) or uniform (min, max) of the deviation from the nominal value")
+
+        oasysgui.lineEdit(box_mc, self, "monte_carlo_samples", "Number of samples", labelWidth=260, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(box_mc, self, "monte_carlo_seed", "Random seed", labelWidth=260, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(box_mc, self, "monte_carlo_workers", "Parallel processes", labelWidth=260, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(box_mc, self, "monte_carlo_file", "Results file (.csv)", labelWidth=150, valueType=str, orientation="horizontal")
+
+        gui.button(box_mc, self, "Run Monte Carlo", callback=self.start_monte_carlo)
+
     def set_Propagator(self):
         self.fresnel_box.setVisible(self.propagator <= 1)
         self.fraunhofer_box.setVisible(self.propagator == 2)
         self.integral_box.setVisible(self.propagator == 3)
         self.zoom_box.setVisible(self.propagator == 4)
         self.zoom_scaled_box.setVisible(self.propagator == 5)
+        self.cache_box.setVisible(self.propagator in (0, 4))
         if self.propagator == 5: self.set_ScaledGuess()
+        self.set_PropagatorCache()
+
+    def set_PropagatorCache(self):
+        self.cache_box_1.setVisible(self.use_propagator_cache == 1)
+        if self.use_propagator_cache == 0: self.propagator_cache.clear()
 
     def set_ScaledGuess(self):
         self.zoom_scaled_box_1.setVisible(self.scaled_guess_R==0)
@@ -213,6 +272,69 @@ class OWWOOpticalElement1D(WofryWidget, WidgetDecorator):
         congruence.checkNumber(self.q, "Distance to next Continuation Plane")
         congruence.checkAngle(self.angle_radial, "Incident Angle (to normal)")
         congruence.checkAngle(self.angle_azimuthal, "Rotation along Beam Axis")
+        if self.use_propagator_cache == 1: congruence.checkStrictlyPositiveNumber(self.propagator_cache_size, "Cache Size Limit")
+
+    def get_beamline_element(self):
+        optical_element = self.get_optical_element()
+        optical_element.name = self.oe_name if not self.oe_name is None else self.windowTitle()
+
+        beamline_element = BeamlineElement(optical_element=optical_element,
+                                           coordinates=ElementCoordinates(p=self.p,
+                                                                          q=self.q,
+                                                                          angle_radial=numpy.radians(self.angle_radial),
+                                                                          angle_azimuthal=numpy.radians(self.angle_azimuthal)))
+
+        return beamline_element
+
+    def get_propagator_info(self):
+        #
+        # this will store the propagation parameters in beamline in order to perform the propagation in the script
+        #
+        # 1D
+        # ==
+        #
+        # propagators_list = ["Fresnel",    "Fresnel (Convolution)",  "Fraunhofer",    "Integral",    "Fresnel Zoom",    "Fresnel Zoom Scaled"]
+        # class_name       = ["Fresnel1D",  "FresnelConvolution1D",   "Fraunhofer1D",  "Integral1D",  "FresnelZoom1D",   "FresnelZoomScaling1D"]
+        # handler_name     = ["FRESNEL_1D", "FRESNEL_CONVOLUTION_1D", "FRAUNHOFER_1D", "INTEGRAL_1D", "FRESNEL_ZOOM_1D", "FRESNEL_ZOOM_SCALING_1D"]
+
+        if self.propagator == 0:
+            propagator_info = {
+                "propagator_class_name": "Fresnel",
+                "propagator_handler_name": self.get_handler_name(),
+                "propagator_additional_parameters_names": [],
+                "propagator_additional_parameters_values": []}
+        elif self.propagator == 1:
+            propagator_info = {
+                "propagator_class_name": "FresnelConvolution1D",
+                "propagator_handler_name": self.get_handler_name(),
+                "propagator_additional_parameters_names": [],
+                "propagator_additional_parameters_values": []}
+        elif self.propagator == 2:
+            propagator_info = {
+                "propagator_class_name": "Fraunhofer1D",
+                "propagator_handler_name": self.get_handler_name(),
+                "propagator_additional_parameters_names": [],
+                "propagator_additional_parameters_values": []}
+        elif self.propagator == 3:
+            propagator_info = {
+                "propagator_class_name": "Integral1D",
+                "propagator_handler_name": self.get_handler_name(),
+                "propagator_additional_parameters_names": ['magnification_x', 'magnification_N'],
+                "propagator_additional_parameters_values": [self.magnification_x, self.magnification_N]}
+        elif self.propagator == 4:
+            propagator_info = {
+                "propagator_class_name": "FresnelZoom1D",
+                "propagator_handler_name": self.get_handler_name(),
+                "propagator_additional_parameters_names": ['magnification_x'],
+                "propagator_additional_parameters_values": [self.magnification_x]}
+        elif self.propagator == 5:
+            propagator_info = {
+                "propagator_class_name": "FresnelZoomScaling1D",
+                "propagator_handler_name": self.get_handler_name(),
+                "propagator_additional_parameters_names": ['magnification_x','radius'],
+                "propagator_additional_parameters_values": [self.magnification_x, self.wavefront_radius]}
+
+        return propagator_info
 
     def propagate_wavefront(self):
 
@@ -232,79 +354,70 @@ class OWWOOpticalElement1D(WofryWidget, WidgetDecorator):
             input_wavefront  = self.input_data.get_wavefront()
             beamline         = self.input_data.get_beamline().duplicate()
 
-            optical_element = self.get_optical_element()
-            optical_element.name = self.oe_name if not self.oe_name is None else self.windowTitle()
-
-            beamline_element = BeamlineElement(optical_element=optical_element,
-                                               coordinates=ElementCoordinates(p=self.p,
-                                                                              q=self.q,
-                                                                              angle_radial=numpy.radians(self.angle_radial),
-                                                                              angle_azimuthal=numpy.radians(self.angle_azimuthal)))
-
-            #
-            # this will store the propagation parameters in beamline in order to perform the propagation in the script
-            #
-            # 1D
-            # ==
-            #
-            # propagators_list = ["Fresnel",    "Fresnel (Convolution)",  "Fraunhofer",    "Integral",    "Fresnel Zoom",    "Fresnel Zoom Scaled"]
-            # class_name       = ["Fresnel1D",  "FresnelConvolution1D",   "Fraunhofer1D",  "Integral1D",  "FresnelZoom1D",   "FresnelZoomScaling1D"]
-            # handler_name     = ["FRESNEL_1D", "FRESNEL_CONVOLUTION_1D", "FRAUNHOFER_1D", "INTEGRAL_1D", "FRESNEL_ZOOM_1D", "FRESNEL_ZOOM_SCALING_1D"]
-
-            if self.propagator == 0:
-                propagator_info = {
-                    "propagator_class_name": "Fresnel",
-                    "propagator_handler_name": self.get_handler_name(),
-                    "propagator_additional_parameters_names": [],
-                    "propagator_additional_parameters_values": []}
-            elif self.propagator == 1:
-                propagator_info = {
-                    "propagator_class_name": "FresnelConvolution1D",
-                    "propagator_handler_name": self.get_handler_name(),
-                    "propagator_additional_parameters_names": [],
-                    "propagator_additional_parameters_values": []}
-            elif self.propagator == 2:
-                propagator_info = {
-                    "propagator_class_name": "Fraunhofer1D",
-                    "propagator_handler_name": self.get_handler_name(),
-                    "propagator_additional_parameters_names": [],
-                    "propagator_additional_parameters_values": []}
-            elif self.propagator == 3:
-                propagator_info = {
-                    "propagator_class_name": "Integral1D",
-                    "propagator_handler_name": self.get_handler_name(),
-                    "propagator_additional_parameters_names": ['magnification_x', 'magnification_N'],
-                    "propagator_additional_parameters_values": [self.magnification_x, self.magnification_N]}
-            elif self.propagator == 4:
-                propagator_info = {
-                    "propagator_class_name": "FresnelZoom1D",
-                    "propagator_handler_name": self.get_handler_name(),
-                    "propagator_additional_parameters_names": ['magnification_x'],
-                    "propagator_additional_parameters_values": [self.magnification_x]}
-            elif self.propagator == 5:
-                propagator_info = {
-                    "propagator_class_name": "FresnelZoomScaling1D",
-                    "propagator_handler_name": self.get_handler_name(),
-                    "propagator_additional_parameters_names": ['magnification_x','radius'],
-                    "propagator_additional_parameters_values": [self.magnification_x, self.wavefront_radius]}
+            beamline_element = self.get_beamline_element()
+            propagator_info  = self.get_propagator_info()
 
             beamline.append_beamline_element(beamline_element, propagator_info)
 
             propagation_elements = PropagationElements()
             propagation_elements.add_beamline_element(beamline_element)
 
-            propagation_parameters = PropagationParameters(wavefront=input_wavefront.duplicate(),
+            # the input wavefront is shared with the upstream widget: propagators always return a new wavefront,
+            # so a private copy is needed only when the optical element is applied directly to the input
+            if self.p == 0.0: input_wavefront = input_wavefront.duplicate()
+
+            propagation_parameters = PropagationParameters(wavefront=input_wavefront,
                                                            propagation_elements=propagation_elements)
 
             self.set_additional_parameters(propagation_parameters)
 
             self.setStatusMessage("Begin Propagation")
+            self.progressBarSet(20)
 
-            propagator = PropagationManager.Instance()
+            input_mode_stack = self.input_data.get_mode_stack()
+            handler_name     = self.get_handler_name()
+
+            if not input_mode_stack is None:
+                local_propagator = self.get_local_propagator(batch=True)
+
+                # all the modes are propagated together, the output wavefront is the first one
+                def propagate():
+                    check_task_cancelled()
+
+                    output_mode_stack = propagate_mode_stack_1D(input_mode_stack,
+                                                                propagation_parameters,
+                                                                handler_name=handler_name,
+                                                                local_propagator=local_propagator)
+
+                    return output_mode_stack.get_mode_wavefront(0), output_mode_stack
+            else:
+                local_propagator = self.get_local_propagator()
 
-            output_wavefront = propagator.do_propagation(propagation_parameters=propagation_parameters,
-                                                         handler_name=self.get_handler_name())
+                def propagate():
+                    check_task_cancelled()
 
+                    if local_propagator is None:
+                        propagator = PropagationManager.Instance()
+
+                        output_wavefront = propagator.do_propagation(propagation_parameters=propagation_parameters,
+                                                                     handler_name=handler_name)
+                    else:
+                        output_wavefront = local_propagator.do_propagation(parameters=propagation_parameters)
+
+                    return output_wavefront, None
+
+            # the heavy part runs in a worker thread: a newer request makes the results of the running one stale
+            if self.propagate_in_background == 1:
+                self.start_background_task(propagate,
+                                           on_completed=lambda output: self.propagation_completed(beamline, *output),
+                                           on_failed=self.propagation_failed)
+            else:
+                self.propagation_completed(beamline, *propagate())
+        except Exception as exception:
+            self.propagation_failed(exception)
+
+    def propagation_completed(self, beamline, output_wavefront, output_mode_stack=None):
+        try:
             self.setStatusMessage("Propagation Completed")
 
             self.wavefront_to_plot = output_wavefront
@@ -316,7 +429,7 @@ class OWWOOpticalElement1D(WofryWidget, WidgetDecorator):
             else:
                 self.progressBarFinished()
 
-            self.send("WofryData", WofryData(beamline=beamline, wavefront=output_wavefront))
+            self.send("WofryData", WofryData(beamline=beamline, wavefront=output_wavefront, mode_stack=output_mode_stack))
             self.send("Trigger", TriggerIn(new_object=True))
 
             self.wofry_python_script.set_code(beamline.to_python_code())
@@ -326,9 +439,105 @@ class OWWOOpticalElement1D(WofryWidget, WidgetDecorator):
             try:    self.print_intensities()
             except: pass
         except Exception as exception:
-            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+            self.propagation_failed(exception)
+
+    def propagation_failed(self, exception):
+        self.progressBarFinished()
+
+        QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+        if self.IS_DEVELOP: raise exception
 
-            if self.IS_DEVELOP: raise exception
+    # one-element beamline, starting from the input wavefront: the names are those of wofry_batch, with oe1
+    def get_monte_carlo_beamline(self):
+        beamline = WOBeamline()
+        beamline.append_beamline_element(self.get_beamline_element(), self.get_propagator_info())
+
+        return beamline
+
+    def get_monte_carlo_perturbations(self):
+        return [("oe1." + name, distribution, value_1, value_2) for name, distribution, value_1, value_2 in parse_perturbations(self.monte_carlo_perturbations)]
+
+    def check_monte_carlo_fields(self):
+        self.monte_carlo_samples = congruence.checkStrictlyPositiveNumber(self.monte_carlo_samples, "Number of samples")
+        self.monte_carlo_seed = congruence.checkPositiveNumber(self.monte_carlo_seed, "Random seed")
+        self.monte_carlo_workers = congruence.checkStrictlyPositiveNumber(self.monte_carlo_workers, "Parallel processes")
+        self.monte_carlo_file = congruence.checkFileName(self.monte_carlo_file)
+
+    def start_monte_carlo(self):
+        self.progressBarInit()
+
+        self.wofry_output.setText("")
+
+        sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+
+        try:
+            if self.input_data is None: raise Exception("No Input Data")
+
+            self.check_data()
+            self.check_monte_carlo_fields()
+
+            input_wavefront = self.input_data.get_wavefront()
+
+            # the guessed radius of the scaled propagator is stored in the propagator info
+            self.set_additional_parameters(PropagationParameters(wavefront=input_wavefront, propagation_elements=PropagationElements()))
+
+            beamline = self.get_monte_carlo_beamline()
+            samples  = sample_perturbations(beamline, self.get_monte_carlo_perturbations(), self.monte_carlo_samples, seed=self.monte_carlo_seed)
+
+            workers              = self.monte_carlo_workers
+            use_propagator_cache = self.use_propagator_cache == 1
+
+            print("Monte Carlo: %d samples, %d processes" % (len(samples), workers))
+
+            def monte_carlo():
+                figures_of_merit = [None] * len(samples)
+                statistics = None
+
+                for index, values, statistics in run_monte_carlo(beamline, samples, input_wavefront=input_wavefront,
+                                                                 workers=workers, use_propagator_cache=use_propagator_cache):
+                    check_task_cancelled()
+                    set_task_progress(20 + 60 * (index + 1) / len(samples))
+
+                    if isinstance(values, Exception):
+                        print("sample %d failed: %s" % (index, str(values)))
+                    else:
+                        figures_of_merit[index] = values
+
+                        # running statistics, every 10% of the samples
+                        if statistics.get_number_of_samples() % max(1, len(samples) // 10) == 0: print(statistics.get_summary())
+
+                return figures_of_merit, statistics
+
+            if self.propagate_in_background == 1:
+                self.start_background_task(monte_carlo,
+                                           on_completed=lambda output: self.monte_carlo_completed(samples, *output),
+                                           on_failed=self.propagation_failed)
+            else:
+                self.monte_carlo_completed(samples, *monte_carlo())
+        except Exception as exception:
+            self.propagation_failed(exception)
+
+    def monte_carlo_completed(self, samples, figures_of_merit, statistics):
+        try:
+            save_monte_carlo_results(self.monte_carlo_file, samples, figures_of_merit)
+            print("File %s written to disk." % self.monte_carlo_file)
+
+            if not statistics is None and statistics.get_number_of_samples() > 0:
+                intensity_file = os.path.splitext(self.monte_carlo_file)[0] + "_intensity.dat"
+
+                numpy.savetxt(intensity_file, numpy.column_stack((statistics.get_abscissas(),
+                                                                  statistics.get_intensity().get_mean(),
+                                                                  statistics.get_intensity().get_standard_deviation())),
+                              header="abscissas[m] mean_intensity std_intensity")
+                print("File %s written to disk." % intensity_file)
+
+                print("\n\n\n ==========  Monte Carlo (Strehl ratio relative to the nominal element): ")
+                print(statistics.get_summary())
+
+            self.progressBarFinished()
+        except Exception as exception:
+            self.propagation_failed(exception)
 
     def print_intensities(self):
         input_wavefront = self.input_data.get_wavefront()
@@ -361,6 +570,24 @@ class OWWOOpticalElement1D(WofryWidget, WidgetDecorator):
         elif self.propagator == 5:
             return FresnelZoomScaling1D.HANDLER_NAME
 
+    # propagators of this package (kernels cache), None to use the ones of the PropagationManager
+    # with batch=True the propagator is returned also without cache, to propagate the mode stacks in one go
+    def get_local_propagator(self, batch=False):
+        if self.use_propagator_cache == 0 and not batch: return None
+
+        if self.use_propagator_cache == 0:
+            cache = None
+        else:
+            cache = self.propagator_cache
+            cache.set_size_limit(self.propagator_cache_size)
+
+        if self.propagator == 0:
+            return CachedFresnel1D(cache)
+        elif self.propagator == 4:
+            return CachedFresnelZoom1D(cache)
+        else:
+            return None
+
     def set_additional_parameters(self, propagation_parameters):
         if self.propagator <= 2:
             pass
@@ -394,7 +621,7 @@ class OWWOOpticalElement1D(WofryWidget, WidgetDecorator):
                 raise Exception("Only wofry_data allowed as input")
 
             if self.is_automatic_execution:
-                self.propagate_wavefront()
+                self.execute_automatically(self.propagate_wavefront)
 
     def get_titles(self):
         return ["Wavefront 1D Intensity",
@@ -2,7 +2,7 @@ import numpy
 
 from PyQt5 import QtWidgets
 from PyQt5.QtWidgets import QMessageBox, QApplication
-from PyQt5.QtCore import QRect
+from PyQt5.QtCore import QRect, QTimer
 from PyQt5.QtGui import QTextCursor
 
 from orangewidget import gui
@@ -11,8 +11,8 @@ from oasys.widgets import gui as oasysgui
 
 from oasys.widgets.widget import AutomaticWidget
 
-from silx.gui.plot import Plot2D
-from orangecontrib.wofry.util.wofry_util import ImageViewWithFWHM
+from silx.gui.plot import Plot2D, PlotWindow
+from orangecontrib.wofry.util.wofry_util import ImageViewWithFWHM, WorkerThread, TaskCancelled, DecimatedImage
 
 from orangecontrib.wofry.widgets.gui.python_script import PythonScript
 
@@ -25,16 +25,27 @@ class WofryWidget(AutomaticWidget):
     IMAGE_HEIGHT = 545
     MAX_WIDTH = 1320
     MAX_HEIGHT = 705
+    MAX_DISPLAY_PIXELS = 1024
     CONTROL_AREA_WIDTH = 410
     TABS_AREA_HEIGHT = 545
 
     want_main_area = 1
 
     view_type=Setting(1)
+    automatic_execution_delay=Setting(0)
 
     def __init__(self, is_automatic=True, show_view_options=True, show_script_tab=True):
         super().__init__(is_automatic)
 
+        self.__last_task_id = 0
+        self.__task_thread  = None
+        self.__pending_task = None
+
+        self.__automatic_execution_function = None
+        self.__automatic_execution_timer = QTimer(self)
+        self.__automatic_execution_timer.setSingleShot(True)
+        self.__automatic_execution_timer.timeout.connect(self.__run_automatic_execution)
+
         geom = QApplication.desktop().availableGeometry()
         self.setGeometry(QRect(round(geom.width()*0.05),
                                round(geom.height()*0.05),
@@ -67,12 +78,20 @@ class WofryWidget(AutomaticWidget):
                                                 labelWidth=220,
                                                 items=["No", "Yes (image)","Yes (image + hist.)"],
                                                 callback=self.set_ViewType, sendSelectedValue=False, orientation="horizontal")
+
+            if is_automatic:
+                oasysgui.lineEdit(view_box_1, self, "automatic_execution_delay", "Automatic execution delay [ms]",
+                                  labelWidth=220, valueType=int, orientation="horizontal")
         else:
             self.view_type = 1
 
         self.tab = []
         self.tabs = oasysgui.tabWidget(plot_tab)
 
+        self.__deferred_plots = {}
+        self.__decimated_images = {}
+        self.tabs.currentChanged.connect(self.__tab_changed)
+
         self.initializeTabs()
 
         self.set_ViewType()
@@ -85,6 +104,72 @@ class WofryWidget(AutomaticWidget):
         gui.rubber(self.mainArea)
 
 
+    #
+    # automatic execution: inputs arriving within automatic_execution_delay from the previous one restart the wait, so a
+    # burst of upstream updates triggers a single execution with the newest data
+    #
+    def execute_automatically(self, function):
+        if self.automatic_execution_delay <= 0:
+            function()
+        else:
+            self.__automatic_execution_function = function
+            self.__automatic_execution_timer.start(int(self.automatic_execution_delay))
+
+    def __run_automatic_execution(self):
+        function, self.__automatic_execution_function = self.__automatic_execution_function, None
+
+        if not function is None: function()
+
+    #
+    # background tasks: one at a time, while running only the last requested task is kept waiting and the running one
+    # is cancelled (it stops at its next check_task_cancelled); only the results of the last requested task are
+    # delivered, the others are stale and discarded
+    #
+    def start_background_task(self, task, on_completed, on_failed=None):
+        self.__last_task_id += 1
+        self.__pending_task = (self.__last_task_id, task, on_completed, on_failed)
+
+        if self.__task_thread is None: self.__start_pending_task()
+        else: self.__task_thread.cancel()
+
+    def is_background_task_running(self):
+        return not self.__task_thread is None
+
+    def __start_pending_task(self):
+        task_id, task, on_completed, on_failed = self.__pending_task
+        self.__pending_task = None
+
+        def task_completed(id, result):
+            if id == self.__last_task_id: on_completed(result)
+
+        def task_failed(id, exception):
+            if id == self.__last_task_id and not on_failed is None and not isinstance(exception, TaskCancelled): on_failed(exception)
+
+        def task_progress(id, value):
+            if id == self.__last_task_id: self.progressBarSet(value)
+
+        self.__task_thread = WorkerThread(task_id, task)
+        self.__task_thread.task_completed.connect(task_completed)
+        self.__task_thread.task_failed.connect(task_failed)
+        self.__task_thread.task_progress.connect(task_progress)
+        self.__task_thread.finished.connect(self.__task_finished)
+        self.__task_thread.start()
+
+    def __task_finished(self):
+        self.__task_thread.wait() # finished is emitted just before the thread really ends
+        self.__task_thread = None
+
+        if not self.__pending_task is None: self.__start_pending_task()
+
+    def onDeleteWidget(self):
+        self.__automatic_execution_timer.stop()
+        self.__pending_task = None
+        if not self.__task_thread is None:
+            self.__task_thread.cancel()
+            self.__task_thread.wait()
+
+        super().onDeleteWidget()
+
     def initializeTabs(self):
         raise NotImplementedError()
 
@@ -120,27 +205,33 @@ class WofryWidget(AutomaticWidget):
         if tabs_canvas_index is None: tabs_canvas_index = 0 #back compatibility?
 
 
-        self.tab[tabs_canvas_index].layout().removeItem(self.tab[tabs_canvas_index].layout().itemAt(0))
-
-        self.plot_canvas[plot_canvas_index] = oasysgui.plotWindow(parent=None,
-                                                                  backend=None,
-                                                                  resetzoom=True,
-                                                                  autoScale=False,
-                                                                  logScale=True,
-                                                                  grid=True,
-                                                                  curveStyle=True,
-                                                                  colormap=False,
-                                                                  aspectRatio=False,
-                                                                  yInverted=False,
-                                                                  copy=True,
-                                                                  save=True,
-                                                                  print_=True,
-                                                                  control=control,
-                                                                  position=True,
-                                                                  roi=False,
-                                                                  mask=False,
-                                                                  fit=False)
+        canvas_to_update = self.get_canvas_to_update(tabs_canvas_index, plot_canvas_index, PlotWindow, excluded_type=Plot2D)
 
+        if not canvas_to_update is None:
+            canvas_to_update.clear()
+        else:
+            self.remove_canvas(tabs_canvas_index)
+
+            self.plot_canvas[plot_canvas_index] = oasysgui.plotWindow(parent=None,
+                                                                      backend=None,
+                                                                      resetzoom=True,
+                                                                      autoScale=False,
+                                                                      logScale=True,
+                                                                      grid=True,
+                                                                      curveStyle=True,
+                                                                      colormap=False,
+                                                                      aspectRatio=False,
+                                                                      yInverted=False,
+                                                                      copy=True,
+                                                                      save=True,
+                                                                      print_=True,
+                                                                      control=control,
+                                                                      position=True,
+                                                                      roi=False,
+                                                                      mask=False,
+                                                                      fit=False)
+
+            self.tab[tabs_canvas_index].layout().addWidget(self.plot_canvas[plot_canvas_index])
 
         self.plot_canvas[plot_canvas_index].setDefaultPlotLines(True)
         self.plot_canvas[plot_canvas_index].setActiveCurveColor(color='blue')
@@ -165,8 +256,6 @@ class WofryWidget(AutomaticWidget):
             except:
                 pass
 
-        self.tab[tabs_canvas_index].layout().addWidget(self.plot_canvas[plot_canvas_index])
-
         WofryWidget.plot_histo(self.plot_canvas[plot_canvas_index], x, y, title, xtitle, ytitle, color, replace, symbol=symbol)
 
         self.plot_canvas[plot_canvas_index].setXAxisLogarithmic(log_x)
@@ -215,35 +304,39 @@ class WofryWidget(AutomaticWidget):
 
         if tabs_canvas_index is None: tabs_canvas_index = 0 #back compatibility?
 
-        self.tab[tabs_canvas_index].layout().removeItem(self.tab[tabs_canvas_index].layout().itemAt(0))
-
-        self.plot_canvas[plot_canvas_index] = oasysgui.plotWindow(parent=None,
-                                                                  backend=None,
-                                                                  resetzoom=True,
-                                                                  autoScale=False,
-                                                                  logScale=True,
-                                                                  grid=True,
-                                                                  curveStyle=True,
-                                                                  colormap=False,
-                                                                  aspectRatio=False,
-                                                                  yInverted=False,
-                                                                  copy=True,
-                                                                  save=True,
-                                                                  print_=True,
-                                                                  control=control,
-                                                                  position=True,
-                                                                  roi=False,
-                                                                  mask=False,
-                                                                  fit=False)
+        canvas_to_update = self.get_canvas_to_update(tabs_canvas_index, plot_canvas_index, PlotWindow, excluded_type=Plot2D)
 
+        if not canvas_to_update is None:
+            canvas_to_update.clear()
+        else:
+            self.remove_canvas(tabs_canvas_index)
+
+            self.plot_canvas[plot_canvas_index] = oasysgui.plotWindow(parent=None,
+                                                                      backend=None,
+                                                                      resetzoom=True,
+                                                                      autoScale=False,
+                                                                      logScale=True,
+                                                                      grid=True,
+                                                                      curveStyle=True,
+                                                                      colormap=False,
+                                                                      aspectRatio=False,
+                                                                      yInverted=False,
+                                                                      copy=True,
+                                                                      save=True,
+                                                                      print_=True,
+                                                                      control=control,
+                                                                      position=True,
+                                                                      roi=False,
+                                                                      mask=False,
+                                                                      fit=False)
+
+            self.tab[tabs_canvas_index].layout().addWidget(self.plot_canvas[plot_canvas_index])
 
         self.plot_canvas[plot_canvas_index].setDefaultPlotLines(True)
         self.plot_canvas[plot_canvas_index].setActiveCurveColor(color='blue')
         self.plot_canvas[plot_canvas_index].setGraphXLabel(xtitle)
         self.plot_canvas[plot_canvas_index].setGraphYLabel(ytitle)
 
-        self.tab[tabs_canvas_index].layout().addWidget(self.plot_canvas[plot_canvas_index])
-
 
         for i in range(len(y_list)):
             self.plot_canvas[plot_canvas_index].addCurve(x, y_list[i],
@@ -272,67 +365,139 @@ class WofryWidget(AutomaticWidget):
         self.progressBarSet(progressBarValue)
 
 
+    # data2D can also be a function returning the data, called only when the plot is really done: plots of the tabs
+    # not shown are deferred until the tab is selected (when the progress bar is already finished: they do not use it)
     def plot_data2D(self, data2D, dataX, dataY, progressBarValue, tabs_canvas_index, plot_canvas_index,
                     title="",xtitle="", ytitle=""):
 
         if self.view_type == 0:
             pass
-        elif self.view_type == 1:
-            self.plot_data2D_only_image(data2D, dataX, dataY, progressBarValue, tabs_canvas_index,plot_canvas_index,
-                         title=title, xtitle=xtitle, ytitle=ytitle)
-        elif self.view_type == 2:
-            self.plot_data2D_with_histograms(data2D, dataX, dataY, progressBarValue, tabs_canvas_index,plot_canvas_index,
-                         title=title, xtitle=xtitle, ytitle=ytitle)
+        else:
+            def plot(progressBarValue=None):
+                data = data2D() if callable(data2D) else data2D
+
+                if self.view_type == 1:
+                    self.plot_data2D_only_image(data, dataX, dataY, progressBarValue, tabs_canvas_index,plot_canvas_index,
+                                 title=title, xtitle=xtitle, ytitle=ytitle)
+                elif self.view_type == 2:
+                    self.plot_data2D_with_histograms(data, dataX, dataY, progressBarValue, tabs_canvas_index,plot_canvas_index,
+                                 title=title, xtitle=xtitle, ytitle=ytitle)
+
+            if self.tabs.currentIndex() == tabs_canvas_index:
+                self.__deferred_plots.pop(tabs_canvas_index, None)
+                plot(progressBarValue)
+            else:
+                self.__deferred_plots[tabs_canvas_index] = plot
+                self.progressBarSet(progressBarValue)
+
+    def __tab_changed(self, index):
+        # tabs are also changed while they are rebuilt: the deferred plot runs after, if still needed
+        QTimer.singleShot(0, lambda: self.__run_deferred_plot(index))
+
+    def __run_deferred_plot(self, index):
+        plot = self.__deferred_plots.pop(index, None)
+
+        if not plot is None and self.tabs.currentIndex() == index:
+            try:
+                plot()
+            except Exception as exception:
+                QtWidgets.QMessageBox.critical(self, "Error", str(exception), QtWidgets.QMessageBox.Ok)
+
+                if self.IS_DEVELOP: raise exception
+
+    # the canvas already in the tab, if of the given type, can be updated in place
+    def get_canvas_to_update(self, tabs_canvas_index, plot_canvas_index, canvas_type, excluded_type=None):
+        canvas = self.plot_canvas[plot_canvas_index]
+
+        if canvas is None or not isinstance(canvas, canvas_type): return None
+        if not excluded_type is None and isinstance(canvas, excluded_type): return None
+        if self.tab[tabs_canvas_index].layout().indexOf(canvas) < 0: return None
+
+        return canvas
+
+    def remove_canvas(self, tabs_canvas_index):
+        item = self.tab[tabs_canvas_index].layout().itemAt(0)
+
+        if not item is None:
+            self.tab[tabs_canvas_index].layout().removeItem(item)
+            if not item.widget() is None:
+                self.__decimated_images.pop(item.widget(), None)
+                item.widget().deleteLater()
 
     def plot_data2D_only_image(self, data2D, dataX, dataY, progressBarValue, tabs_canvas_index, plot_canvas_index,
                     title="", xtitle="", ytitle=""):
 
-        self.tab[tabs_canvas_index].layout().removeItem(self.tab[tabs_canvas_index].layout().itemAt(0))
+        # images larger than the screen are shown binned, with the full resolution fetched on zoom
+        decimated_image = DecimatedImage(data2D, dataX, dataY, max_pixels=self.MAX_DISPLAY_PIXELS)
 
-        xmin = dataX[0] # numpy.min(dataX)
-        xmax = dataX[-1] # numpy.max(dataX)
-        ymin = dataY[0] # numpy.min(dataY)
-        ymax = dataY[-1] # numpy.max(dataY)
+        colormap = {"name":"temperature", "normalization":"linear", "autoscale":True, "vmin":0, "vmax":0, "colors":256}
 
-        origin = (xmin, ymin)
-        scale = (abs((xmax-xmin)/len(dataX)), abs((ymax-ymin)/len(dataY)))
+        if self.get_canvas_to_update(tabs_canvas_index, plot_canvas_index, Plot2D) is None:
+            self.remove_canvas(tabs_canvas_index)
 
-        data_to_plot = data2D.T
+            self.plot_canvas[plot_canvas_index] = Plot2D()
 
-        colormap = {"name":"temperature", "normalization":"linear", "autoscale":True, "vmin":0, "vmax":0, "colors":256}
+            self.plot_canvas[plot_canvas_index].resetZoom()
+            self.plot_canvas[plot_canvas_index].setXAxisAutoScale(True)
+            self.plot_canvas[plot_canvas_index].setYAxisAutoScale(True)
+            self.plot_canvas[plot_canvas_index].setGraphGrid(False)
+            self.plot_canvas[plot_canvas_index].setKeepDataAspectRatio(True)
+            self.plot_canvas[plot_canvas_index].yAxisInvertedAction.setVisible(False)
 
-        self.plot_canvas[plot_canvas_index] = Plot2D()
+            self.plot_canvas[plot_canvas_index].setXAxisLogarithmic(False)
+            self.plot_canvas[plot_canvas_index].setYAxisLogarithmic(False)
+            #silx 0.4.0
+            self.plot_canvas[plot_canvas_index].getMaskAction().setVisible(False)
+            self.plot_canvas[plot_canvas_index].getRoiAction().setVisible(False)
+            self.plot_canvas[plot_canvas_index].getColormapAction().setVisible(True)
+            self.plot_canvas[plot_canvas_index].setKeepDataAspectRatio(False)
 
-        self.plot_canvas[plot_canvas_index].resetZoom()
-        self.plot_canvas[plot_canvas_index].setXAxisAutoScale(True)
-        self.plot_canvas[plot_canvas_index].setYAxisAutoScale(True)
-        self.plot_canvas[plot_canvas_index].setGraphGrid(False)
-        self.plot_canvas[plot_canvas_index].setKeepDataAspectRatio(True)
-        self.plot_canvas[plot_canvas_index].yAxisInvertedAction.setVisible(False)
+            self.plot_canvas[plot_canvas_index].sigPlotSignal.connect(
+                lambda event, canvas=self.plot_canvas[plot_canvas_index]: self.__plot_limits_changed(canvas, event))
 
-        self.plot_canvas[plot_canvas_index].setXAxisLogarithmic(False)
-        self.plot_canvas[plot_canvas_index].setYAxisLogarithmic(False)
-        #silx 0.4.0
-        self.plot_canvas[plot_canvas_index].getMaskAction().setVisible(False)
-        self.plot_canvas[plot_canvas_index].getRoiAction().setVisible(False)
-        self.plot_canvas[plot_canvas_index].getColormapAction().setVisible(True)
-        self.plot_canvas[plot_canvas_index].setKeepDataAspectRatio(False)
+            self.tab[tabs_canvas_index].layout().addWidget(self.plot_canvas[plot_canvas_index])
 
-        self.plot_canvas[plot_canvas_index].addImage(numpy.array(data_to_plot),
-                                                     legend="None",
-                                                     scale=scale,
-                                                     origin=origin,
-                                                     colormap=colormap,
-                                                     replace=True)
+        self.__decimated_images[self.plot_canvas[plot_canvas_index]] = [decimated_image, colormap, None]
 
+        self.__add_decimated_image(self.plot_canvas[plot_canvas_index], resetzoom=True)
 
         self.plot_canvas[plot_canvas_index].setGraphXLabel(xtitle)
         self.plot_canvas[plot_canvas_index].setGraphYLabel(ytitle)
         self.plot_canvas[plot_canvas_index].setGraphTitle(title)
 
-        self.tab[tabs_canvas_index].layout().addWidget(self.plot_canvas[plot_canvas_index])
+        if not progressBarValue is None: self.progressBarSet(progressBarValue)
 
-        self.progressBarSet(progressBarValue)
+    def __add_decimated_image(self, canvas, x_range=None, y_range=None, resetzoom=False):
+        decimated_image, colormap, shown = self.__decimated_images[canvas]
+
+        data_to_plot, dataX, dataY, factor = decimated_image.get_image(x_range, y_range)
+
+        if data_to_plot.size == 0 or shown == (factor, dataX[0], dataX[-1], dataY[0], dataY[-1]): return
+
+        full_dataX, full_dataY = decimated_image.get_coordinates()
+
+        pixel_size = (abs((full_dataX[-1]-full_dataX[0])/len(full_dataX)), abs((full_dataY[-1]-full_dataY[0])/len(full_dataY)))
+
+        scale = (pixel_size[0]*factor, pixel_size[1]*factor)
+        origin = (dataX[0] - 0.5*(factor-1)*pixel_size[0], dataY[0] - 0.5*(factor-1)*pixel_size[1])
+
+        # only the binned (or cropped) data is transposed and copied
+        canvas.addImage(numpy.array(data_to_plot.T),
+                        legend="None",
+                        scale=scale,
+                        origin=origin,
+                        colormap=colormap,
+                        replace=True,
+                        resetzoom=resetzoom)
+
+        self.__decimated_images[canvas][2] = (factor, dataX[0], dataX[-1], dataY[0], dataY[-1])
+
+    def __plot_limits_changed(self, canvas, event):
+        if event["event"] == "limitsChanged" and canvas in self.__decimated_images:
+            try:
+                self.__add_decimated_image(canvas, x_range=canvas.getXAxis().getLimits(), y_range=canvas.getYAxis().getLimits())
+            except Exception as exception:
+                if self.IS_DEVELOP: raise exception
 
     def plot_data2D_with_histograms(self, data2D, dataX, dataY, progressBarValue, tabs_canvas_index, plot_canvas_index,
                                     title="", xtitle="", ytitle=""):
@@ -340,21 +505,23 @@ class WofryWidget(AutomaticWidget):
         xum = "H [\u03BCm]"
         yum = "V [\u03BCm]"
 
-        self.tab[tabs_canvas_index].layout().removeItem(self.tab[tabs_canvas_index].layout().itemAt(0))
-
-        data_to_plot = data2D
+        # the image is shown binned to screen resolution, the widths and the total are calculated on the full data
+        data_to_plot, dataX_to_plot, dataY_to_plot, _ = DecimatedImage(data2D, dataX, dataY, max_pixels=self.MAX_DISPLAY_PIXELS).get_image()
 
-        self.plot_canvas[plot_canvas_index] = ImageViewWithFWHM() #Plot2D()
+        if self.get_canvas_to_update(tabs_canvas_index, plot_canvas_index, ImageViewWithFWHM) is None:
+            self.remove_canvas(tabs_canvas_index)
 
-        colormap = {"name":"temperature", "normalization":"linear", "autoscale":True, "vmin":0, "vmax":0, "colors":256}
+            self.plot_canvas[plot_canvas_index] = ImageViewWithFWHM() #Plot2D()
 
-        self.plot_canvas[plot_canvas_index].plot_2D(numpy.array(data_to_plot),dataX,dataY,factor1=1e0,factor2=1e0,
-               title=title,xtitle=xtitle, ytitle=ytitle,xum=xum,yum=yum,colormap=colormap)
+            self.tab[tabs_canvas_index].layout().addWidget(self.plot_canvas[plot_canvas_index])
 
+        colormap = {"name":"temperature", "normalization":"linear", "autoscale":True, "vmin":0, "vmax":0, "colors":256}
 
-        self.tab[tabs_canvas_index].layout().addWidget(self.plot_canvas[plot_canvas_index])
+        self.plot_canvas[plot_canvas_index].plot_2D(numpy.array(data_to_plot),dataX_to_plot,dataY_to_plot,factor1=1e0,factor2=1e0,
+               title=title,xtitle=xtitle, ytitle=ytitle,xum=xum,yum=yum,colormap=colormap,
+               full_data=(data2D, numpy.asarray(dataX), numpy.asarray(dataY)))
 
-        self.progressBarSet(progressBarValue)
+        if not progressBarValue is None: self.progressBarSet(progressBarValue)
 
     @classmethod
     def plot_histo(cls, plot_window, x, y, title, xtitle, ytitle, color='blue', replace=True, symbol=''):
@@ -116,7 +116,7 @@ class GenericWavefrontViewer1D(WofryWidget):
                 self.accumulated_data = {}
                 self.accumulated_data["counter"] = 1
                 self.accumulated_data["intensity"] = self.wofry_data.get_wavefront().get_intensity()
-                self.accumulated_data["complex_amplitude"] = self.wofry_data.get_wavefront().get_complex_amplitude()
+                self.accumulated_data["complex_amplitude"] = self.wofry_data.get_wavefront().get_complex_amplitude().copy()
 
                 self.accumulated_data["x"] = self.wofry_data.get_wavefront().get_abscissas()
 
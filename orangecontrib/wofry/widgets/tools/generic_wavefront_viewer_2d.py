@@ -1,13 +1,16 @@
 __author__ = 'srio'
 
-import numpy
+import os, numpy
 
 from PyQt5.QtGui import QPalette, QColor, QFont
+from PyQt5.QtWidgets import QMessageBox
 from orangewidget import gui
 from orangewidget.settings import Setting
 from oasys.widgets import gui as oasysgui
+from oasys.widgets import congruence
 
 from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_accumulators import WavefrontAccumulator2D
 from orangecontrib.wofry.widgets.gui.ow_wofry_widget import WofryWidget
 
 class GenericWavefrontViewer2D(WofryWidget):
@@ -31,6 +34,11 @@ class GenericWavefrontViewer2D(WofryWidget):
     plot_csd = Setting(0)
     plot_iterations = Setting(0)
     phase_unwrap = Setting(0)
+    single_precision = Setting(0)
+    csd_downsampling = Setting(1)
+    history_size = Setting(1000)
+    spill_to_file = Setting(0)
+    spill_file_name = Setting("wavefront_accumulation.h5")
 
 
     def __init__(self):
@@ -76,6 +84,29 @@ class GenericWavefrontViewer2D(WofryWidget):
                     items=['No','H only','V only','First H, then V','First V then H'],
                     valueType=int, orientation="horizontal", callback=self.refresh)
 
+        accumulator_box = oasysgui.widgetBox(self.tab_sou, "Accumulator (applied after Clear)", addSpace=True, orientation="vertical")
+        gui.comboBox(accumulator_box, self, "single_precision", label="Precision", labelWidth=250,
+                     items=["Double", "Single"], sendSelectedValue=False, orientation="horizontal")
+        oasysgui.lineEdit(accumulator_box, self, "csd_downsampling", "CSD downsampling factor", labelWidth=250,
+                          valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(accumulator_box, self, "history_size", "Iterations kept in memory", labelWidth=250,
+                          valueType=int, orientation="horizontal")
+        gui.comboBox(accumulator_box, self, "spill_to_file", label="Spill iterations to HDF5 file", labelWidth=250,
+                     items=["No", "Yes"], sendSelectedValue=False, orientation="horizontal", callback=self.set_SpillToFile)
+
+        self.spill_box = oasysgui.widgetBox(accumulator_box, "", addSpace=False, orientation="horizontal")
+        self.le_spill_file_name = oasysgui.lineEdit(self.spill_box, self, "spill_file_name", "File name", labelWidth=80,
+                                                    valueType=str, orientation="horizontal")
+        gui.button(self.spill_box, self, "...", callback=self.select_spill_file)
+
+        self.set_SpillToFile()
+
+    def set_SpillToFile(self):
+        self.spill_box.setVisible(self.spill_to_file == 1)
+
+    def select_spill_file(self):
+        self.le_spill_file_name.setText(oasysgui.selectFileFromDialog(self, self.spill_file_name, "Open HDF5 File"))
+
 
     def initializeTabs(self):
         size = len(self.tab)
@@ -107,18 +138,6 @@ class GenericWavefrontViewer2D(WofryWidget):
             tab.setFixedWidth(self.IMAGE_WIDTH)
 
 
-    def crossSpectralDensityHV(self):
-
-        WF = self.wavefront2D.get_complex_amplitude()
-        imodeX = WF[:,int(0.5*WF.shape[1])]
-        imodeY = WF[int(0.5*WF.shape[0]),:]
-
-        Wx1x2 =  numpy.outer( numpy.conj(imodeX) , imodeX ) #* self.eigenvalue(i)
-        Wy1y2 =  numpy.outer( numpy.conj(imodeY) , imodeY ) #* self.eigenvalue(i)
-
-
-        return Wx1x2,Wy1y2
-
     def set_input(self, wofry_data):
 
         if not wofry_data is None:
@@ -127,28 +146,29 @@ class GenericWavefrontViewer2D(WofryWidget):
 
             self.wavefront2D = wofry_data.get_wavefront()
 
-            Wx1x2,Wy1y2  = self.crossSpectralDensityHV()
-
-            delta = self.wavefront2D.delta()
-            if self.accumulated_data is None:
-                self.accumulated_data = {}
-                self.accumulated_data["counter"] = 1
-                self.accumulated_data["intensity"] = self.wavefront2D.get_intensity()
-                self.accumulated_data["phase"] = self.wavefront2D.get_phase()
-
-                self.accumulated_data["W_x1_0_x2_0"] = Wx1x2
-                self.accumulated_data["W_0_y1_0_y2"] = Wy1y2
-                self.accumulated_data["x"] = self.wavefront2D.get_coordinate_x()
-                self.accumulated_data["y"] = self.wavefront2D.get_coordinate_y()
-                self.accumulated_data["iteration_intensities"] = [self.wavefront2D.get_intensity().sum()*delta[0]*delta[1]]
-
-            else:
-                self.accumulated_data["counter"] += 1
-                self.accumulated_data["intensity"] += self.wavefront2D.get_intensity()
-                self.accumulated_data["phase"] += self.wavefront2D.get_phase()
-                self.accumulated_data["W_x1_0_x2_0"] += Wx1x2
-                self.accumulated_data["W_0_y1_0_y2"] += Wy1y2
-                self.accumulated_data["iteration_intensities"].append( self.wavefront2D.get_intensity().sum()*delta[0]*delta[1])
+            try:
+                if self.accumulated_data is None:
+                    congruence.checkStrictlyPositiveNumber(self.csd_downsampling, "CSD downsampling factor")
+                    congruence.checkStrictlyPositiveNumber(self.history_size, "Iterations kept in memory")
+                    if self.spill_to_file == 1: congruence.checkDir(self.spill_file_name)
+
+                    self.accumulated_data = WavefrontAccumulator2D(self.wavefront2D.get_coordinate_x(),
+                                                                   self.wavefront2D.get_coordinate_y(),
+                                                                   single_precision=self.single_precision == 1,
+                                                                   csd_downsampling=self.csd_downsampling,
+                                                                   history_size=self.history_size,
+                                                                   spill_file_name=self.spill_file_name if self.spill_to_file == 1 else None)
+
+                    if self.spill_to_file == 1:
+                        # an existing file is not overwritten: the accumulator can spill to a new one
+                        self.setStatusMessage("Spill file: " + os.path.split(self.accumulated_data.get_spill_file_name())[1])
+
+                self.accumulated_data.add_wavefront(self.wavefront2D)
+            except Exception as exception:
+                QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+                if self.IS_DEVELOP: raise exception
+                return
 
             self.progressBarInit()
             self.do_plot_results(10) #refresh()
@@ -174,15 +194,15 @@ class GenericWavefrontViewer2D(WofryWidget):
             tabs_canvas_index = -1
             if self.plot_intensity:
                 tabs_canvas_index += 1
-                self.plot_data2D(data2D=self.accumulated_data["intensity"],
-                                 dataX=1e6*self.accumulated_data["x"],
-                                 dataY=1e6*self.accumulated_data["y"],
+                self.plot_data2D(data2D=self.accumulated_data.get_intensity(),
+                                 dataX=1e6*self.accumulated_data.get_coordinate_x(),
+                                 dataY=1e6*self.accumulated_data.get_coordinate_y(),
                                  progressBarValue=progressBarValue+10,
                                  tabs_canvas_index=tabs_canvas_index,
                                  plot_canvas_index=0,
                                  title="Wavefront 2D Intensity",
-                                 xtitle="Horizontal [$\mu$m] ( %d pixels)"%(self.accumulated_data["x"].size),
-                                 ytitle="Vertical [$\mu$m] (%d pixels)"%(self.accumulated_data["y"].size))
+                                 xtitle="Horizontal [$\mu$m] ( %d pixels)"%(self.accumulated_data.get_coordinate_x().size),
+                                 ytitle="Vertical [$\mu$m] (%d pixels)"%(self.accumulated_data.get_coordinate_y().size))
 
                 x,y,txt = self.get_data_iterations()
                 if not(self.keep_result):
@@ -192,7 +212,7 @@ class GenericWavefrontViewer2D(WofryWidget):
 
             if self.plot_phase:
                 tabs_canvas_index += 1
-                phase =self.accumulated_data["phase"] / self.accumulated_data["counter"]
+                phase = self.accumulated_data.get_averaged_phase().astype(numpy.float64)
 
                 if self.phase_unwrap > 0:
                     if self.phase_unwrap == 1: # x only
@@ -205,11 +225,11 @@ class GenericWavefrontViewer2D(WofryWidget):
                         phase = numpy.unwrap(numpy.unwrap(phase,axis=1),axis=0)
 
                 phase *=  180.0 / numpy.pi
-                intensity_normalized = self.accumulated_data["intensity"] / self.accumulated_data["intensity"].max()
+                intensity_normalized = self.accumulated_data.get_intensity() / self.accumulated_data.get_intensity().max()
                 phase[numpy.where(intensity_normalized<0.1)] = 0
                 self.plot_data2D(data2D=phase,
-                                 dataX=1e6*self.accumulated_data["x"],
-                                 dataY=1e6*self.accumulated_data["y"],
+                                 dataX=1e6*self.accumulated_data.get_coordinate_x(),
+                                 dataY=1e6*self.accumulated_data.get_coordinate_y(),
                                  progressBarValue=progressBarValue+10,
                                  tabs_canvas_index=tabs_canvas_index,
                                  plot_canvas_index=0,
@@ -218,9 +238,9 @@ class GenericWavefrontViewer2D(WofryWidget):
                                  ytitle="Vertical Coordinate [$\mu$m]")
             if self.plot_csd:
                 tabs_canvas_index += 1
-                self.plot_data2D(data2D=numpy.abs(self.accumulated_data["W_x1_0_x2_0"]),
-                                 dataX=1e6*self.accumulated_data["x"],
-                                 dataY=1e6*self.accumulated_data["y"],
+                self.plot_data2D(data2D=numpy.abs(self.accumulated_data.get_W_x1_0_x2_0()),
+                                 dataX=1e6*self.accumulated_data.get_csd_coordinate_x(),
+                                 dataY=1e6*self.accumulated_data.get_csd_coordinate_x(),
                                  progressBarValue=progressBarValue+10,
                                  tabs_canvas_index=tabs_canvas_index,
                                  plot_canvas_index=0,
@@ -228,9 +248,9 @@ class GenericWavefrontViewer2D(WofryWidget):
                                  xtitle="Horizontal Coordinate x1 [$\mu$m]",
                                  ytitle="Horizontal Coordinate x2 [$\mu$m]")
                 tabs_canvas_index += 1
-                self.plot_data2D(data2D=numpy.abs(self.accumulated_data["W_0_y1_0_y2"]),
-                                 dataX=1e6*self.accumulated_data["x"],
-                                 dataY=1e6*self.accumulated_data["y"],
+                self.plot_data2D(data2D=numpy.abs(self.accumulated_data.get_W_0_y1_0_y2()),
+                                 dataX=1e6*self.accumulated_data.get_csd_coordinate_y(),
+                                 dataY=1e6*self.accumulated_data.get_csd_coordinate_y(),
                                  progressBarValue=progressBarValue+10,
                                  tabs_canvas_index=tabs_canvas_index,
                                  plot_canvas_index=0,
@@ -248,7 +268,7 @@ class GenericWavefrontViewer2D(WofryWidget):
                                  xtitle="iteration index",
                                  ytitle="intensity [arbitrary units]",
                                  calculate_fwhm=False,
-                                 xrange=[-1,1+self.accumulated_data["counter"]],
+                                 xrange=[x[0]-1,x[-1]+1],
                                  symbol='o')
 
 
@@ -259,18 +279,19 @@ class GenericWavefrontViewer2D(WofryWidget):
 
     def get_data_iterations(self):
 
-
-        x = numpy.arange(self.accumulated_data["counter"])
-        y = numpy.array(self.accumulated_data["iteration_intensities"])
+        x, y = self.accumulated_data.get_iteration_intensities()
+        y0 = self.accumulated_data.get_first_iteration_intensity()
+        total_intensity = self.accumulated_data.get_total_intensity()
 
         txt = "#########################################################\n"
+        if x[0] > 0: txt += "  (only the last %d of %d iterations are kept in memory)\n"%(x.size, self.accumulated_data.get_counter())
         txt += "%20s %20s %20s %20s\n"%("iteration","intensity","intensity/I0","intensity/TotalInt")
         for i,xi in enumerate(x):
-            txt += "%20d  %20.5g  %20.5f %20.5f \n"%(xi,y[i],y[i]/y[0],y[i]/y.sum())
+            txt += "%20d  %20.5g  %20.5f %20.5f \n"%(xi,y[i],y[i]/y0,y[i]/total_intensity)
 
-        txt += "  Total intensity: %g\n"%(y.sum())
-        txt += "  Mean intensity: %g\n"%(y.mean())
-        txt += "  Standard deviation intensity: %g\n"%(y.std())
+        txt += "  Total intensity: %g\n"%(total_intensity)
+        txt += "  Mean intensity: %g\n"%(self.accumulated_data.get_mean_intensity())
+        txt += "  Standard deviation intensity: %g\n"%(self.accumulated_data.get_standard_deviation_intensity())
 
 
         txt += "\n"
@@ -280,6 +301,7 @@ class GenericWavefrontViewer2D(WofryWidget):
     def reset_accumumation(self):
 
         self.initializeTabs()
+        if not self.accumulated_data is None: self.accumulated_data.spill()
         self.accumulated_data = None
         self.wavefront2D = None
 
@@ -10,7 +10,7 @@ from oasys.util.oasys_util import EmittingStream, TriggerIn, TriggerOut
 from wofry.propagator.wavefront2D.generic_wavefront import GenericWavefront2D
 from wofry.propagator.wavefront1D.generic_wavefront import GenericWavefront1D
 
-from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_objects import WofryData, WofryModeStack2D
 from orangecontrib.wofry.widgets.gui.ow_wofry_widget import WofryWidget
 
 
@@ -106,7 +106,7 @@ class OW2Dto1D(WofryWidget):
             else: self.wavefront1D_h = wofry_data
 
             if self.is_automatic_execution:
-                self.send_data()
+                self.execute_automatically(self.send_data)
 
     def set_input_v(self, wofry_data):
         if not wofry_data is None:
@@ -114,7 +114,7 @@ class OW2Dto1D(WofryWidget):
             else: self.wavefront1D_v = wofry_data
 
             if self.is_automatic_execution:
-                self.send_data()
+                self.execute_automatically(self.send_data)
 
     def send_data(self):
         if not self.wavefront1D_h is None and not self.wavefront1D_v is None:
@@ -136,7 +136,9 @@ class OW2Dto1D(WofryWidget):
 
             self.progressBarFinished()
 
-            self.send("WofryData", WofryData(wavefront=self.wavefront2D))
+            # the combined wavefront is separable: downstream elements can propagate its x and y factors
+            self.send("WofryData", WofryData(wavefront=self.wavefront2D,
+                                             mode_stack=WofryModeStack2D.initialize_from_wavefront(self.wavefront2D)))
             self.send("GenericWavefront2D", self.wavefront2D)
 
     def do_plot_results(self, progressBarValue):
@@ -101,7 +101,7 @@ class OW2Dto1D(WofryWidget):
             else:
                 self.wavefront2D = wofry_data
 
-            if self.is_automatic_execution: self.send_data()
+            if self.is_automatic_execution: self.execute_automatically(self.send_data)
 
     def send_data(self):
         if not self.wavefront2D is None:
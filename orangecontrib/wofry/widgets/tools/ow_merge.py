@@ -387,10 +387,10 @@ class OWWOMerge(OWWidget):
                 current_wavefront = current_wavefront.duplicate()
                 if self.use_weights == 1:
                     new_weight = getattr(self, "weight_input_wavefront" + str(index))
-                    current_wavefront.get_wavefront().rescale_amplitude(new_weight)
+                    current_wavefront.get_writable_wavefront().rescale_amplitude(new_weight)
 
                     new_phase = getattr(self, "phase_input_wavefront" + str(index))
-                    current_wavefront.get_wavefront().add_phase_shift(new_phase)
+                    current_wavefront.get_writable_wavefront().add_phase_shift(new_phase)
 
                 if cumulated_complex_amplitude is None:
                     merged_wavefront = current_wavefront.duplicate()
@@ -411,7 +411,7 @@ class OWWOMerge(OWWidget):
                         return
                     cumulated_complex_amplitude += ca
 
-        wf = merged_wavefront.get_wavefront()
+        wf = merged_wavefront.get_writable_wavefront()
         wf.set_complex_amplitude(cumulated_complex_amplitude)
 
         self.send("WofryData", merged_wavefront)
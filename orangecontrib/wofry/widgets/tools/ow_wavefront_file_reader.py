@@ -15,6 +15,7 @@ from wofryimpl.propagator.light_source_h5file import WOH5FileLightSource
 from wofryimpl.beamline.beamline import WOBeamline
 
 from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_h5file import WOH5FileROILightSource
 
 class OWWavefrontFileReader(oasyswidget.OWWidget):
     name = "Generic Wavefront File Reader"
@@ -31,6 +32,14 @@ class OWWavefrontFileReader(oasyswidget.OWWidget):
     file_name = Setting("")
     data_path = Setting("")
 
+    use_roi   = Setting(0)
+    roi_x_min = Setting(-1e-4)
+    roi_x_max = Setting( 1e-4)
+    roi_y_min = Setting(-1e-4)
+    roi_y_max = Setting( 1e-4)
+    binning_x = Setting(1)
+    binning_y = Setting(1)
+
     outputs = [{"name":"WofryData2D",
                 "type":WofryData,
                 "doc":"WofryData2D",
@@ -49,7 +58,7 @@ class OWWavefrontFileReader(oasyswidget.OWWidget):
         self.addAction(self.runaction)
 
         self.setFixedWidth(590)
-        self.setFixedHeight(250)
+        self.setFixedHeight(450)
 
         left_box_1 = oasysgui.widgetBox(self.controlArea, "HDF5 Local File Selection", addSpace=True,
                                         orientation="vertical",width=570, height=100)
@@ -66,6 +75,23 @@ class OWWavefrontFileReader(oasyswidget.OWWidget):
 
         gui.separator(left_box_1, height=20)
 
+        roi_box = oasysgui.widgetBox(self.controlArea, "Region of Interest", addSpace=True, orientation="vertical", width=570, height=190)
+
+        gui.comboBox(roi_box, self, "use_roi", label="Read", labelWidth=190,
+                     items=["Full wavefront", "Region of interest and binning"],
+                     callback=self.set_ROI, sendSelectedValue=False, orientation="horizontal")
+
+        self.roi_box_1 = oasysgui.widgetBox(roi_box, "", addSpace=False, orientation="vertical")
+
+        oasysgui.lineEdit(self.roi_box_1, self, "roi_x_min", "H min [m]", labelWidth=300, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.roi_box_1, self, "roi_x_max", "H max [m]", labelWidth=300, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.roi_box_1, self, "roi_y_min", "V min [m] (2D only)", labelWidth=300, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.roi_box_1, self, "roi_y_max", "V max [m] (2D only)", labelWidth=300, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.roi_box_1, self, "binning_x", "H binning [pixels]", labelWidth=300, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(self.roi_box_1, self, "binning_y", "V binning [pixels] (2D only)", labelWidth=300, valueType=int, orientation="horizontal")
+
+        self.set_ROI()
+
         button = gui.button(self.controlArea, self, "Browse File and Send Data", callback=self.read_file)
         button.setFixedHeight(45)
         gui.separator(self.controlArea, height=20)
@@ -75,11 +101,26 @@ class OWWavefrontFileReader(oasyswidget.OWWidget):
         gui.rubber(self.controlArea)
 
 
+    def set_ROI(self):
+        self.roi_box_1.setVisible(self.use_roi == 1)
+
     def get_light_source(self):
-        light_source = WOH5FileLightSource(
-            name   = self.name                ,
-            h5file = self.file_name,
-        )
+        if self.use_roi == 0:
+            light_source = WOH5FileLightSource(
+                name   = self.name                ,
+                h5file = self.file_name,
+            )
+        else:
+            # only the region of interest is read from the file
+            light_source = WOH5FileROILightSource(
+                name      = self.name,
+                h5file    = self.file_name,
+                filepath  = self.data_path if self.data_path.strip() != "" else "wfr",
+                x_roi     = (self.roi_x_min, self.roi_x_max),
+                y_roi     = (self.roi_y_min, self.roi_y_max),
+                binning_x = self.binning_x,
+                binning_y = self.binning_y,
+            )
         return light_source
 
 
@@ -109,6 +150,12 @@ class OWWavefrontFileReader(oasyswidget.OWWidget):
             congruence.checkEmptyString(self.file_name, "File Name")
             congruence.checkFile(self.file_name)
 
+            if self.use_roi == 1:
+                congruence.checkGreaterThan(self.roi_x_max, self.roi_x_min, "H max", "H min")
+                congruence.checkGreaterThan(self.roi_y_max, self.roi_y_min, "V max", "V min")
+                congruence.checkStrictlyPositiveNumber(self.binning_x, "H binning")
+                congruence.checkStrictlyPositiveNumber(self.binning_y, "V binning")
+
             light_source = self.get_light_source()
             wfr = light_source.get_wavefront()
 
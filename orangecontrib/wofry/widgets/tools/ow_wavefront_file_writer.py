@@ -1,14 +1,18 @@
 #TODO: this widget is valid for 1D and 2D wavefronts. Is there a better way to discriminate without duplicating widgets?
 
-import os
+import os, numpy
 
 from PyQt5.QtWidgets import QMessageBox
 
 from orangewidget import gui, widget
 from orangewidget.settings import Setting
 from oasys.widgets import gui as oasysgui, congruence
+from oasys.util.oasys_util import TriggerOut
 
 from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_h5file import save_h5_wavefront, get_next_frame_path, is_compression_available, COMPRESSION_FILTERS, WavefrontStackWriter
+from orangecontrib.wofry.util.wofry_batch import save_beamline, get_scan_cases, run_cases
+from orangecontrib.wofry.util.wofry_util import WorkerThread
 
 class OWWavefrontFileWriter(widget.OWWidget):
     name = "Generic Wavefront  File Writer"
@@ -26,9 +30,31 @@ class OWWavefrontFileWriter(widget.OWWidget):
     data_path = Setting("wfr")
     is_automatic_run= Setting(1)
 
-    inputs = [("WofryData" , WofryData, "setGenericWavefront")]
+    write_mode        = Setting(0)
+    compression       = Setting(0)
+    compression_level = Setting(4)
+    chunking          = Setting(0)
+    chunk_x           = Setting(256)
+    chunk_y           = Setting(256)
+    single_precision  = Setting(0)
+    flush_every       = Setting(10)
+    save_beamline     = Setting(0)
+    parallel_scan_variable_name = Setting("oe1.q")
+    scan_from          = Setting(0.0)
+    scan_to            = Setting(1.0)
+    scan_points        = Setting(10)
+    scan_workers       = Setting(max(1, (os.cpu_count() or 2) - 1))
+
+    inputs = [("WofryData" , WofryData, "setGenericWavefront"),
+              ("Trigger", TriggerOut, "receive_trigger_signal")]
 
     wavefront = None
+    beamline = None
+    scan_thread = None
+    stack_writer = None
+    # variable name and value sent by the loop point
+    _trigger_variable_name = None
+    _trigger_variable_value = numpy.nan
 
     def __init__(self):
         super().__init__()
@@ -38,10 +64,10 @@ class OWWavefrontFileWriter(widget.OWWidget):
         self.addAction(self.runaction)
 
         self.setFixedWidth(590)
-        self.setFixedHeight(300)
+        self.setFixedHeight(810)
 
         left_box_1 = oasysgui.widgetBox(self.controlArea, "HDF5 File Selection", addSpace=True, orientation="vertical",
-                                         width=570, height=200)
+                                         width=570, height=230)
 
         gui.checkBox(left_box_1, self, 'is_automatic_run', 'Automatic Execution')
 
@@ -61,36 +87,249 @@ class OWWavefrontFileWriter(widget.OWWidget):
                                                     labelWidth=200, valueType=str, orientation="horizontal")
         self.le_data_path.setFixedWidth(330)
 
+        gui.comboBox(left_box_1, self, "write_mode", label="Write mode", labelWidth=200,
+                     items=["Overwrite file", "Append as new frame (name_NNNN)", "Append to stack (scans)"],
+                     callback=self.set_WriteMode, sendSelectedValue=False, orientation="horizontal")
+
+        self.stack_box = oasysgui.widgetBox(left_box_1, "", addSpace=False, orientation="horizontal")
+        oasysgui.lineEdit(self.stack_box, self, "flush_every", "Write every [frames]", labelWidth=200,
+                          valueType=int, orientation="horizontal")
+        gui.button(self.stack_box, self, "Close Stack", callback=self.close_stack)
+
+        # the beamline file can be run without the GUI: python -m orangecontrib.wofry.util.wofry_batch
+        gui.comboBox(left_box_1, self, "save_beamline", label="Save beamline (<file name>.beamline.pkl)", labelWidth=300,
+                     items=["No", "Yes"], sendSelectedValue=False, orientation="horizontal")
+
+        layout_box = oasysgui.widgetBox(self.controlArea, "Storage Layout", addSpace=True, orientation="vertical", width=570, height=210)
+
+        gui.comboBox(layout_box, self, "compression", label="Compression", labelWidth=300,
+                     items=["None", "gzip", "lzf", "Blosc (hdf5plugin)"],
+                     callback=self.set_Compression, sendSelectedValue=False, orientation="horizontal")
+
+        self.compression_box = oasysgui.widgetBox(layout_box, "", addSpace=False, orientation="vertical")
+        oasysgui.lineEdit(self.compression_box, self, "compression_level", "Compression level", labelWidth=300,
+                          valueType=int, orientation="horizontal")
+
+        gui.comboBox(layout_box, self, "chunking", label="Chunks", labelWidth=300,
+                     items=["Automatic", "Custom"],
+                     callback=self.set_Compression, sendSelectedValue=False, orientation="horizontal")
+
+        self.chunk_box = oasysgui.widgetBox(layout_box, "", addSpace=False, orientation="vertical")
+        oasysgui.lineEdit(self.chunk_box, self, "chunk_x", "Chunk size H [pixels]", labelWidth=300,
+                          valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(self.chunk_box, self, "chunk_y", "Chunk size V [pixels] (2D only)", labelWidth=300,
+                          valueType=int, orientation="horizontal")
+
+        gui.comboBox(layout_box, self, "single_precision", label="Complex amplitude precision", labelWidth=300,
+                     items=["Double (complex128)", "Single (complex64)"],
+                     sendSelectedValue=False, orientation="horizontal")
+
+        # the beamline received is run by a pool of processes for each value, the wavefronts appended to the stack
+        scan_box = oasysgui.widgetBox(self.controlArea, "Parallel Scan (to stack)", addSpace=True, orientation="vertical", width=570, height=175)
+
+        oasysgui.lineEdit(scan_box, self, "parallel_scan_variable_name", "Variable (source.<name>, oe<N>.<name>, ...)", labelWidth=300,
+                          valueType=str, orientation="horizontal")
+        oasysgui.lineEdit(scan_box, self, "scan_from", "From", labelWidth=300, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(scan_box, self, "scan_to", "To", labelWidth=300, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(scan_box, self, "scan_points", "Number of points", labelWidth=300, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(scan_box, self, "scan_workers", "Number of processes", labelWidth=300, valueType=int, orientation="horizontal")
+
+        gui.button(scan_box, self, "Run Parallel Scan", callback=self.run_parallel_scan)
+
+        self.set_Compression()
+        self.set_WriteMode()
+
         button = gui.button(self.controlArea, self, "Write File", callback=self.write_file)
         button.setFixedHeight(45)
 
         gui.rubber(self.controlArea)
 
+    def set_WriteMode(self):
+        self.stack_box.setVisible(self.write_mode == 2)
+        if self.write_mode != 2: self.close_stack()
+
+    def close_stack(self):
+        if not self.stack_writer is None:
+            self.stack_writer.close()
+            self.setStatusMessage("Stack closed: %d frames in %s" % (self.stack_writer.get_number_of_frames(),
+                                                                     os.path.split(self.stack_writer.get_filename())[1]))
+            self.stack_writer = None
+
+    def onDeleteWidget(self):
+        if not self.scan_thread is None: self.scan_thread.wait()
+        self.close_stack()
+        super().onDeleteWidget()
+
+    # the scan value sent by the loop point is stored with the next wavefronts written in the stack
+    def receive_trigger_signal(self, trigger):
+        if trigger and trigger.new_object == True:
+            if trigger.has_additional_parameter("variable_name"):
+                self._trigger_variable_name = trigger.get_additional_parameter("variable_name").strip()
+                try:    self._trigger_variable_value = float(trigger.get_additional_parameter("variable_value"))
+                except: self._trigger_variable_value = numpy.nan
+
+    def set_Compression(self):
+        self.compression_box.setVisible(self.compression in (1, 3))
+        self.chunk_box.setVisible(self.chunking == 1)
+
+    def get_beamline_file_name(self):
+        return os.path.splitext(self.file_name)[0] + ".beamline.pkl"
+
     def selectFile(self):
         self.le_file_name.setText(oasysgui.selectFileFromDialog(self, self.file_name, "Open HDF5 File"))
 
     def setGenericWavefront(self, data):
         if not data is None:
             self.wavefront = data.get_wavefront()
+            self.beamline  = data.get_beamline()
 
             if self.is_automatic_run:
                 self.write_file()
 
 
+    # appended to the status messages of the writing
+    def get_compression_warning(self):
+        compression = COMPRESSION_FILTERS[self.compression]
+
+        if is_compression_available(compression): return ""
+        else: return " - compression filter " + compression + " not available: using gzip"
+
+    def get_storage_options(self, dimension):
+        compression = COMPRESSION_FILTERS[self.compression]
+        if not is_compression_available(compression): compression = "gzip"
+
+        if self.chunking == 0:
+            chunks = None
+        elif dimension == 1:
+            chunks = (self.chunk_x,)
+        else:
+            chunks = (self.chunk_x, self.chunk_y)
+
+        return compression, chunks
+
+    def run_parallel_scan(self):
+        self.setStatusMessage("")
+
+        try:
+            if self.beamline is None or self.beamline.get_light_source() is None: raise ValueError("Beamline with light source not present")
+            if not self.scan_thread is None: raise ValueError("A scan is already running")
+
+            congruence.checkDir(self.file_name)
+            congruence.checkEmptyString(self.data_path, "Wavefront name")
+            congruence.checkEmptyString(self.parallel_scan_variable_name, "Variable")
+            congruence.checkStrictlyPositiveNumber(self.scan_points, "Number of points")
+            congruence.checkStrictlyPositiveNumber(self.scan_workers, "Number of processes")
+
+            self.close_stack()
+
+            variable_name = self.parallel_scan_variable_name.strip()
+            values = numpy.linspace(self.scan_from, self.scan_to, self.scan_points)
+            cases = get_scan_cases(variable_name, values)
+            compression, chunks = self.get_storage_options(self.beamline.get_light_source().get_dimension())
+
+            stack_writer = WavefrontStackWriter(self.file_name, self.data_path,
+                                                compression=compression,
+                                                compression_level=self.compression_level,
+                                                chunks=chunks,
+                                                single_precision=self.single_precision == 1,
+                                                flush_every=self.flush_every)
+            beamline = self.beamline
+            workers = self.scan_workers
+
+            def scan():
+                failed = []
+                try:
+                    for index, output_wavefront in run_cases(beamline, cases, workers=workers):
+                        if isinstance(output_wavefront, Exception): failed.append((values[index], output_wavefront))
+                        else: stack_writer.append(output_wavefront, scan_value=values[index], variable_name=variable_name)
+                finally:
+                    stack_writer.close()
+
+                return stack_writer.get_number_of_frames(), failed
+
+            self.setStatusMessage("Running scan of %s on %d processes" % (variable_name, workers) + self.get_compression_warning())
+
+            self.scan_thread = WorkerThread(0, scan)
+            self.scan_thread.task_completed.connect(self.scan_completed)
+            self.scan_thread.task_failed.connect(self.scan_failed)
+            self.scan_thread.finished.connect(self.scan_finished)
+            self.scan_thread.start()
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+    def scan_completed(self, task_id, result):
+        number_of_frames, failed = result
+
+        self.setStatusMessage("Scan completed: %d frames in %s" % (number_of_frames, os.path.split(self.file_name)[1]) + self.get_compression_warning())
+
+        if len(failed) > 0:
+            QMessageBox.warning(self, "Warning",
+                                "Scan points failed:\n" + "\n".join(["%g: %s" % (value, str(exception)) for value, exception in failed]),
+                                QMessageBox.Ok)
+
+    def scan_failed(self, task_id, exception):
+        self.setStatusMessage("")
+        QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+    def scan_finished(self):
+        self.scan_thread.wait()
+        self.scan_thread = None
+
     def write_file(self):
         self.setStatusMessage("")
 
         try:
             if not self.wavefront is None:
                 congruence.checkDir(self.file_name)
+                congruence.checkEmptyString(self.data_path, "Wavefront name")
+
+                if self.compression in (1, 3): congruence.checkPositiveNumber(self.compression_level, "Compression level")
+                if self.chunking == 1:
+                    congruence.checkStrictlyPositiveNumber(self.chunk_x, "Chunk size H")
+                    congruence.checkStrictlyPositiveNumber(self.chunk_y, "Chunk size V")
+
+                compression, chunks = self.get_storage_options(self.wavefront.get_dimension())
+
+                if self.write_mode == 2:
+                    congruence.checkStrictlyPositiveNumber(self.flush_every, "Write every")
+
+                    if not self.stack_writer is None and (self.stack_writer.get_filename() != self.file_name or
+                                                          self.stack_writer.get_filepath() != self.data_path):
+                        self.close_stack()
+
+                    if self.stack_writer is None:
+                        self.stack_writer = WavefrontStackWriter(self.file_name, self.data_path,
+                                                                 compression=compression,
+                                                                 compression_level=self.compression_level,
+                                                                 chunks=chunks,
+                                                                 single_precision=self.single_precision == 1,
+                                                                 flush_every=self.flush_every)
+
+                    self.stack_writer.append(self.wavefront, scan_value=self._trigger_variable_value, variable_name=self._trigger_variable_name)
+
+                    frame = "frame %d" % (self.stack_writer.get_number_of_frames() - 1)
+                else:
+                    if self.write_mode == 0:
+                        data_path = self.data_path
+                    else:
+                        data_path = get_next_frame_path(self.file_name, self.data_path)
+
+                    # note that this is valid for both 1D and 2D wavefronts
+                    save_h5_wavefront(self.wavefront, self.file_name, data_path,
+                                      overwrite=self.write_mode == 0,
+                                      compression=compression,
+                                      compression_level=self.compression_level,
+                                      chunks=chunks,
+                                      single_precision=self.single_precision == 1)
+
+                    frame = data_path
 
-                # note that this is valid for both 1D and 2D wavefronts because both implement
-                # the save_h5_file method. 
-                self.wavefront.save_h5_file(self.file_name,self.data_path)
+                if self.save_beamline == 1 and not self.beamline is None:
+                    save_beamline(self.beamline, self.get_beamline_file_name())
 
                 path, file_name = os.path.split(self.file_name)
 
-                self.setStatusMessage("File Out: " + file_name)
+                self.setStatusMessage("File Out: " + file_name + " (" + frame + ")" + self.get_compression_warning())
 
             else:
                 QMessageBox.critical(self, "Error",
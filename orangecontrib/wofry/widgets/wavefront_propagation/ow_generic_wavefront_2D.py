@@ -447,7 +447,10 @@ class OWGenericWavefront2D(WofryWidget):
                              ytitle="Vertical [$\mu$m] ( %d pixels)" % (self.wavefront2D.get_coordinate_y().size))
 
 
-            self.plot_data2D(data2D=self.wavefront2D.get_phase(from_minimum_intensity=0.1),
+            # the phase is calculated only when its tab is shown
+            wavefront = self.wavefront2D
+
+            self.plot_data2D(data2D=lambda: wavefront.get_phase(from_minimum_intensity=0.1),
                              dataX=1e6 * self.wavefront2D.get_coordinate_x(),
                              dataY=1e6 * self.wavefront2D.get_coordinate_y(),
                              progressBarValue=progressBarValue,
@@ -2,6 +2,7 @@ import numpy
 import sys
 
 from PyQt5.QtGui import QPalette, QColor, QFont
+from PyQt5.QtWidgets import QMessageBox
 
 from orangewidget import gui
 from orangewidget import widget
@@ -15,12 +16,13 @@ from syned.beamline.beamline import Beamline
 
 from wofryimpl.beamline.beamline import WOBeamline
 
-from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_objects import WofryData, WofryModeStack
 from orangecontrib.wofry.widgets.gui.ow_wofry_widget import WofryWidget
 
 import scipy.constants as codata
 
-from wofryimpl.propagator.util.undulator_coherent_mode_decomposition_1d import UndulatorCoherentModeDecomposition1D
+from orangecontrib.wofry.util.wofry_cmd_cache import calculate_coherent_mode_decomposition, get_default_cmd_cache_directory, clear_cmd_cache, \
+    DEFAULT_CMD_CACHE_MAX_SIZE_IN_MB
 from syned.storage_ring.electron_beam import ElectronBeam
 from syned.storage_ring.magnetic_structures.undulator import Undulator
 from wofryimpl.propagator.light_source_cmd import WOLightSourceCMD
@@ -73,6 +75,8 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
     flag_gsm = Setting(0)
     scan_direction_flag = Setting(0)
     mode_index = Setting(0)
+    send_mode_stack = Setting(0)
+    mode_stack_size = Setting(50)
 
     spectral_density_threshold = Setting(0.99)
     correction_factor = Setting(1.0)
@@ -88,9 +92,17 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
     e_energy_dispersion_interval_in_sigma_units = Setting(6.0)
     e_energy_dispersion_points = Setting(11)
 
+    eigensolver = Setting(0)
+    minimum_number_of_modes = Setting(20)
+
+    use_cmd_cache = Setting(0)
+    cmd_cache_directory = Setting("")
+    cmd_cache_max_size = Setting(DEFAULT_CMD_CACHE_MAX_SIZE_IN_MB)
+
     # to store calculations
     coherent_mode_decomposition = None
     coherent_mode_decomposition_results = None
+    coherent_mode_decomposition_parameters = None
 
     def __init__(self):
 
@@ -200,6 +212,19 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
         gui.button(left_box_5, self, "-1", callback=self.decrease_mode_index, width=30)
         gui.button(left_box_5, self,  "0", callback=self.reset_mode_index, width=30)
 
+        gui.comboBox(left_box_3, self, "send_mode_stack", label="Send also mode stack", labelWidth=350,
+                     items=["No",
+                            "Yes"
+                            ],
+                     callback=self.set_visible,
+                     tooltip="send_mode_stack",
+                     sendSelectedValue=False, orientation="horizontal")
+
+        self.mode_stack_box = oasysgui.widgetBox(left_box_3, "", addSpace=False, orientation="vertical")
+        oasysgui.lineEdit(self.mode_stack_box, self, "mode_stack_size", "Number of modes in the stack",
+                          labelWidth=300, tooltip="mode_stack_size",
+                          valueType=int, orientation="horizontal")
+
         #
         # Light Source
         #
@@ -300,6 +325,45 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
                           labelWidth=300, tooltip="e_energy_dispersion_points",
                           valueType=int, orientation="horizontal")
 
+        # the partial eigensolver calculates only the first modes, up to the cumulated occupation threshold
+        eigensolver_box = oasysgui.widgetBox(self.tab_advance_settings, "Diagonalization", addSpace=False,
+                                             orientation="vertical")
+
+        gui.comboBox(eigensolver_box, self, "eigensolver", label="Modes", labelWidth=150,
+                     items=["All (full eigensolver)",
+                            "First modes (partial eigensolver)"
+                            ],
+                     callback=self.set_visible,
+                     tooltip="eigensolver",
+                     sendSelectedValue=False, orientation="horizontal")
+
+        self.eigensolver_panel = oasysgui.widgetBox(eigensolver_box, "", addSpace=False, orientation="vertical")
+        oasysgui.lineEdit(self.eigensolver_panel, self, "spectral_density_threshold", "Cumulated occupation threshold",
+                          labelWidth=300, tooltip="spectral_density_threshold",
+                          valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.eigensolver_panel, self, "minimum_number_of_modes", "Minimum number of modes",
+                          labelWidth=300, tooltip="minimum_number_of_modes",
+                          valueType=int, orientation="horizontal")
+
+        # decompositions already calculated (in this or other sessions) are read from disk
+        cache_box = oasysgui.widgetBox(self.tab_advance_settings, "Coherent mode decomposition cache", addSpace=False,
+                                       orientation="vertical")
+
+        gui.comboBox(cache_box, self, "use_cmd_cache", label="Store and reuse calculations", labelWidth=350,
+                     items=["No", "Yes"],
+                     callback=self.set_visible,
+                     tooltip="use_cmd_cache",
+                     sendSelectedValue=False, orientation="horizontal")
+
+        self.cmd_cache_panel = oasysgui.widgetBox(cache_box, "", addSpace=False, orientation="vertical")
+        oasysgui.lineEdit(self.cmd_cache_panel, self, "cmd_cache_directory", "Directory (empty: default)",
+                          labelWidth=150, tooltip=get_default_cmd_cache_directory(),
+                          valueType=str, orientation="horizontal")
+        oasysgui.lineEdit(self.cmd_cache_panel, self, "cmd_cache_max_size", "Maximum size [MB]",
+                          labelWidth=250, tooltip="least recently used calculations are removed above it",
+                          valueType=float, orientation="horizontal")
+        gui.button(self.cmd_cache_panel, self, "Clear Cache", callback=self.clear_cmd_cache)
+
         self.set_visible()
 
 
@@ -307,6 +371,22 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
         self.emittances_box_h.setVisible(self.scan_direction_flag == 0)
         self.emittances_box_v.setVisible(self.scan_direction_flag == 1)
         self.ener_dispersion_panel.setVisible(self.e_energy_dispersion_flag == 1)
+        self.mode_stack_box.setVisible(self.send_mode_stack == 1)
+        self.cmd_cache_panel.setVisible(self.use_cmd_cache == 1)
+        self.eigensolver_panel.setVisible(self.eigensolver == 1)
+
+    def get_cmd_cache_directory(self):
+        if self.use_cmd_cache == 0: return None
+        elif self.cmd_cache_directory.strip() == "": return get_default_cmd_cache_directory()
+        else: return self.cmd_cache_directory.strip()
+
+    def clear_cmd_cache(self):
+        try:
+            clear_cmd_cache(self.get_cmd_cache_directory() or get_default_cmd_cache_directory())
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+            if self.IS_DEVELOP: raise exception
 
     def increase_mode_index(self):
         self.mode_index += 1
@@ -386,10 +466,15 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
         congruence.checkStrictlyPositiveNumber(self.number_of_points, "Number of Points")
 
         congruence.checkNumber(self.mode_index, "Mode index")
+        if self.send_mode_stack == 1: congruence.checkStrictlyPositiveNumber(self.mode_stack_size, "Number of modes in the stack")
 
         congruence.checkStrictlyPositiveNumber(self.spectral_density_threshold, "Threshold")
+        if self.eigensolver == 1:
+            if self.spectral_density_threshold > 1.0: raise Exception("Cumulated occupation threshold must be <= 1")
+            congruence.checkStrictlyPositiveNumber(self.minimum_number_of_modes, "Minimum number of modes")
 
         congruence.checkStrictlyPositiveNumber(self.correction_factor, "Correction factor for SigmaI")
+        if self.use_cmd_cache == 1: congruence.checkStrictlyPositiveNumber(self.cmd_cache_max_size, "Maximum size of the cache")
 
 
     def receive_syned_data(self, data):
@@ -478,8 +563,7 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
         elif self.flag_gsm == 1:
             useGSMapproximation = True
 
-        # main calculation
-        self.coherent_mode_decomposition = UndulatorCoherentModeDecomposition1D(
+        parameters = dict(
             electron_energy=self.electron_energy_in_GeV,
             electron_current=self.ring_current,
             undulator_period=self.period_length,
@@ -499,9 +583,16 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
             e_energy_dispersion_sigma_relative=self.e_energy_dispersion_sigma_relative,
             e_energy_dispersion_interval_in_sigma_units=self.e_energy_dispersion_interval_in_sigma_units,
             e_energy_dispersion_points=self.e_energy_dispersion_points,
+            occupation_threshold=self.spectral_density_threshold if self.eigensolver == 1 else None,
+            minimum_number_of_modes=max(6, self.minimum_number_of_modes),
         )
-        # make calculation
-        self.coherent_mode_decomposition_results = self.coherent_mode_decomposition.calculate()
+
+        # main calculation, skipped if the parameters did not change or if found in the cache
+        if self.coherent_mode_decomposition is None or self.coherent_mode_decomposition_parameters != parameters:
+            self.coherent_mode_decomposition, self.coherent_mode_decomposition_results = \
+                calculate_coherent_mode_decomposition(parameters, cache_directory=self.get_cmd_cache_directory(),
+                                                      max_size_in_MB=self.cmd_cache_max_size)
+            self.coherent_mode_decomposition_parameters = parameters
 
         if self.view_type != 0:
             self.initializeTabs()
@@ -525,11 +616,37 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
         if self.view_type != 0:
             self.do_plot_send_mode()
 
+        number_of_modes = self.coherent_mode_decomposition_results["eigenvalues"].size
+        if int(self.mode_index) >= number_of_modes:
+            raise Exception("Mode %d not calculated: %d modes available (increase the occupation threshold)" % (int(self.mode_index), number_of_modes))
+
         beamline = WOBeamline(light_source=self.get_light_source())
         print(">>> sending mode: ", int(self.mode_index))
+
+        wavefront = self.coherent_mode_decomposition.get_eigenvector_wavefront(int(self.mode_index))
+
+        if self.send_mode_stack == 1:
+            mode_stack = self.get_mode_stack(wavefront)
+            print(">>> sending mode stack: modes %d to %d" % (mode_stack.get_mode_indices()[0], mode_stack.get_mode_indices()[-1]))
+        else:
+            mode_stack = None
+
         self.send("WofryData", WofryData(
-            wavefront=self.coherent_mode_decomposition.get_eigenvector_wavefront(int(self.mode_index)),
-            beamline=beamline))
+            wavefront=wavefront,
+            beamline=beamline,
+            mode_stack=mode_stack))
+
+    # the stack starts from the selected mode, so its first mode is the wavefront sent
+    def get_mode_stack(self, wavefront):
+        eigenvalues  = self.coherent_mode_decomposition_results["eigenvalues"]
+        eigenvectors = self.coherent_mode_decomposition_results["eigenvectors"]
+
+        mode_indices = numpy.arange(int(self.mode_index), min(int(self.mode_index) + int(self.mode_stack_size), eigenvalues.size))
+
+        return WofryModeStack(abscissas=wavefront.get_abscissas(),
+                              complex_amplitudes=eigenvectors[mode_indices, :] * numpy.sqrt(eigenvalues[mode_indices])[:, numpy.newaxis],
+                              wavelength=wavefront.get_wavelength(),
+                              mode_indices=mode_indices)
 
     def do_plot_send_mode(self):
         if not self.coherent_mode_decomposition is None:
@@ -565,8 +682,7 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
             #
             if self.flag_gsm:
                 abscissas = self.coherent_mode_decomposition.abscissas
-                indices = numpy.arange(abscissas.size)
-                intensity = self.coherent_mode_decomposition.CSD[indices,indices]
+                intensity = numpy.diagonal(self.coherent_mode_decomposition.CSD)
             else:
                 abscissas = self.coherent_mode_decomposition.abscissas
                 intensity = self.coherent_mode_decomposition.output_wavefront.get_intensity()
@@ -633,9 +749,10 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
             eigenvectors = self.coherent_mode_decomposition_results["eigenvectors"]
 
 
+            # the trace of the CSD is the sum of all the eigenvalues, also when only the first ones are calculated
             nmodes = self.number_of_points
             x = numpy.arange(eigenvalues.size)
-            occupation = eigenvalues[0:nmodes] / (eigenvalues.sum())
+            occupation = eigenvalues[0:nmodes] / numpy.real(numpy.trace(CSD))
             cumulated_occupation = numpy.cumsum(occupation)
 
             self.plot_data1D(x,
@@ -680,18 +797,13 @@ class OWUndulatorCoherentModeDecomposition1D(WofryWidget):
             ytitle = "spectral density"
             colors = ['green', 'black', 'red', 'brown', 'orange', 'pink']
 
-            SD = numpy.zeros_like(abscissas)
-            for i in range(SD.size):
-                SD[i] = numpy.real(CSD[i, i])
+            SD = numpy.real(numpy.diagonal(CSD))
 
-            # restore spectral density from modes
-            y = numpy.zeros_like(abscissas, dtype=complex)
-            nmodes = abscissas.size
-            for i in range(nmodes):
-                y += eigenvalues[i] * numpy.conjugate(eigenvectors[i, :]) * eigenvectors[i, :]
+            # restore spectral density from modes: sum of eigenvalue * |eigenvector|^2
+            y = numpy.einsum("i,ij->j", eigenvalues, numpy.abs(eigenvectors)**2)
 
             self.plot_multi_data1D(1e6 * abscissas,
-                             [SD,numpy.real(y)],
+                             [SD, y],
                              progressBarValue=progressBarValue,
                              tabs_canvas_index=6,
                              plot_canvas_index=6,
@@ -18,6 +18,7 @@ from wofry.propagator.wavefront2D.generic_wavefront import GenericWavefront2D
 from wofry.propagator.util.gaussian_schell_model import GaussianSchellModel2D
 
 from orangecontrib.wofry.util.wofry_objects import WofryData
+from orangecontrib.wofry.util.wofry_coherent_modes import get_gsm_2d_sorted_modes, get_gsm_2d_mode_stack
 from orangecontrib.wofry.widgets.gui.ow_wofry_widget import WofryWidget
 
 from wofryimpl.propagator.light_source import WOLightSource
@@ -73,8 +74,12 @@ class OWUndulatorGaussianShellModel2D(WofryWidget):
 
     spectral_density_threshold = Setting(0.99)
 
+    send_mode_stack = Setting(0)
+    mode_stack_size = Setting(50)
+
     wavefront2D = None
     _gsm_2d = None
+    _gsm_2d_sorted_modes = None
 
     def __init__(self):
         super().__init__(is_automatic=False, show_view_options=True, show_script_tab=True)
@@ -188,6 +193,19 @@ class OWUndulatorGaussianShellModel2D(WofryWidget):
                           labelWidth=250, tooltip="spectral_density_threshold",
                           valueType=float, orientation="horizontal")
 
+        gui.comboBox(self.mode_index_box, self, "send_mode_stack", label="Send also mode stack", labelWidth=350,
+                     items=["No",
+                            "Yes"
+                            ],
+                     callback=self.set_visible,
+                     tooltip="send_mode_stack",
+                     sendSelectedValue=False, orientation="horizontal")
+
+        self.mode_stack_box = oasysgui.widgetBox(self.mode_index_box, "", addSpace=False, orientation="vertical")
+        oasysgui.lineEdit(self.mode_stack_box, self, "mode_stack_size", "Number of modes in the stack",
+                          labelWidth=300, tooltip="mode_stack_size",
+                          valueType=int, orientation="horizontal")
+
 
 
         self.emittances_box = oasysgui.widgetBox(self.tab_emit, "Electron beam sizes", addSpace=True,
@@ -212,6 +230,7 @@ class OWUndulatorGaussianShellModel2D(WofryWidget):
     def set_visible(self):
         self.emittances_box.setVisible(self.use_emittances == 1)
         self.mode_index_box.setVisible(self.use_emittances == 1)
+        self.mode_stack_box.setVisible(self.send_mode_stack == 1)
 
     def increase_mode_index(self):
         self.mode_index += 1
@@ -271,6 +290,7 @@ class OWUndulatorGaussianShellModel2D(WofryWidget):
             congruence.checkStrictlyPositiveNumber(self.steps_step_v, "Step (V)")
 
         congruence.checkNumber(self.mode_index, "Mode index")
+        if self.send_mode_stack == 1: congruence.checkStrictlyPositiveNumber(self.mode_stack_size, "Number of modes in the stack")
 
 
     def receive_syned_data(self, data):
@@ -393,13 +413,42 @@ class OWUndulatorGaussianShellModel2D(WofryWidget):
                     pass
                 else:
                     self._gsm_2d = GaussianSchellModel2D(1.0, sigmaI_h, sigmaMu_h, sigmaI_v, sigmaMu_v)
+                    self._gsm_2d_sorted_modes = None
 
-            ih, iv = self._gsm_2d.sortedModeIndices(self.mode_index, n_points=self._n_h * self._n_v)
+            ih, iv = self.get_sorted_mode_indices(self.mode_index)
 
             print("2D mode index %d corresponds to (H,V)=(%d,%d) modes." % (self.mode_index, ih, iv))
 
         return sigmaI_h, sigmaI_v, beta_h, beta_v, ih, iv
 
+    # (n, m) orders and eigenvalues of the first n_h x n_v modes, by decreasing eigenvalue
+    def get_sorted_modes(self):
+        number_of_modes = self._n_h * self._n_v
+
+        if self._gsm_2d_sorted_modes is None or self._gsm_2d_sorted_modes[0].size != number_of_modes:
+            self._gsm_2d_sorted_modes = get_gsm_2d_sorted_modes(self._gsm_2d, number_of_modes)
+
+        return self._gsm_2d_sorted_modes
+
+    def get_sorted_mode_indices(self, mode_index):
+        n, m, _ = self.get_sorted_modes()
+
+        return n[mode_index], m[mode_index]
+
+    # separable stack of the sorted modes from mode_index: only the 1D factors are calculated
+    def get_mode_stack(self, wavefront):
+        n, m, _ = self.get_sorted_modes()
+
+        mode_indices = numpy.arange(int(self.mode_index), min(int(self.mode_index) + int(self.mode_stack_size), n.size))
+
+        return get_gsm_2d_mode_stack(self._gsm_2d,
+                                     wavefront.get_coordinate_x(),
+                                     wavefront.get_coordinate_y(),
+                                     n[mode_indices],
+                                     m[mode_indices],
+                                     wavelength=wavefront.get_wavelength(),
+                                     mode_indices=mode_indices)
+
     def get_light_source(self, sigmaI_h, sigmaI_v, beta_h, beta_v, ih, iv):
 
         return WOLightSource(
@@ -476,24 +525,14 @@ class OWUndulatorGaussianShellModel2D(WofryWidget):
                     self._cumulated_occupation = numpy.array([1.0])
                     self._eigenvalues_map = numpy.ones((1,1))
                 else:
-                    N = self._n_h * self._n_v
                     # compute cumulated occupation and eigenvalue map
-                    sorted_array = []
-                    for i in range(N):
-                        ihh, ivv = self._gsm_2d.sortedModeIndices(i, n_points=N)
-                        sorted_array.append([ihh, ivv])
+                    _, _, eigenvalues = self.get_sorted_modes()
 
-
-                    eigenvalues_x = numpy.array([self._gsm_2d._mode_x.beta(i) for i in range(N)])
-                    eigenvalues_y = numpy.array([self._gsm_2d._mode_y.beta(i) for i in range(N)])
-
-                    eigenvalues = numpy.zeros(N)
-                    for i in range(eigenvalues.size):
-                        eigenvalues[i] = eigenvalues_x[sorted_array[i][0]] * \
-                                         eigenvalues_y[sorted_array[i][1]]
+                    eigenvalues_x = numpy.array([self._gsm_2d._mode_x.beta(i) for i in range(self._n_h)])
+                    eigenvalues_y = numpy.array([self._gsm_2d._mode_y.beta(i) for i in range(self._n_v)])
 
                     self._cumulated_occupation = numpy.cumsum(eigenvalues)
-                    self._eigenvalues_map = numpy.outer(eigenvalues_x[0:self._n_h],eigenvalues_y[0:self._n_v])
+                    self._eigenvalues_map = numpy.outer(eigenvalues_x, eigenvalues_y)
                     self._spectral_density_threshold_backup = self.spectral_density_threshold
 
 
@@ -507,7 +546,14 @@ class OWUndulatorGaussianShellModel2D(WofryWidget):
             except:
                 pass
 
-            self.send("WofryData", WofryData(wavefront=self.wavefront2D, beamline=beamline))
+            if self.use_emittances == 1 and self.send_mode_stack == 1:
+                mode_stack = self.get_mode_stack(self.wavefront2D)
+                self.setStatusMessage("Mode stack: modes %d to %d" % (mode_stack.get_mode_indices()[0], mode_stack.get_mode_indices()[-1]))
+            else:
+                mode_stack = None
+                self.setStatusMessage("")
+
+            self.send("WofryData", WofryData(wavefront=self.wavefront2D, beamline=beamline, mode_stack=mode_stack))
 
         except Exception as exception:
             QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
@@ -524,7 +570,7 @@ class OWUndulatorGaussianShellModel2D(WofryWidget):
 
             titles = ["Wavefront 2D Intensity", "Cumulated occupation", "Eigenvalues map"]
             try:
-                ih, iv = self._gsm_2d.sortedModeIndices(self.mode_index, n_points=self._n_h * self._n_v)
+                ih, iv = self.get_sorted_mode_indices(self.mode_index)
             except:
                 ih, iv = 0, 0
 
@@ -62,6 +62,7 @@ ENTRY_POINTS = {
         "Wofry Optical Elements = orangecontrib.wofry.widgets.beamline_elements",
         "Wofry Tools = orangecontrib.wofry.widgets.tools",
     ),
+    'console_scripts' : ("wofry-batch = orangecontrib.wofry.util.wofry_batch:main", ),
 }
 
 if __name__ == '__main__':